@@ -1,704 +1,843 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, g, request, jsonify, render_template
 from flask_cors import CORS
-from flask_mail import Mail, Message
+from flask_mail import Mail
 from dotenv import load_dotenv
-from fpdf import FPDF
 import base64
+import functools
+import hmac
 import json
-import requests
-from requests.auth import HTTPBasicAuth
+import logging
+import time
 import os
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from werkzeug.exceptions import HTTPException
+
+from jobs import (
+    DEFAULT_DB_PATH, DONE, FAILED, PENDING, RETRYING, RUNNING, SKIPPED,
+    JobQueue, SubmissionStore, fan_out, validate_submission,
+)
+import outbox as outbox_module
+from attachments import ASSETS_DIR, AttachmentCache, CachedPartMessage, DiskFile
+from breaker import CircuitBreaker, CircuitOpenError
+from email_templates import get_email_body, medication_key
+from images import ImageTarget, SizeStats
+from logs import log_payload, mask_email, setup_logging
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, registry as metrics
+from order_batcher import OrderBatcher
+from outbox import DeferDelivery, DeliveryRejected, Dispatcher, Outbox
+from pdf_engine import PdfRenderEngine
+from pdf_export import FORMATS as EXPORT_FORMATS, date_range, export_pdfs
+from profiling import profiler_from_env
+from shipstation import ShipStationClient
+from smtp_pool import SMTPPool
+from store_cache import DEFAULT_CACHE_PATH as STORE_CACHE_PATH, StoreDirectory
+from tracing import add_trace_id_to_logs, current_trace_id, tracer_from_env
+from treatment_plan_pdf import TreatmentPlanBuilder
+from uploads import DEFAULT_MAX_BYTES as DEFAULT_MAX_ID_FILE_BYTES, DEFAULT_UPLOAD_DIR, UploadRejected, save_upload
 
 # Load environment variables from .env file
 load_dotenv()
+setup_logging()
+log = logging.getLogger(__name__)
+
+# ✅ Request tracing: one trace per submission, spans written to TRACE_FILE
+tracer = tracer_from_env()
+add_trace_id_to_logs()
+
+# ✅ Opt-in request profiles (PROFILE_SAMPLE_RATE, or X-Profile: 1 from an admin)
+profiler = profiler_from_env()
 
 # Initialize Flask app
 app = Flask(__name__, static_folder="static", template_folder="templates")
 CORS(app)
 
+# ✅ Metrics, served in the Prometheus text format at /metrics
+STAGE_SECONDS = metrics.histogram(
+    "wlf_stage_duration_seconds", "Time spent in each submission stage", ("stage", "medication"))
+STAGE_ERRORS = metrics.counter(
+    "wlf_stage_errors_total", "Submission stages that failed", ("stage", "medication"))
+STAGES_IN_FLIGHT = metrics.gauge("wlf_stages_in_flight", "Submission stages running right now", ("stage",))
+HTTP_SECONDS = metrics.histogram("wlf_http_request_duration_seconds", "Time to answer a request", ("endpoint",))
+HTTP_REQUESTS = metrics.counter("wlf_http_requests_total", "Answered requests", ("endpoint", "status"))
+HTTP_IN_FLIGHT = metrics.gauge("wlf_http_requests_in_flight", "Requests being handled right now", ("endpoint",))
+WEBHOOKS = metrics.counter("wlf_shipstation_webhooks_total", "ShipStation webhooks received", ("resource_type",))
+# ShipStation's webhook events; anything else is counted as "other"
+WEBHOOK_TYPES = frozenset({"ORDER_NOTIFY", "ITEM_ORDER_NOTIFY", "SHIP_NOTIFY", "ITEM_SHIP_NOTIFY"})
+OUTBOX_DELIVERY_SECONDS = metrics.histogram(
+    "wlf_outbox_delivery_seconds", "Time to deliver an outbox entry", ("kind", "outcome"))
+OUTBOX_ENTRIES = metrics.gauge("wlf_outbox_entries", "Outbox entries by status", ("status",))
+BREAKER_OPEN = metrics.gauge("wlf_circuit_open", "1 while an integration's circuit breaker is not closed", ("breaker",))
+
+def instrumented(endpoint):
+    """Count, time, trace and (when asked) profile the requests of a view"""
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            status = 500
+            # Decided once per request; the work it queues is profiled along with it
+            g.profile = profiler.wanted(profile_requested(request))
+            try:
+                with tracer.span(endpoint) as span, HTTP_IN_FLIGHT.track_in_progress(endpoint=endpoint), \
+                        HTTP_SECONDS.time(endpoint=endpoint), \
+                        profiler.profile(endpoint, span.trace_id, requested=g.profile, sample=False):
+                    response = app.make_response(view(*args, **kwargs))
+                    status = response.status_code
+                    span.set(status=status)
+                response.headers["X-Trace-Id"] = span.trace_id
+                return response
+            except HTTPException as e:
+                status = e.code
+                raise
+            finally:
+                HTTP_REQUESTS.inc(endpoint=endpoint, status=status)
+        return wrapper
+    return decorate
+
+# ✅ Upload limits: the whole request, and the ID file within it
+MAX_ID_FILE_BYTES = int(os.getenv("MAX_ID_FILE_BYTES", str(DEFAULT_MAX_ID_FILE_BYTES)))
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_REQUEST_BYTES", str(MAX_ID_FILE_BYTES + 1024 * 1024)))
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", DEFAULT_UPLOAD_DIR)
+
 # ✅ Email configuration (SendGrid)
-app.config['MAIL_SERVER'] = 'smtp.sendgrid.net'
-app.config['MAIL_PORT'] = 587
-app.config['MAIL_USE_TLS'] = True
+app.config['MAIL_SERVER'] = os.getenv("MAIL_SERVER", 'smtp.sendgrid.net')
+app.config['MAIL_PORT'] = int(os.getenv("MAIL_PORT", "587"))
+app.config['MAIL_USE_TLS'] = os.getenv("MAIL_USE_TLS", "true").lower() in ("1", "true", "yes")
 app.config['MAIL_USERNAME'] = os.getenv("MAIL_USERNAME")  # Should be 'apikey'
 app.config['MAIL_PASSWORD'] = os.getenv("MAIL_PASSWORD")  # Your SendGrid API key
 app.config['MAIL_DEFAULT_SENDER'] = "info@citylifepharmacy.com"  # Your verified sender
 
-# ✅ ShipStation credentials
-SHIPSTATION_API_KEY = os.getenv("SHIPSTATION_API_KEY")
-SHIPSTATION_API_SECRET = os.getenv("SHIPSTATION_API_SECRET")
+# ✅ ShipStation client (pooled keep-alive session, reads SHIPSTATION_* settings)
+shipstation = ShipStationClient.from_env()
+
+# ✅ ShipStation store, discovered from /stores and cached on disk
+store_directory = StoreDirectory(
+    shipstation,
+    cache_path=os.getenv("SHIPSTATION_STORE_CACHE", STORE_CACHE_PATH),
+    ttl=float(os.getenv("SHIPSTATION_STORE_TTL", str(6 * 3600))),
+    refresh_interval=float(os.getenv("SHIPSTATION_STORE_REFRESH", "3600")),
+    configured_store_id=os.getenv("SHIPSTATION_STORE_ID"),
+)
 
 # Initialize Mail
 mail = Mail(app)
 
-# Ensure uploads folder exists
-os.makedirs("uploads", exist_ok=True)
+# Keep authenticated SMTP connections open across submissions
+smtp_pool = SMTPPool(
+    mail,
+    size=int(os.getenv("SMTP_POOL_SIZE", "4")),
+    max_idle=float(os.getenv("SMTP_POOL_MAX_IDLE", "120")),
+    timeout=float(os.getenv("SMTP_TIMEOUT", "30")),
+    acquire_timeout=float(os.getenv("SMTP_POOL_ACQUIRE_TIMEOUT", "60")),
+)
 
-# ✅ ShipStation order sender function
-def send_to_shipstation(order_data):
-    url = "https://ssapi.shipstation.com/orders/createorder"
-    auth = HTTPBasicAuth(SHIPSTATION_API_KEY, SHIPSTATION_API_SECRET)
+# Instruction PDFs for injectables, read once and kept in memory
+attachment_cache = AttachmentCache(os.getenv("INSTRUCTIONS_DIR", ASSETS_DIR))
+attachment_cache.preload()
 
-    # Inject the correct store ID if it's not already set
+# Optionally send one treatment-plan PDF (cover page + instructions) instead
+treatment_plan_pdf = os.getenv("TREATMENT_PLAN_PDF", "").lower() in ("1", "true", "yes")
+
+def apply_default_store(order_data):
+    # Inject the discovered store ID if it's not already set
     if "storeId" not in order_data or not order_data["storeId"]:
-        order_data["storeId"] = "7d85cae5-49cd-419c-985a-d00c871321e5"
+        if store_directory.store_id is None:
+            # Only right after a cold start, before the first /stores response
+            store_directory.wait_ready(5)
+        if store_directory.store_id:
+            order_data["storeId"] = store_directory.store_id
+    return order_data
 
-    try:
-        response = requests.post(url, json=order_data, auth=auth)
-        if response.status_code == 200:
-            print("📦 Order successfully sent to ShipStation.")
-        else:
-            print(f"❌ ShipStation error: {response.status_code} - {response.text}")
-    except Exception as e:
-        print(f"⚠️ Exception sending to ShipStation: {e}")
+# ✅ ShipStation order sender function
+def send_to_shipstation(order_data):
+    """Create one order; raises OrderRejected if ShipStation refuses it, RuntimeError on other errors"""
+    apply_default_store(order_data)
+
+    response = shipstation.create_order(order_data)
+    if response.status_code == 200:
+        log.info("Order sent to ShipStation", extra={"orderNumber": order_data.get("orderNumber")})
+        return True
+    log.error("ShipStation error", extra={"status": response.status_code, "response": response.text[:500]})
+    if 400 <= response.status_code < 500 and response.status_code != 429:
+        # A bad address or payload: ShipStation is up, retrying won't help
+        raise OrderRejected(f"ShipStation rejected order {order_data.get('orderNumber')}: "
+                            f"{response.status_code} - {response.text[:500]}")
+    raise RuntimeError(f"ShipStation error: {response.status_code} - {response.text[:500]}")
+
+def send_orders_to_shipstation(orders):
+    """Create a batch of orders with one createorders call; returns per-order results"""
+    response = shipstation.create_orders([apply_default_store(order) for order in orders])
+    if response.status_code != 200:
+        raise RuntimeError(f"ShipStation error: {response.status_code} - {response.text}")
+    results = response.json().get("results", [])
+    log.info("Sent a batch of orders to ShipStation", extra={
+        "orders": len(orders), "accepted": sum(1 for result in results if result.get('success')),
+    })
+    return results
+
+# Collects orders from concurrent submissions into createorders calls
+order_batcher = OrderBatcher(
+    send_orders_to_shipstation,
+    max_batch=int(os.getenv("SHIPSTATION_BATCH_SIZE", "20")),
+    max_wait=float(os.getenv("SHIPSTATION_BATCH_WINDOW", "1.0")),
+)
 
 @app.route("/")
 def home():
     return render_template("index.html")
 
-# ✅ Only ONE get_email_body() defined
-def get_email_body(med, name):
-    if med == "quickstrips":
-        return f"""Hi {name},
-
-Thank you for using City Life Pharmacy, I have reviewed your medical intake and I have put together the following treatment plan for you below. Please read it carefully.
-
-You have been prescribed compounded semaglutide oral dissolving film. 
-
-Oraldissolving films are a novel way to take semaglutide that allows you to receive the dose effectively and safely. Oral dissolving films allow you to bypass the digestive tract which allows you to get more of the medication into your bloodstream without being broken down by your stomach acids or liver. This also would reduce the side effects of the medication.
-
-Taking GLP-1 medication like semaglutide while taking steps toward maintaining a healthy diet and lifestyle can help you achieve your target weight.
-
-Please note: Your prescription has been sent to the pharmacy for processing and fulfillment and should ship out within 3-4 business days.
-
-Imagine your GLP-1 medication is like a gas pedal for your hunger. At first, you might need to press down a bit more (higher dose) to feel satisfied with less food and reach your weight loss goals. This helps you ease off the gas and eat less.
-
-The good news is, as you keep using the medication, your body gets used to this setting (reaches steady-state). Once you've reached your goal weight or your cravings are under control at a specific dose, you don't need to keep pushing down on the gas pedal further (increasing the dose). You can keep your foot at that comfortable level (steady-state dose) to maintain your progress!
-
-This means you can take your GLP-1 medication consistently at the same dose to keep your appetite in check and your weight loss on track. Talk to your doctor about when a steady-state dose might be the right "cruising speed" for you.
-
-*On your next refill order date, you will be asked a series of questions with your refill order, which will help me determine if you need to be increased, or kept at the same dose*
-
-<strong>*Please make sure to follow up with your primary care physician for routine screening including evaluation of your cholesterol levels, thyroid levels, and other
-routine lab testing*</strong>
-
-<strong>How should you take semaglutide strips?</strong>
-Make sure your hands are dry and clean before removing the strips. The strip should then be removed from its packaging and placed either under the tongue (sublingual) or between your gum and cheek (buccal). The strip should start dissolving almost immediately when it comes in contact with your saliva. Allow it to rest in place for 90 seconds before swallowing any remaining undissolved portion of the strip. You may drink water after this step although it is not necessary. The starting dose of the strips is 0.5 mg once daily. The dose may be increased to daily based on your response.
-
-<strong>What is the titration schedule with semaglutide strips?</strong>
-In general, the starting dose is 0.5 mg taken once daily for one month. This allows your body to get used to the medication and observe if you experienceany side effects. The dose can be increased to 1 mg once daily for another month if you are tolerating the medication well. The dose can be increased to 2 and 3 mg once daily for the third and foruth month based on your response and if you are tolerating the medication well. 
-
-<strong>How should semaglutide strips be stored?</strong>
-The medication should be stored at room temperature and in an area away from light and moisture. We recommend storing it in your bedroom or living room area as those areas are generally not exposed to fluctuations in temperature and aren't exposed to
-moisture.
-
-<strong>WHO SHOULD NOT TAKE SEMAGLUTIDE?</strong>
-Patients to whom the following apply are not eligible for Semaglutide Treatment:
-- Eating Disorder
-- Gallbladder Disease (does not include gallbladder         removal/cholecystectomy)
-- Drug Abuse
-- Alcohol Abuse
-- Recent Bariatric Surgery
-- Pancreatitis
-- Personal or family history of medullary Thyroid Cancer
-- Multiple endocrine neoplasia type 2 syndrome (MEN-2)
-- Currently Pregnant
-- Currently Breastfeeding
-- Planning to Become Pregnant
-- Retinopathy
-
-
-<strong>WHAT ARE THE COMMON SIDE EFFECTS OF SEMAGLUTIDE?</strong>
-- Nausea is most common in customers beginning treatment with Semaglutide. Other common side effects are abdominal pain, headaches, fatigue, constipation, diarrhea, dizziness, upset stomach, and heartburn. Please let us know if you are experiencing any adverse symptoms and call 911 or go to the emergency room if you feel like you are experiencing a medical emergency.
-
-Thank you and please contact us if you have any questions or concerns
-
-Rimon
-<strong>Pharmacist</strong>
-
-City Life Pharmacy & Compounding Centre
-info@CityLifePharmacy.com
-www.CityLifePharmacy.com
-Tel 416-214-CITY (2489)"""
-    
-    elif med == "drops":
-        return f"""Hi {name},
-
-Thank you for using City Life Pharmacy, I have reviewed your medical intake and I have put together the following treatment plan for you below. Please read it carefully.
-
-Taking GLP-1 medication like semaglutide while taking steps toward maintaining a healthy diet and lifestyle can help you achieve your target weight.
-
-Please note: Your prescription has been sent to the pharmacy for processing and fulfillment and should ship out within 2-3 business days.
-
-Imagine your GLP-1 medication is like a gas pedal for your hunger. At first, you might need to press down a bit more (higher dose) to feel satisfied with less food and
-reach your weight loss goals. This helps you ease off the gas and eat less. The good news is, as you keep using the medication, your body gets used to this setting (reaches steady-state). Once you've reached your goal weight or your cravings are under control at a specific dose, you don't need to keep pushing down on the gas pedal further (increasing the dose). You can keep your foot at that comfortable level (steady-state dose) to maintain your progress! This means you can take your GLP-1 medication consistently at the same dose to keep your appetite in check and your weight loss on track. Talk to your doctor about when a steady-state dose might be the right "cruising speed" for you.
-
-<strong>*On your next refill order date, you will be asked a series of questions with your refill order, which will help me determine if you need to be increased, or kept at the same dose.*</strong>
-
-<strong>*Please make sure to follow up with your primary care physician for routine screening including evaluation of your cholesterol levels, thyroid levels, and other routine lab testing.</strong>
-
-<strong>WHO SHOULD NOT TAKE SEMAGLUTIDE?</strong>
-Patients to whom the following apply are not eligible for Semaglutide Treatment:
-- Eating Disorder
-- Gallbladder Disease (does not include gallbladder removal/cholecystectomy)
-- Drug Abuse
-- Alcohol Abuse
-- Recent Bariatric Surgery
-- Pancreatitis
-- Personal or family history of medullary Thyroid Cancer
-- Multiple endocrine neoplasia type 2 syndrome (MEN-2)
-- Currently Pregnant
-- Currently Breastfeeding
-- Planning to Become Pregnant
-- Retinopathy
-
-<strong>WHAT ARE THE COMMON SIDE EFFECTS OF SEMAGLUTIDE?</strong>
-- Nausea is most common in customers beginning treatment with Semaglutide. Other common side effects are abdominal pain, headaches, fatigue, constipation, diarrhea, dizziness, upset stomach, and heartburn. Please let us know if you are experiencing any adverse symptoms and call 911 or go to the emergency room if you feel like you are experiencing a medical emergency.
-
-<strong>How do you take sublingual semaglutide drops?</strong>
-Draw up 1 ml using the syringe given to you and place the drops underneath the tongue once daily. Press down your tongue for at least 90 seconds to keep the liquid in place to allow for proper absorption of the medication. Do not eat or drink anything for at least half an hour after using the medication. The preferred time to use the medication is in the evening towards bed time.
-
-<strong>What is the titration schedule of Semaglutide drops?</strong>
-The general starting point for semaglutide sublingual drops is 0.5 mg once daily for 1 month. This first month is to get your body used to the medication and to see if any side effects are observed. If well tolerated, the dose can be increased to 1 mg daily for a month and then possibly 2 mg and 3 mg in the third and fourth month based on response and tolerability. Month 2-3 is when usually most people start to see meaningful changes in their weight.
-
-<strong>How should Semaglitude drops be stored?</strong>
-The medication should be stored at room temperature and in an area away from light and moisture. We recommend storing it in your bedroom or living room area as those areas are generally not exposed to fluctuations in temperature and aren't exposed to moisture.
-
-Thank you and please reach out to us if you have any questions or concerns!
-
-Rimon
-<strong>Pharmacist</strong>
-
-            City Life Pharmacy & Compounding Centre
-                    info@CityLifePharmacy.com
-                    www.CityLifePharmacy.com
-                    Tel 416-214-CITY (2489)"""
-
-    elif med == "tirzepatide":
-        return f"""Hi {name},
-
-Thank you for using City Life Pharmacy  I have reviewed your medical intake and I have put together the following treatment plan for you below. Please read it carefully. You have been prescribed Mounjaro (tirzepatide). This medication typically follows a
-titration schedule that is outlined below. At your follow up your physician will determine if you are to increase, decrease, or stay at your current dose.
-
-<strong>Mounjaro Dosing Schedule:</strong>
-Month 1: Inject 2.5mg subcutaneously once weekly x 4 weeks.
-Month 2 : Inject 5mg subcutaneously once weekly x 4 weeks.
-Month 3: Inject 7.5mg subcutaneously once weekly x 4 weeks
-Month 4: Inject 10 mg subcutaneously once weekly x 4 weeks
-Month 5: Inject 12.5mg subcutaneously once weekly x 4 weeks
-Month 6: Inject 15mg subcutaneously once weekly x 4 weeks
-
-Taking GLP-1 medication like tirzepatide while taking steps toward maintaining a healthy diet and lifestyle can help you achieve your target weight.
-
-Please note: Your prescription has been sent to the pharmacy for processing and fulfillment and should ship out within 1-2 business days. Please store Mounjaro vialsin the fridge. You may store it at room temperature for 21 days.
-
-Imagine your GLP-1 medication is like a gas pedal for your hunger. At first, you might need to press down a bit more (higher dose) to feel satisfied with less food and
-reach your weight loss goals. This helps you ease off the gas and eat less. The good news is, as you keep using the medication, your body gets used to this
-setting (reaches steady-state). Once you've reached your goal weight or your cravings are under control at a specific dose, you don't need to keep pushing down on the gas pedal further (increasing the dose). You can keep your foot at that comfortable level (steady-state dose) to maintain your progress!
-
-This means you can take your GLP-1 medication consistently at the same dose to keep your appetite in check and your weight loss on track. Talk to your doctor about when a steady-state dose might be the right "cruising speed" for you.
-
-<strong>*On your next refill order date, you will be asked a series of questions with your refill order, which will help me determine if you need to be increased, or kept at the same
-dose.*</strong>
-
-<strong>*Please make sure to follow up with your primary care physician for routine screening including evaluation of your cholesterol levels, thyroid levels, and other routine lab testing.</strong>
-
-<strong>Below is more detailed information about tirzepatide I would like you to review:</strong>
-
-<strong>WHO SHOULD NOT TAKE Tirzepatide?</strong>
-Patients to whom the following apply are not eligible for tirzepatide Treatment:
-- Eating Disorder
-- Gallbladder Disease (does not include gallbladder removal/cholecystectomy)
-- Drug Abuse
-- Alcohol Abuse
-- Recent Bariatric Surgery
-- Pancreatitis
-- Personal or family history of medullary Thyroid Cancer
-- Multiple endocrine neoplasia type 2 syndrome (MEN-2)
-- Currently Pregnant
-- Currently Breastfeeding
-- Planning to Become Pregnant
-- Retinopathy
-
-<strong>WHAT ARE THE COMMON SIDE EFFECTS OF TIRZEPATIDE?</strong>
-- Nausea is most common in customers beginning treatment with tirzepatide. Other common side effects are abdominal pain, headaches, fatigue, constipation, diarrhea, dizziness, upset stomach, and heartburn. Please let us know if you are experiencing any adverse symptoms and call 911 or go to the emergency room if you feel like you
-are experiencing a medical emergency. Thank you and please reach out to us if you have any questions, concerns, or need further clarification.
-
-<strong>HOW SHOULD I TAKE MOUNJARO?</strong>
-- Mounjaro is injected subcutaneously (meaning it is injected in the "fat tissue" right underneath your skin
-- The preferred site of injection is around the abdomen (at least 2 inches away from the belly button) or the thigh
-- Make sure to rotate sites every week ( do not inject the same spot 2 weeks in a row)
-- Do not inject where the skin has pits, is thickened, or has lumps
-- Do not inject where the skin is tender, bruised, scaly or hard, or into scars or damaged skin
-- Each Mounjaro Pen contontains 4 doses (enough for a month)
-- To prepare for your injection, remove the pen from the refrigerator
-- Wash your hands with Soap and Water
-- And Check the pen to make sure you have the correct medication
-- Make sure the medicine is either colourless or slightly yellow
--Do not use if the pen if it is frozen, cloudy, or has particles
--We have attached detailed instructions on how to inject the medication to this email. Please follow these instructions.
-- Please do not hesitate to contact us for any questions or concerns.
-
-                            Rimon 
-                <strong>Pharmacist </strong>
-
-            City Life Pharmacy & Compounding Centre
-                    info@CityLifePharmacy.com
-                    www.CityLifePharmacy.com
-                    Tel 416-214-CITY (2489)"""
-
-    elif med == "ozempic":
-        return f"""Hi {name},
-
-
-Thank you for your order.  I have reviewed your medical intake and I have put together the following treatment plan for you below.  Please read it carefully.
-
-You have been prescribed Ozempic (semaglutide). This medication typically follows a titration schedule that is outlined below. At your follow up your physician will determine if you are to increase, decrease, or stay at your current dose.
-
-
- We have attached detailed instructions on how to inject Ozempic to this email. Please read it carefully.  
- 
- Ozempic Dosing Schedule:
-
-        Month 1:  Inject 0.25mg subcutaneously once weekly x 4 weeks.
-
-        Month 2: Inject 0.5mg subcutaneously once weekly x 4 weeks.
-
-        Month 3: Inject 1 mg subcutaneously once weekly for 4 weeks 
-
-        *Follow up visit*
-
-        Month 4: Inject 1mg subcutaneously once weekly x 4 weeks
-
-
- Wegovy Dosing Schedule:
-
-        Month 5: Inject 1.75mg subcutaneously once weekly x 4 weeks
-
-        Month 6: Inject 2mg subcutaneously once weekly x 4 weeks
-
-        *Months 5 and 6 are dispensed as Wegovy to ensure the most cost effective semaglutide option.
-
-
-Taking GLP-1 medication like semaglutide while taking steps toward maintaining a healthy diet and lifestyle can help you achieve your target weight.
-
-Please note: Your prescription has been sent to the pharmacy for processing and fulfillment and should ship out within 1-2 business days. Please store Ozempic and Wegovy pens in the fridge until you are ready to use the medication. Once the medication is out of the fridge, it can be stored at room temperature for 56 days.
-
-Imagine your GLP-1 medication is like a gas pedal for your hunger. At first, you might need to press down a bit more (higher dose) to feel satisfied with less food and reach your weight loss goals. This helps you ease off the gas and eat less.
-
-The good news is, as you keep using the medication, your body gets used to this setting (reaches steady-state). Once you've reached your goal weight or your cravings are under control at a specific dose, you don't need to keep pushing down on the gas pedal further (increasing the dose). You can keep your foot at that comfortable level (steady-state dose) to maintain your progress!
-
-This means you can take your GLP-1 medication consistently at the same dose to keep your appetite in check and your weight loss on track. Talk to your doctor about when a steady-state dose might be the right "cruising speed" for you.
-
-*On your next refill order date, you will be asked a series of questions with your refill order, which will help me determine if you need to be increased, or kept at the same dose.
-
- *Please make sure to follow up with your primary care physician for routine screening including evaluation of your cholesterol levels, thyroid levels, and other routine lab testing.
-
-Below is more detailed information about Semaglutide I would like you to review:
-
-RISKS:
-
-WHO SHOULD NOT TAKE SEMAGLUTIDE?
-
-Patients to whom the following apply are not eligible for Semaglutide Treatment:
-
-- Eating Disorder
-- Gallbladder Disease (does not include gallbladder removal/cholecystectomy)
-- Drug Abuse
-- Alcohol Abuse
-- Recent Bariatric Surgery
-- Pancreatitis
-- Personal or family history of medullary Thyroid Cancer
- - Multiple endocrine neoplasia type 2 syndrome (MEN-2)
- - Currently Pregnant
-- Currently Breastfeeding
-- Planning to Become Pregnant
-- Retinopathy
-
-WHAT ARE THE COMMON SIDE EFFECTS OF SEMAGLUTIDE?
-
-Nausea is most common in customers beginning treatment with Semaglutide. Other common side effects are abdominal pain, headaches, fatigue, constipation, diarrhea, dizziness, upset stomach, and heartburn. Please let us know if you are experiencing any adverse symptoms and call 911 or go to the emergency room if you feel like you are experiencing a medical emergency.
-
-
-Thank you and please reach out to us if you have any questions, concerns, or need further clarification. 
-
-
-                        Rimon
-                Pharmacist 
-
-
-
-
-
-            City Life Pharmacy & Compounding Centre
-                 info@CityLifePharmacy.com
-                www.CityLifePharmacy.com
-                Tel 416-214-CITY (2489)"""
-
-def generate_patient_pdf(data):
-    """Generate a PDF from the patient data"""
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", size=12)
-    
-    # Title
-    pdf.set_font("Arial", "B", 16)
-    pdf.cell(0, 10, "Patient Information", ln=True, align="C")
-    pdf.ln(10)
-    
-    # Patient details
-    pdf.set_font("Arial", size=12)
-    
-    # Helper function to add a field to the PDF
-    def add_field(label, value):
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(60, 8, f"{label}:", 0, 0)
-        pdf.set_font("Arial", size=12)
-        pdf.cell(0, 8, str(value), 0, 1)
-    
-    # Basic Information
-    pdf.set_font("Arial", "B", 14)
-    pdf.cell(0, 10, "Basic Information", 0, 1)
-    pdf.ln(5)
-    
-    if 'firstName' in data:
-        add_field("First Name", data['firstName'])
-    if 'lastName' in data:
-        add_field("Last Name", data['lastName'])
-    if 'email' in data:
-        add_field("Email", data['email'])
-    if 'phone' in data:
-        add_field("Phone", data['phone'])
-    if 'dateOfBirth' in data:
-        add_field("Date of Birth", data['dateOfBirth'])
-    if 'gender' in data:
-        add_field("Gender", data['gender'])
-    
-    pdf.ln(5)
-    
-    # Address Information
-    if any(key in data for key in ['address', 'city', 'province', 'postalCode']):
-        pdf.set_font("Arial", "B", 14)
-        pdf.cell(0, 10, "Address Information", 0, 1)
-        pdf.ln(5)
-        
-        if 'address' in data:
-            add_field("Address", data['address'])
-        if 'city' in data:
-            add_field("City", data['city'])
-        if 'province' in data:
-            add_field("Province", data['province'])
-        if 'postalCode' in data:
-            add_field("Postal Code", data['postalCode'])
-        
-        pdf.ln(5)
-    
-    # Physical Information
-    if any(key in data for key in ['height', 'weight', 'bmi']):
-        pdf.set_font("Arial", "B", 14)
-        pdf.cell(0, 10, "Physical Information", 0, 1)
-        pdf.ln(5)
-        
-        if 'height' in data:
-            add_field("Height", f"{data['height']} inches")
-        if 'weight' in data:
-            add_field("Weight", f"{data['weight']} lbs")
-        if 'bmi' in data:
-            add_field("BMI", f"{data['bmi']:.1f}")
-        
-        pdf.ln(5)
-    
-    # Medical Information
-    pdf.set_font("Arial", "B", 14)
-    pdf.cell(0, 10, "Medical Information", 0, 1)
-    pdf.ln(5)
-    
-    # Go through all the questions and answers
-    medical_fields = [
-        'currentMedications', 'allergies', 'medicalConditions', 'weightLossAttempts',
-        'idealWeight', 'dietaryRestrictions', 'exerciseRoutine', 'smokingStatus',
-        'alcoholConsumption', 'sleepPatterns', 'stressLevels', 'menstrualCycle',
-        'medications', 'preferredMedication', 'treatmentGoals'
-    ]
-    
-    for field in medical_fields:
-        if field in data and data[field]:
-            # Convert field name to readable format
-            readable_field = field.replace('_', ' ').replace('camelCase', ' ').title()
-            readable_field = readable_field.replace('Current Medications', 'Current Medications')
-            readable_field = readable_field.replace('Medical Conditions', 'Medical Conditions')
-            readable_field = readable_field.replace('Weight Loss Attempts', 'Previous Weight Loss Attempts')
-            readable_field = readable_field.replace('Ideal Weight', 'Target Weight')
-            readable_field = readable_field.replace('Dietary Restrictions', 'Dietary Restrictions')
-            readable_field = readable_field.replace('Exercise Routine', 'Exercise Routine')
-            readable_field = readable_field.replace('Smoking Status', 'Smoking Status')
-            readable_field = readable_field.replace('Alcohol Consumption', 'Alcohol Consumption')
-            readable_field = readable_field.replace('Sleep Patterns', 'Sleep Patterns')
-            readable_field = readable_field.replace('Stress Levels', 'Stress Levels')
-            readable_field = readable_field.replace('Menstrual Cycle', 'Menstrual Cycle')
-            readable_field = readable_field.replace('Preferred Medication', 'Preferred Medication')
-            readable_field = readable_field.replace('Treatment Goals', 'Treatment Goals')
-            
-            value = data[field]
-            if isinstance(value, list):
-                value = ', '.join(value)
-            
-            add_field(readable_field, value)
-    
-    # Delivery Method Section
-    if 'deliveryMethod' in data:
-        pdf.ln(5)
-        pdf.set_font("Arial", "B", 14)
-        pdf.cell(0, 10, "Delivery Information", 0, 1)
-        pdf.ln(5)
-        add_field("Delivery Method", data['deliveryMethod'].title())
-    
-    # Add any other fields that weren't covered
-    excluded_fields = ['firstName', 'lastName', 'email', 'phone', 'dateOfBirth', 'gender',
-                      'address', 'city', 'province', 'postalCode', 'height', 'weight', 'bmi', 'deliveryMethod'] + medical_fields
-    
-    other_fields = {k: v for k, v in data.items() if k not in excluded_fields and v}
-    
-    if other_fields:
-        pdf.ln(5)
-        pdf.set_font("Arial", "B", 14)
-        pdf.cell(0, 10, "Additional Information", 0, 1)
-        pdf.ln(5)
-        
-        for field, value in other_fields.items():
-            readable_field = field.replace('_', ' ').replace('camelCase', ' ').title()
-            if isinstance(value, list):
-                value = ', '.join(value)
-            add_field(readable_field, str(value))
-    
-    # Save to a temporary file
-    filename = f"patient_{data.get('firstName', 'unknown')}_{data.get('lastName', 'patient')}.pdf"
-    filepath = os.path.join("uploads", filename)
-    pdf.output(filepath)
-    
-    return filepath
+def run_stage(submission_id, stage, func, *args, medication):
+    """Run one processing stage, time it and record its outcome on the submission"""
+    submissions.set_stage(submission_id, stage, RUNNING)
+    try:
+        with tracer.span(stage, submissionId=submission_id) as span, \
+                STAGES_IN_FLIGHT.track_in_progress(stage=stage), STAGE_SECONDS.time(stage=stage, medication=medication):
+            result = func(*args)
+            if result is SKIPPED or result is RETRYING:
+                span.set(outcome="skipped" if result is SKIPPED else "deferred")
+    except Exception as e:
+        STAGE_ERRORS.inc(stage=stage, medication=medication)
+        submissions.set_stage(submission_id, stage, FAILED, str(e))
+        log.error("Stage failed: %s", e, extra={"submissionId": submission_id, "stage": stage})
+        return None
+    if result is SKIPPED:
+        submissions.set_stage(submission_id, stage, SKIPPED)
+    elif result is not RETRYING:
+        # RETRYING stages are updated by the outbox dispatcher hooks
+        submissions.set_stage(submission_id, stage, DONE)
+    return result
+
+def deliver(submission_id, stage, kind, payload, body=None):
+    """Record a side effect in the outbox, then try to deliver it right away"""
+    entry_id = outbox.add(kind, payload, body=body, submission_id=submission_id, stage=stage)
+    if not outbox_dispatcher.dispatch(entry_id):
+        return RETRYING
+
+def queue_email(submission_id, stage, msg):
+    # Freeze the rendered message so retries send exactly the same bytes
+    if msg.date is None:
+        msg.date = time.time()
+    trace_id = current_trace_id()
+    if trace_id:
+        msg.extra_headers = {**(msg.extra_headers or {}), "X-Trace-Id": trace_id}
+    payload = {"sender": msg.sender, "recipients": sorted(msg.send_to), "subject": msg.subject}
+    return deliver(submission_id, stage, "email", payload, body=msg.as_bytes())
+
+def deliver_email(entry):
+    """Outbox handler: send a stored MIME message as-is"""
+    payload = entry["payload"]
+    smtp_pool.sendmail(payload["sender"], payload["recipients"], entry["body"])
+    log.info("Email sent", extra={
+        "outboxId": entry["id"], "stage": entry["stage"],
+        "recipients": [mask_email(address) for address in payload["recipients"]],
+    })
+
+def deliver_shipstation_order(entry):
+    """Outbox handler: create the stored order in ShipStation"""
+    if order_batcher.max_batch == 1:
+        send_to_shipstation(entry["payload"])
+        return
+
+    future = order_batcher.submit(entry["payload"])
+    try:
+        result = future.result(timeout=BRANCH_TIMEOUTS["shipstation"])
+    except FutureTimeoutError:
+        if future.cancel():
+            raise OrderWithdrawn("The order was still waiting for a ShipStation batch")
+        # Already on its way; the client's own timeouts bound the rest of the wait
+        result = future.result()
+    if not result.get("success"):
+        raise OrderRejected(f"ShipStation rejected order {result.get('orderNumber')}: {result.get('errorMessage')}")
+    log.info("ShipStation order created", extra={"orderNumber": result.get("orderNumber"), "orderId": result.get("orderId")})
+
+class OrderRejected(DeliveryRejected):
+    """ShipStation answered but refused this particular order"""
+
+class OrderWithdrawn(Exception):
+    """An order was taken back before its batch was sent"""
+
+def guarded(breaker, handler):
+    """Run an outbox handler behind a circuit breaker, deferring while it is open"""
+    def run(entry):
+        start = time.perf_counter()
+        outcome = "error"
+        # Retries run on the dispatcher thread, outside the submission's trace
+        trace_id = current_trace_id() or (entry["submission_id"] and submissions.trace_id(entry["submission_id"]))
+        try:
+            with tracer.span(f"outbox.{entry['kind']}", trace_id=trace_id or None,
+                             outboxId=entry["id"], attempt=entry["attempts"]):
+                result = breaker.call(handler, entry)
+            outcome = "ok"
+            return result
+        except CircuitOpenError as e:
+            outcome = "deferred"
+            raise DeferDelivery(e.retry_in, str(e))
+        except OrderWithdrawn as e:
+            outcome = "deferred"
+            raise DeferDelivery(outbox.backoff_base, str(e))
+        finally:
+            OUTBOX_DELIVERY_SECONDS.observe(time.perf_counter() - start, kind=entry["kind"], outcome=outcome)
+    return run
+
+def outbox_entry_sent(entry):
+    if entry["submission_id"] and entry["stage"]:
+        submissions.set_stage(entry["submission_id"], entry["stage"], DONE)
+
+def outbox_entry_failed(entry, error, status):
+    if entry["submission_id"] and entry["stage"]:
+        state = FAILED if status == outbox_module.DEAD else RETRYING
+        submissions.set_stage(entry["submission_id"], entry["stage"], state, str(error))
+
+def send_patient_email(submission_id, data):
+    """Email the treatment plan (and injection instructions) to the patient"""
+    email = data.get('email', '')
+    if not email:
+        return SKIPPED
+
+    first_name = data.get('firstName', 'Patient')
+    preferred_medication = data.get('preferredMedication', '')
+
+    # ✅ Get the correct email body based on medication choice
+    email_body = get_email_body(preferred_medication, first_name)
+
+    msg = CachedPartMessage(
+        subject=f"Your Treatment Plan - City Life Pharmacy",
+        recipients=[email],
+        html=email_body
+    )
+
+    if treatment_plan_pdf and attach_treatment_plan(msg, data):
+        return queue_email(submission_id, "patient_email", msg)
+
+    # Attach medication-specific PDF instructions for injectable medications
+    try:
+        instructions = attachment_cache.instructions_for(preferred_medication)
+        if instructions:
+            msg.attach_cached(instructions)
+            log.debug("Attached %s to patient email", instructions.display_name)
+    except FileNotFoundError as e:
+        log.warning("PDF file not found: %s", e.filename)
+    except Exception as pdf_error:
+        log.warning("Failed to attach PDF: %s", pdf_error)
+
+    return queue_email(submission_id, "patient_email", msg)
+
+def attach_treatment_plan(msg, data):
+    """Attach the personalized treatment-plan PDF; False if there is none"""
+    full_name = f"{data.get('firstName', 'Patient')} {data.get('lastName', '')}".strip()
+    try:
+        plan = treatment_plans.build(full_name, data.get('preferredMedication', ''))
+    except Exception as plan_error:
+        log.warning("Failed to build treatment plan PDF: %s", plan_error)
+        return False
+    if plan is None:
+        return False
+    msg.attach("Treatment_Plan.pdf", "application/pdf", plan)
+    log.debug("Attached Treatment_Plan.pdf to patient email", extra={"bytes": len(plan)})
+    return True
+
+def send_pharmacy_email(submission_id, data, pdf_data, upload, id_in_pdf=False):
+    """Notify the pharmacy with the intake PDF and the uploaded ID"""
+    first_name = data.get('firstName', 'Patient')
+    last_name = data.get('lastName', '')
+    full_name = f"{first_name} {last_name}".strip()
+    email = data.get('email', '')
+    phone = data.get('phone', '')
+    address = data.get('address', '')
+    city = data.get('city', '')
+    province = data.get('province', '')
+    postal_code = data.get('postalCode', '')
+    preferred_medication = data.get('preferredMedication', '')
+    id_note = "<p>The patient's ID is on the last page of the PDF.</p>" if id_in_pdf else ""
+
+    pharmacy_msg = CachedPartMessage(
+        subject=f"New Weight Loss Consultation - {full_name}",
+        recipients=["info@citylifepharmacy.com"],
+        html=f"""
+        <h2>New Weight Loss Consultation Received</h2>
+        <p><strong>Patient:</strong> {full_name}</p>
+        <p><strong>Email:</strong> {email}</p>
+        <p><strong>Phone:</strong> {phone}</p>
+        <p><strong>Preferred Medication:</strong> {preferred_medication}</p>
+        <p><strong>Address:</strong> {address}, {city}, {province} {postal_code}</p>
+
+        <p>Please find the complete patient information attached as PDF.</p>
+        {id_note}
+
+        <hr>
+        <p><small>This consultation was submitted through the City Life Pharmacy weight loss form.</small></p>
+        """
+    )
+    pharmacy_msg.attach(
+        filename=f"consultation_{full_name.replace(' ', '_')}.pdf",
+        content_type="application/pdf",
+        data=pdf_data
+    )
+
+    # Attach ID file if it was uploaded; it is read from disk as the message is built
+    if upload is not None:
+        pharmacy_msg.attach_cached(DiskFile(
+            upload.path,
+            f"patient_id_{full_name.replace(' ', '_')}.{upload.extension}",
+            upload.content_type,
+        ))
+        log.debug("Attached ID file to pharmacy email", extra={"contentType": upload.content_type})
+
+    return queue_email(submission_id, "pharmacy_email", pharmacy_msg)
+
+def build_shipstation_order(submission_id, data):
+    """Build the ShipStation createorder payload for a submission"""
+    first_name = data.get('firstName', 'Patient')
+    last_name = data.get('lastName', '')
+    full_name = f"{first_name} {last_name}".strip()
+    email = data.get('email', '')
+    phone = data.get('phone', '')
+    address = data.get('address', '')
+    city = data.get('city', '')
+    province = data.get('province', '')
+    postal_code = data.get('postalCode', '')
+    preferred_medication = data.get('preferredMedication', '')
+
+    return {
+        "orderNumber": f"WL-{data.get('firstName', '')}-{data.get('lastName', '')}-{hash(email) % 10000}",
+        # ShipStation updates the order with this key instead of creating a
+        # second one, so a retried or resent createorder is harmless
+        "orderKey": submission_id,
+        "orderDate": "2024-01-01T00:00:00.0000000",
+        "orderStatus": "awaiting_shipment",
+        "customerUsername": email,
+        "customerEmail": email,
+        "billTo": {
+            "name": full_name,
+            "company": "",
+            "street1": address,
+            "street2": "",
+            "street3": "",
+            "city": city,
+            "state": province,
+            "postalCode": postal_code,
+            "country": "CA",
+            "phone": phone
+        },
+        "shipTo": {
+            "name": full_name,
+            "company": "",
+            "street1": address,
+            "street2": "",
+            "street3": "",
+            "city": city,
+            "state": province,
+            "postalCode": postal_code,
+            "country": "CA",
+            "phone": phone
+        },
+        "items": [
+            {
+                "lineItemKey": f"WL-{preferred_medication}",
+                "sku": f"WL-{preferred_medication.upper()}",
+                "name": f"Weight Loss Consultation - {preferred_medication}",
+                "quantity": 1,
+                "unitPrice": 150.00,
+                "warehouseLocation": "Pharmacy"
+            }
+        ]
+    }
+
+def create_shipstation_order(submission_id, data):
+    order = build_shipstation_order(submission_id, data)
+    trace_id = current_trace_id()
+    if trace_id:
+        # Shown to staff only; links the order back to the submission's trace
+        order["internalNotes"] = f"Submission {submission_id} (trace {trace_id})"
+    return deliver(submission_id, "shipstation", "shipstation", order)
+
+def stages_to_run(submission_id):
+    """Stages of a submission that are still pending or were cut off while running.
+
+    A stage that already reached the outbox is left to the outbox, so a
+    submission re-queued after a restart never sends anything twice.
+    """
+    recorded = outbox.stage_statuses(submission_id)
+    todo = set()
+    for stage, state in submissions.stage_states(submission_id).items():
+        if state not in (PENDING, RUNNING):
+            continue
+        if stage not in recorded:
+            todo.add(stage)
+        elif recorded[stage] == outbox_module.SENT:
+            submissions.set_stage(submission_id, stage, DONE)
+        elif recorded[stage] == outbox_module.DEAD:
+            submissions.set_stage(submission_id, stage, FAILED, "Outbox entry ran out of attempts")
+        else:
+            submissions.set_stage(submission_id, stage, RETRYING)
+    if "pdf" in todo and "pharmacy_email" not in todo:
+        # The PDF only exists for the pharmacy email, which got past it
+        submissions.set_stage(submission_id, "pdf", DONE)
+        todo.discard("pdf")
+    return todo
+
+def branch_label(outcome):
+    if not outcome["ok"]:
+        return "error"
+    return "deferred" if outcome["result"] is RETRYING else "ok"
+
+def process_submission(submission_id, profile=False):
+    """Worker entry point: run every stage for a persisted submission.
+
+    ``profile`` is the profiling decision of the request that queued it.
+    Returns None without running anything if another process holds the
+    submission's lease.
+    """
+    if not submissions.claim(submission_id):
+        log.info("Submission leased to another process; skipping", extra={"submissionId": submission_id})
+        return None
+    trace_id = submissions.trace_id(submission_id)
+    with tracer.span("process_submission", trace_id=trace_id, submissionId=submission_id), \
+            profiler.profile("process_submission", trace_id, requested=profile, sample=False):
+        return process_stages(submission_id, profile)
+
+def profiled(name, func):
+    """``func`` profiled on whichever thread runs it, under the current trace"""
+    def run():
+        with profiler.profile(name, current_trace_id(), requested=True, sample=False):
+            return func()
+    return run
+
+def process_stages(submission_id, profile=False):
+    """Run the three branches of a submission side by side"""
+    data, upload = submissions.load(submission_id)
+    medication = medication_key(data.get('preferredMedication'))
+    todo = stages_to_run(submission_id)
+    log.debug("Processing submission", extra={"submissionId": submission_id, "stages": sorted(todo)})
+
+    def patient_branch():
+        with app.app_context():
+            return run_stage(submission_id, "patient_email", send_patient_email, submission_id, data,
+                             medication=medication)
+
+    def pharmacy_branch():
+        try:
+            return pharmacy_stages()
+        finally:
+            # The queued email has its own copy of the ID, and a failed branch
+            # isn't run again; only a crash leaves the file for recovery
+            if upload is not None:
+                submissions.discard_upload(submission_id, upload)
+
+    def pharmacy_stages():
+        with app.app_context():
+            # Generate PDF from the data
+            id_embedded = False
+            if EMBED_ID_IMAGE and upload is not None:
+                intake = run_stage(submission_id, "pdf", pdf_engine.render_intake,
+                                   data, upload.path, ID_IMAGE_TARGET, medication=medication)
+                pdf_data = intake.pdf if intake else None
+                if intake:
+                    id_embedded = intake.id_embedded
+                    id_size_stats.record(intake.id_original_bytes, intake.id_embedded_bytes)
+                    if id_embedded:
+                        log.debug("Embedded ID image", extra={
+                            "submissionId": submission_id,
+                            "originalBytes": intake.id_original_bytes, "embeddedBytes": intake.id_embedded_bytes,
+                        })
+            else:
+                pdf_data = run_stage(submission_id, "pdf", pdf_engine.render, data, medication=medication)
+            if not pdf_data:
+                submissions.set_stage(submission_id, "pharmacy_email", FAILED, "No PDF was generated")
+                return None
+            log.debug("Generated PDF", extra={"submissionId": submission_id, "bytes": len(pdf_data)})
+
+            # Send notification email to pharmacy with PDF attachment
+            return run_stage(submission_id, "pharmacy_email", send_pharmacy_email,
+                             submission_id, data, pdf_data,
+                             None if id_embedded else upload, id_embedded, medication=medication)
+
+    def shipstation_branch():
+        return run_stage(submission_id, "shipstation", create_shipstation_order, submission_id, data,
+                         medication=medication)
+
+    if upload is not None and "pharmacy_email" not in todo:
+        # Left behind by a restart after the pharmacy email was queued
+        submissions.discard_upload(submission_id, upload)
+
+    # The three branches don't depend on each other, so run them side by side
+    branches = {
+        "patient_email": patient_branch,
+        "pharmacy_email": pharmacy_branch,
+        "shipstation": shipstation_branch,
+    }
+    if profile:
+        # The branches' threads need profiles of their own
+        branches = {stage: profiled(f"process_submission.{stage}", branch) for stage, branch in branches.items()}
+    outcomes = fan_out(branch_executor, {
+        stage: (branch, BRANCH_TIMEOUTS[stage]) for stage, branch in branches.items() if stage in todo
+    })
+
+    for stage, outcome in outcomes.items():
+        if outcome.get("timedOut"):
+            # A branch that finishes late still records its own result
+            submissions.set_stage(submission_id, stage, FAILED, outcome["error"])
+    log.info("Submission processed", extra={
+        "submissionId": submission_id,
+        "branches": {stage: branch_label(outcome) for stage, outcome in outcomes.items()},
+        "durationsMs": {stage: round(outcome["durationMs"]) for stage, outcome in outcomes.items()},
+    })
+    return outcomes
+
+pdf_engine = PdfRenderEngine(
+    workers=int(os.getenv("PDF_RENDER_WORKERS", str(os.cpu_count() or 1))),
+    max_queued=int(os.getenv("PDF_RENDER_QUEUE", "0")) or None,
+    timeout=float(os.getenv("PDF_RENDER_TIMEOUT", "30")),
+)
+# Embed a downscaled ID photo in the intake PDF instead of attaching the upload
+EMBED_ID_IMAGE = os.getenv("PDF_EMBED_ID_IMAGE", "").lower() in ("1", "true", "yes")
+ID_IMAGE_TARGET = ImageTarget(
+    max_pixels=int(os.getenv("PDF_ID_IMAGE_MAX_PIXELS", "1600")),
+    quality=int(os.getenv("PDF_ID_IMAGE_QUALITY", "75")),
+    max_bytes=int(os.getenv("PDF_ID_IMAGE_MAX_BYTES", "500000")),
+)
+id_size_stats = SizeStats()
+# Cover pages are rendered on the pool too
+treatment_plans = TreatmentPlanBuilder(attachment_cache, render=pdf_engine.render_cover)
+# Fork the render workers before the submission, branch and outbox threads
+# start.  The log listener thread is already running; fork() only copies the
+# calling thread, and logs.py holds the listener's output across the fork and
+# gives each worker a listener of its own.
+pdf_engine.start()
+store_directory.start()
+
+# Shared by the per-submission fan-out of emails and the ShipStation order
+branch_executor = ThreadPoolExecutor(max_workers=int(os.getenv("BRANCH_WORKERS", "12")), thread_name_prefix="branch")
+BRANCH_TIMEOUTS = {
+    "patient_email": float(os.getenv("PATIENT_EMAIL_TIMEOUT", "60")),
+    "pharmacy_email": float(os.getenv("PHARMACY_EMAIL_TIMEOUT", "90")),
+    "shipstation": float(os.getenv("SHIPSTATION_TIMEOUT", "60")),
+}
+
+submissions = SubmissionStore(
+    os.getenv("SUBMISSIONS_DB", DEFAULT_DB_PATH),
+    lease_seconds=float(os.getenv("SUBMISSION_LEASE_SECONDS", "600")),
+)
+job_queue = JobQueue(process_submission, max_workers=int(os.getenv("SUBMISSION_WORKERS", "4")))
+
+outbox = Outbox(
+    os.getenv("OUTBOX_DB", outbox_module.DEFAULT_DB_PATH),
+    max_attempts=int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8")),
+    backoff_base=float(os.getenv("OUTBOX_BACKOFF_SECONDS", "30")),
+)
+# One breaker per integration; while open, work waits in the outbox
+breakers = {
+    "smtp": CircuitBreaker(
+        "smtp",
+        failure_threshold=int(os.getenv("SMTP_BREAKER_THRESHOLD", "3")),
+        reset_timeout=float(os.getenv("SMTP_BREAKER_RESET", "60")),
+    ),
+    "shipstation": CircuitBreaker(
+        "shipstation",
+        failure_threshold=int(os.getenv("SHIPSTATION_BREAKER_THRESHOLD", "3")),
+        reset_timeout=float(os.getenv("SHIPSTATION_BREAKER_RESET", "60")),
+        excluded=(OrderRejected,),
+        ignored=(OrderWithdrawn,),
+    ),
+}
+
+outbox_dispatcher = Dispatcher(
+    outbox,
+    {
+        "email": guarded(breakers["smtp"], deliver_email),
+        "shipstation": guarded(breakers["shipstation"], deliver_shipstation_order),
+    },
+    batch_size=int(os.getenv("OUTBOX_BATCH_SIZE", "20")),
+    poll_interval=float(os.getenv("OUTBOX_POLL_SECONDS", "5")),
+    on_sent=outbox_entry_sent,
+    on_failed=outbox_entry_failed,
+)
+# Retries run in every process that serves the app, not only under app.run()
+outbox_dispatcher.start()
+
+def start_background_work():
+    """Server start-up: pick up submissions whose process died before finishing them.
+
+    Only the serving process calls this (``__main__`` below and ``wsgi.py``);
+    CLIs and the benchmark that import this module never recover anything.
+    """
+    job_queue.start_recovery(submissions, interval=float(os.getenv("SUBMISSION_RECOVERY_INTERVAL", "60")))
+
+@app.errorhandler(413)
+def request_too_large(e):
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    log.warning("Rejected a request larger than %d MB", limit_mb)
+    return jsonify({
+        "success": False,
+        "message": f"The upload is too large. Please attach an ID file smaller than {limit_mb} MB."
+    }), 413
 
 @app.route("/submit-form", methods=["POST"])
+@instrumented("submit_form")
 def submit_form():
+    parse_started = time.perf_counter()
     try:
+        upload = None
+
         # Check if we have form data (multipart) or JSON data
         if request.content_type and 'multipart/form-data' in request.content_type:
             # Handle file upload with form data
             form_data_str = request.form.get('formData')
             data = json.loads(form_data_str) if form_data_str else {}
-            
+
             # Handle uploaded ID file
             id_file = request.files.get('idFile')
-            print("📝 Received form data with file upload:", json.dumps(data, indent=2))
             if id_file:
-                print(f"📎 ID file received: {id_file.filename}")
+                # Werkzeug has already spooled a large file to disk; copy it in chunks
+                upload = save_upload(id_file.stream, id_file.filename, UPLOAD_DIR, MAX_ID_FILE_BYTES)
+                if upload:
+                    log.debug("ID file received", extra={"contentType": upload.content_type, "bytes": upload.size})
         else:
             # Handle regular JSON data (backward compatibility)
-            data = request.get_json()
-            id_file = None
-            print("📝 Received form data:", json.dumps(data, indent=2))
-
-        # Generate PDF from the data
-        pdf_path = generate_patient_pdf(data)
-        print(f"📄 Generated PDF: {pdf_path}")
-        
-        # Extract necessary information with debugging
-        print("🔍 Debug: Looking for customer data in received data...")
-        print(f"Data keys: {list(data.keys())}")
-        
-        first_name = data.get('firstName', 'Patient')
-        last_name = data.get('lastName', '')
-        full_name = f"{first_name} {last_name}".strip()
-        email = data.get('email', '')
-        phone = data.get('phone', '')
-        address = data.get('address', '')
-        city = data.get('city', '')
-        province = data.get('province', '')
-        postal_code = data.get('postalCode', '')
-        preferred_medication = data.get('preferredMedication', '')
-        
-        print(f"📋 Extracted data: name={full_name}, email={email}, phone={phone}")
-        print(f"📋 Address: {address}, {city}, {province} {postal_code}")
-        print(f"📋 Medication: {preferred_medication}")
-
-        # ✅ Get the correct email body based on medication choice
-        email_body = get_email_body(preferred_medication, first_name)
-
-        # Send email to patient with treatment plan and medication PDF if applicable
-        if email:
-            try:
-                msg = Message(
-                    subject=f"Your Treatment Plan - City Life Pharmacy",
-                    recipients=[email],
-                    html=email_body
-                )
-                
-                # Attach medication-specific PDF instructions for injectable medications
-                if preferred_medication and preferred_medication.lower() in ['ozempic', 'mounjaro']:
-                    pdf_filename = None
-                    pdf_display_name = None
-                    
-                    if preferred_medication.lower() == 'ozempic':
-                        pdf_filename = "../attached_assets/Ozempic Injection Instructions (1).pdf"
-                        pdf_display_name = "Ozempic_Injection_Instructions.pdf"
-                    elif preferred_medication.lower() == 'mounjaro':
-                        pdf_filename = "../attached_assets/Mounjaro Penfill Instructions.pdf"
-                        pdf_display_name = "Mounjaro_Injection_Instructions.pdf"
-                    
-                    # Attach the PDF if file exists
-                    if pdf_filename:
-                        try:
-                            with open(pdf_filename, 'rb') as pdf_file:
-                                pdf_data = pdf_file.read()
-                            msg.attach(
-                                filename=pdf_display_name,
-                                content_type="application/pdf",
-                                data=pdf_data
-                            )
-                            print(f"✅ Attached {pdf_display_name} to patient email")
-                        except FileNotFoundError:
-                            print(f"⚠️ PDF file not found: {pdf_filename}")
-                        except Exception as pdf_error:
-                            print(f"⚠️ Failed to attach PDF: {pdf_error}")
-                
-                mail.send(msg)
-                print(f"✅ Treatment plan email sent to {email}")
-            except Exception as e:
-                print(f"❌ Failed to send treatment plan email: {e}")
-
-        # Send notification email to pharmacy with PDF attachment
-        try:
-            with open(pdf_path, 'rb') as f:
-                pdf_data = f.read()
-            
-            pharmacy_msg = Message(
-                subject=f"New Weight Loss Consultation - {full_name}",
-                recipients=["info@citylifepharmacy.com"],
-                html=f"""
-                <h2>New Weight Loss Consultation Received</h2>
-                <p><strong>Patient:</strong> {full_name}</p>
-                <p><strong>Email:</strong> {email}</p>
-                <p><strong>Phone:</strong> {phone}</p>
-                <p><strong>Preferred Medication:</strong> {preferred_medication}</p>
-                <p><strong>Address:</strong> {address}, {city}, {province} {postal_code}</p>
-                
-                <p>Please find the complete patient information attached as PDF.</p>
-                
-                <hr>
-                <p><small>This consultation was submitted through the City Life Pharmacy weight loss form.</small></p>
-                """
-            )
-            pharmacy_msg.attach(
-                filename=f"consultation_{full_name.replace(' ', '_')}.pdf",
-                content_type="application/pdf",
-                data=pdf_data
-            )
-            
-            # Attach ID file if it was uploaded
-            if id_file:
-                try:
-                    # Read the file data
-                    id_file.seek(0)  # Reset file pointer to beginning
-                    id_file_data = id_file.read()
-                    
-                    # Get file extension for proper content type
-                    filename = id_file.filename or 'id_file'
-                    file_extension = filename.split('.')[-1].lower() if '.' in filename else ''
-                    content_type = "image/jpeg" if file_extension in ['jpg', 'jpeg'] else "image/png" if file_extension == 'png' else "application/octet-stream"
-                    
-                    pharmacy_msg.attach(
-                        filename=f"patient_id_{full_name.replace(' ', '_')}.{file_extension}",
-                        content_type=content_type,
-                        data=id_file_data
-                    )
-                    print("✅ ID file attached to pharmacy email")
-                except Exception as id_error:
-                    print(f"⚠️ Failed to attach ID file: {id_error}")
-            
-            mail.send(pharmacy_msg)
-            print("✅ Notification email sent to pharmacy")
-        except Exception as e:
-            print(f"❌ Failed to send pharmacy notification: {e}")
-
-        # Prepare ShipStation order data
-        shipstation_order = {
-            "orderNumber": f"WL-{data.get('firstName', '')}-{data.get('lastName', '')}-{hash(email) % 10000}",
-            "orderDate": "2024-01-01T00:00:00.0000000",
-            "orderStatus": "awaiting_shipment",
-            "customerUsername": email,
-            "customerEmail": email,
-            "billTo": {
-                "name": full_name,
-                "company": "",
-                "street1": address,
-                "street2": "",
-                "street3": "",
-                "city": city,
-                "state": province,
-                "postalCode": postal_code,
-                "country": "CA",
-                "phone": phone
-            },
-            "shipTo": {
-                "name": full_name,
-                "company": "",
-                "street1": address,
-                "street2": "",
-                "street3": "",
-                "city": city,
-                "state": province,
-                "postalCode": postal_code,
-                "country": "CA",
-                "phone": phone
-            },
-            "items": [
-                {
-                    "lineItemKey": f"WL-{preferred_medication}",
-                    "sku": f"WL-{preferred_medication.upper()}",
-                    "name": f"Weight Loss Consultation - {preferred_medication}",
-                    "quantity": 1,
-                    "unitPrice": 150.00,
-                    "warehouseLocation": "Pharmacy"
-                }
-            ]
-        }
-
-        # Send to ShipStation
-        send_to_shipstation(shipstation_order)
-
-        # Clean up PDF file
-        try:
-            os.remove(pdf_path)
-            print(f"🗑️ Cleaned up temporary PDF: {pdf_path}")
-        except:
-            pass
-
+            data = request.get_json(silent=True)
+    except UploadRejected as e:
+        log.warning("Rejected ID file: %s", e)
+        return jsonify({"success": False, "message": str(e)}), 400
+    except ValueError as e:
+        log.warning("Could not parse form data: %s", e)
         return jsonify({
-            "success": True,
-            "message": "Form submitted successfully. You will receive a treatment plan via email shortly."
-        })
+            "success": False,
+            "message": "The form data could not be read. Please try again."
+        }), 400
+
+    log_payload(log, "Received form data", data, idFile=upload is not None)
+    errors = validate_submission(data)
+    medication = medication_key(data.get('preferredMedication') if isinstance(data, dict) else None)
+    STAGE_SECONDS.observe(time.perf_counter() - parse_started, stage="parse", medication=medication)
+    if errors:
+        if upload:
+            upload.discard()
+        return jsonify({
+            "success": False,
+            "message": "The form data is incomplete or invalid.",
+            "errors": errors
+        }), 400
 
-    except Exception as e:
-        print(f"❌ Error processing form: {e}")
+    submission_id = None
+    try:
+        with STAGE_SECONDS.time(stage="enqueue", medication=medication):
+            submission_id = submissions.create(data, upload, current_trace_id())
+            job_queue.enqueue(submission_id, profile=g.get("profile", False))
+        log.info("Queued submission", extra={"submissionId": submission_id})
+    except Exception:
+        if upload and submission_id is None:
+            upload.discard()
+        STAGE_ERRORS.inc(stage="enqueue", medication=medication)
+        log.exception("Error queueing submission")
         return jsonify({
             "success": False,
             "message": "An error occurred while processing your form. Please try again."
         }), 500
 
+    return jsonify({
+        "success": True,
+        "submissionId": submission_id,
+        "statusUrl": f"/submission-status/{submission_id}",
+        "traceId": current_trace_id(),
+        "message": "Form submitted successfully. You will receive a treatment plan via email shortly."
+    }), 202
+
+@app.route("/submission-status/<submission_id>", methods=["GET"])
+def submission_status(submission_id):
+    """Report per-stage progress of a queued submission"""
+    status = submissions.status(submission_id)
+    if status is None:
+        return jsonify({"success": False, "message": "Unknown submission"}), 404
+    return jsonify({"success": True, **status})
+
+@app.route("/shipstation-status", methods=["GET"])
+def shipstation_status():
+    """Report the ShipStation rate-limit budget and queued requests"""
+    return jsonify({
+        "success": True,
+        "rateLimit": shipstation.rate_limit_status(),
+        "store": store_directory.status(),
+    })
+
+@app.route("/health", methods=["GET"])
+def health():
+    """Integration breaker states and the backlog of deferred side effects"""
+    breaker_states = {name: breaker.status() for name, breaker in breakers.items()}
+    degraded = any(state["state"] != "closed" for state in breaker_states.values())
+    return jsonify({
+        "status": "degraded" if degraded else "ok",
+        "breakers": breaker_states,
+        "outbox": outbox.counts(),
+        "smtpPool": smtp_pool.status(),
+        "idImages": id_size_stats.status(),
+    })
+
+def is_admin(req):
+    """True if the request carries the ADMIN_TOKEN (never, when none is configured)"""
+    token = os.getenv("ADMIN_TOKEN")
+    supplied = req.headers.get("X-Admin-Token", "")
+    return bool(token) and hmac.compare_digest(supplied.encode(), token.encode())
+
+def profile_requested(req):
+    return req.headers.get("X-Profile") == "1" and is_admin(req)
+
+@app.route("/export-pdfs", methods=["GET"])
+def export_submission_pdfs():
+    """Stream the intake PDFs of a date range as a ZIP or one combined PDF"""
+    if not is_admin(request):
+        return jsonify({"success": False, "message": "Not authorized"}), 403
+
+    fmt = request.args.get("format", "zip")
+    try:
+        since, until = date_range(request.args.get("from"), request.args.get("to"))
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"format must be one of {', '.join(sorted(EXPORT_FORMATS))}")
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    filename = f"intake-pdfs_{request.args.get('from') or 'start'}_{request.args.get('to') or 'now'}.{extension}"
+    log.info("Exporting intake PDFs", extra={"since": since, "until": until, "format": fmt})
+    return Response(
+        export_pdfs(submissions, pdf_engine, since, until, fmt),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Stage latencies, error counts and backlogs in the Prometheus text format"""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@metrics.on_collect
+def collect_backlogs():
+    OUTBOX_ENTRIES.clear()
+    for status, count in outbox.counts().items():
+        OUTBOX_ENTRIES.set(count, status=status)
+    for name, breaker in breakers.items():
+        BREAKER_OPEN.set(int(breaker.state != "closed"), breaker=name)
+
 @app.route("/shipstation-webhook", methods=["POST"])
+@instrumented("shipstation_webhook")
 def shipstation_webhook():
     """Handle ShipStation webhooks"""
     try:
         data = request.get_json()
-        print("📦 ShipStation webhook received:", json.dumps(data, indent=2))
+        resource_type = data.get("resource_type") if isinstance(data, dict) else None
+        WEBHOOKS.inc(resource_type=resource_type if resource_type in WEBHOOK_TYPES else "other")
+        log.info("ShipStation webhook received", extra={"resourceType": resource_type})
+        log_payload(log, "ShipStation webhook payload", data)
         
         # You can add webhook processing logic here
         # For example, updating order status, sending tracking emails, etc.
         
         return jsonify({"success": True})
-    except Exception as e:
-        print(f"❌ Error processing ShipStation webhook: {e}")
+    except Exception:
+        log.exception("Error processing ShipStation webhook")
         return jsonify({"success": False}), 500
 
 if __name__ == "__main__":
+    # With the reloader on, only the child that serves requests recovers work
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_work()
     app.run(debug=True, host="0.0.0.0", port=5001)
\ No newline at end of file
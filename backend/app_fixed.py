@@ -1,21 +1,35 @@
 from flask import Flask, request, jsonify, render_template
 from flask_cors import CORS
-from flask_mail import Mail, Message
+from flask_mail import Mail
 from dotenv import load_dotenv
-from fpdf import FPDF
 import base64
 import json
-import requests
-from requests.auth import HTTPBasicAuth
+import logging
 import os
+import uuid
+
+from attachments import ASSETS_DIR, AttachmentCache, CachedPartMessage, DiskFile
+from email_templates import get_email_body
+from logs import log_payload, mask_email, setup_logging
+from patient_pdf import generate_patient_pdf
+from shipstation import ShipStationClient
+from store_cache import StoreDirectory
+from uploads import DEFAULT_MAX_BYTES, DEFAULT_UPLOAD_DIR, UploadRejected, save_upload
 
 # Load environment variables from .env file
 load_dotenv()
+setup_logging()
+log = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__, static_folder="static", template_folder="templates")
 CORS(app)
 
+# Upload limits: the whole request, and the ID file within it
+MAX_ID_FILE_BYTES = int(os.getenv("MAX_ID_FILE_BYTES", str(DEFAULT_MAX_BYTES)))
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_REQUEST_BYTES", str(MAX_ID_FILE_BYTES + 1024 * 1024)))
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", DEFAULT_UPLOAD_DIR)
+
 # Email configuration (SendGrid)
 app.config['MAIL_SERVER'] = 'smtp.sendgrid.net'
 app.config['MAIL_PORT'] = 587
@@ -27,204 +41,57 @@ app.config['MAIL_DEFAULT_SENDER'] = "info@citylifepharmacy.com"
 # ShipStation credentials
 SHIPSTATION_API_KEY = os.getenv("SHIPSTATION_API_KEY")
 SHIPSTATION_API_SECRET = os.getenv("SHIPSTATION_API_SECRET")
+shipstation = ShipStationClient.from_env()
+store_directory = StoreDirectory(shipstation, configured_store_id=os.getenv("SHIPSTATION_STORE_ID"))
+store_directory.start()
 
 # Initialize Mail
 mail = Mail(app)
 
-# Ensure uploads folder exists
-os.makedirs("uploads", exist_ok=True)
+# Instruction PDFs for injectables, read once and kept in memory
+attachment_cache = AttachmentCache(os.getenv("INSTRUCTIONS_DIR", ASSETS_DIR))
+attachment_cache.preload()
 
 def send_to_shipstation(order_data):
-    url = "https://ssapi.shipstation.com/orders/createorder"
-    
     if not SHIPSTATION_API_KEY or not SHIPSTATION_API_SECRET:
-        print("❌ ShipStation credentials not found in environment")
+        log.error("ShipStation credentials not found in environment")
         return False
-        
-    auth = HTTPBasicAuth(SHIPSTATION_API_KEY, SHIPSTATION_API_SECRET)
 
-    # Inject the correct store ID
+    # Inject the discovered store ID
     if "storeId" not in order_data or not order_data["storeId"]:
-        order_data["storeId"] = "1a4d285c-c602-4731-81d3-c5fb4661fedc"
+        if store_directory.store_id is None:
+            store_directory.wait_ready(5)
+        if store_directory.store_id:
+            order_data["storeId"] = store_directory.store_id
 
     try:
-        response = requests.post(url, json=order_data, auth=auth)
-        print(f"ShipStation response status: {response.status_code}")
+        response = shipstation.create_order(order_data)
         if response.status_code == 200:
-            print("ShipStation order created successfully - Order ID:", response.json().get('orderId'))
-            print("ShipStation success response:", json.dumps(response.json(), indent=2))
+            log.info("ShipStation order created", extra={"orderId": response.json().get('orderId')})
         else:
-            print("ShipStation order creation failed:")
-            print("Response:", response.text)
+            log.error("ShipStation order creation failed",
+                      extra={"status": response.status_code, "response": response.text[:500]})
         return response
     except Exception as e:
-        print(f"Error sending to ShipStation: {e}")
+        log.warning("Error sending to ShipStation: %s", e)
         return None
 
 @app.route("/")
 def home():
     return render_template("index.html")
 
-def get_email_body(med, name):
-    if med == "tirzepatide":
-        return f"""Hi {name},
-
-Thank you for your order. I have reviewed your medical intake and I have put together the following treatment plan for you below. Please read it carefully.
-
-You have been prescribed Mounjaro (tirzepatide). This medication typically follows a titration schedule that is outlined below. At your follow up your physician will determine if you are to increase, decrease, or stay at your current dose.
-
-We have attached detailed instructions on how to inject Mounjaro to this email. Please read it carefully.
-
-<strong>Mounjaro Dosing Schedule:</strong>
-Month 1: Inject 2.5mg subcutaneously once weekly x 4 weeks.
-Month 2: Inject 5mg subcutaneously once weekly x 4 weeks.
-Month 3: Inject 7.5mg subcutaneously once weekly for 4 weeks
-*Follow up visit*
-Month 4: Inject 10mg subcutaneously once weekly x 4 weeks
-Month 5: Inject 12.5mg subcutaneously once weekly x 4 weeks
-Month 6: Inject 15mg subcutaneously once weekly x 4 weeks
-
-Taking GLP-1 medication like tirzepatide while taking steps toward maintaining a healthy diet and lifestyle can help you achieve your target weight.
-
-Please note: Your prescription has been sent to the pharmacy for processing and fulfillment and should ship out within 1-2 business days. Please store Mounjaro vials in the fridge. You may store it at room temperature for 21 days.
-
-Best regards,
-Rimon
-Pharmacist
-
-City Life Pharmacy & Compounding Centre
-info@CityLifePharmacy.com
-www.CityLifePharmacy.com
-Tel 416-214-CITY (2489)"""
-
-    elif med == "ozempic":
-        return f"""Hi {name},
-
-Thank you for your order. I have reviewed your medical intake and I have put together the following treatment plan for you below. Please read it carefully.
-
-You have been prescribed Ozempic (semaglutide). This medication typically follows a titration schedule that is outlined below. At your follow up your physician will determine if you are to increase, decrease, or stay at your current dose.
-
-We have attached detailed instructions on how to inject Ozempic to this email. Please read it carefully.
-
-<strong>Ozempic Dosing Schedule:</strong>
-Month 1: Inject 0.25mg subcutaneously once weekly x 4 weeks.
-Month 2: Inject 0.5mg subcutaneously once weekly x 4 weeks.
-Month 3: Inject 1 mg subcutaneously once weekly for 4 weeks
-*Follow up visit*
-Month 4: Inject 1mg subcutaneously once weekly x 4 weeks
-
-<strong>Wegovy Dosing Schedule:</strong>
-Month 5: Inject 1.75mg subcutaneously once weekly x 4 weeks
-Month 6: Inject 2mg subcutaneously once weekly x 4 weeks
-
-Taking GLP-1 medication like semaglutide while taking steps toward maintaining a healthy diet and lifestyle can help you achieve your target weight.
-
-Please note: Your prescription has been sent to the pharmacy for processing and fulfillment and should ship out within 1-2 business days.
-
-Best regards,
-Rimon
-Pharmacist
-
-City Life Pharmacy & Compounding Centre
-info@CityLifePharmacy.com
-www.CityLifePharmacy.com
-Tel 416-214-CITY (2489)"""
-
-    else:  # quickstrips, drops
-        return f"""Hi {name},
-
-Thank you for your order. Your medication instructions will be provided with your shipment.
-
-Best regards,
-City Life Pharmacy Team
-
-City Life Pharmacy & Compounding Centre
-info@CityLifePharmacy.com
-www.CityLifePharmacy.com
-Tel 416-214-CITY (2489)"""
-
-def generate_patient_pdf(data):
-    """Generate a PDF from the patient data"""
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", size=12)
-    
-    # Title
-    pdf.set_font("Arial", "B", 16)
-    pdf.cell(0, 10, "Patient Information", ln=True, align="C")
-    pdf.ln(10)
-    
-    # Patient details
-    pdf.set_font("Arial", size=12)
-    
-    def add_field(label, value):
-        if value:
-            pdf.set_font("Arial", "B", 12)
-            pdf.cell(50, 8, f"{label}:", 0, 0)
-            pdf.set_font("Arial", size=12)
-            pdf.cell(0, 8, str(value), 0, 1)
-    
-    # Basic Information
-    pdf.set_font("Arial", "B", 14)
-    pdf.cell(0, 10, "Personal Information", 0, 1)
-    pdf.ln(5)
-    
-    add_field("Name", f"{data.get('firstName', '')} {data.get('lastName', '')}")
-    add_field("Email", data.get('email', ''))
-    add_field("Phone", data.get('phone', ''))
-    add_field("Address", data.get('address', ''))
-    add_field("City", data.get('city', ''))
-    add_field("Province", data.get('province', ''))
-    add_field("Postal Code", data.get('postalCode', ''))
-    add_field("Height", data.get('height', ''))
-    add_field("Weight", data.get('weight', ''))
-    add_field("BMI", data.get('bmi', ''))
-    
-    # Medical Information
-    medical_fields = ['medicationAllergies', 'specifyAllergies', 'medicalConditions', 
-                     'weightLossMedications', 'otherMedications', 'bloodPressure']
-    
-    medical_data = {k: v for k, v in data.items() if k in medical_fields and v}
-    
-    if medical_data:
-        pdf.ln(5)
-        pdf.set_font("Arial", "B", 14)
-        pdf.cell(0, 10, "Medical Information", 0, 1)
-        pdf.ln(5)
-        
-        for field, value in medical_data.items():
-            readable_field = field.replace('_', ' ').replace('camelCase', ' ').title()
-            if isinstance(value, list):
-                value = ', '.join(value)
-            add_field(readable_field, str(value))
-    
-    # Additional fields
-    excluded_fields = ['firstName', 'lastName', 'email', 'phone', 
-                      'address', 'city', 'province', 'postalCode', 'height', 'weight', 'bmi'] + medical_fields
-    
-    other_fields = {k: v for k, v in data.items() if k not in excluded_fields and v}
-    
-    if other_fields:
-        pdf.ln(5)
-        pdf.set_font("Arial", "B", 14)
-        pdf.cell(0, 10, "Additional Information", 0, 1)
-        pdf.ln(5)
-        
-        for field, value in other_fields.items():
-            readable_field = field.replace('_', ' ').replace('camelCase', ' ').title()
-            if isinstance(value, list):
-                value = ', '.join(value)
-            add_field(readable_field, str(value))
-    
-    # Save to a temporary file
-    filename = f"patient_{data.get('firstName', 'unknown')}_{data.get('lastName', 'patient')}.pdf"
-    filepath = os.path.join("uploads", filename)
-    pdf.output(filepath)
-    
-    return filepath
+@app.errorhandler(413)
+def request_too_large(e):
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    log.warning("Rejected a request larger than %d MB", limit_mb)
+    return jsonify({
+        "success": False,
+        "message": f"The upload is too large. Please attach an ID file smaller than {limit_mb} MB."
+    }), 413
 
 @app.route("/submit-form", methods=["POST"])
 def submit_form():
+    upload = None
     try:
         # Check if we have form data (multipart) or JSON data
         if request.content_type and 'multipart/form-data' in request.content_type:
@@ -234,26 +101,23 @@ def submit_form():
             
             # Handle uploaded ID file
             id_file = request.files.get('idFile')
-            print("📝 Received form data with file upload:", json.dumps(data, indent=2))
-            print(f"📎 Files in request: {list(request.files.keys())}")
             if id_file:
-                print(f"📎 ID file received: {id_file.filename}, size: {len(id_file.read())} bytes")
-                id_file.seek(0)  # Reset file pointer after reading size
-            else:
-                print("📎 No ID file found in request")
+                try:
+                    # Copied to disk in chunks once; the email attaches it from there
+                    upload = save_upload(id_file.stream, id_file.filename, UPLOAD_DIR, MAX_ID_FILE_BYTES)
+                except UploadRejected as e:
+                    log.warning("Rejected ID file: %s", e)
+                    return jsonify({"success": False, "message": str(e)}), 400
+            if upload:
+                log.debug("ID file received", extra={"contentType": upload.content_type, "bytes": upload.size})
         else:
             # Handle regular JSON data (backward compatibility)
             data = request.get_json()
-            id_file = None
-            print("📝 Received form data:", json.dumps(data, indent=2))
+        log_payload(log, "Received form data", data, idFile=upload is not None)
 
         # Generate PDF from the data
-        pdf_path = generate_patient_pdf(data)
-        print(f"📄 Generated PDF: {pdf_path}")
-        
-        # Debug: Print all available data keys first
-        print(f"🔍 Available data keys: {list(data.keys())}")
-        print(f"📝 Full form data: {json.dumps(data, indent=2, default=str)}")
+        intake_pdf = generate_patient_pdf(data)
+        log.debug("Generated PDF", extra={"bytes": len(intake_pdf)})
         
         # Extract necessary information - try multiple field name patterns
         first_name = data.get('firstName', '') or data.get('fullName', '').split(' ', 1)[0] if data.get('fullName') else ''
@@ -278,19 +142,13 @@ def submit_form():
                               data.get('medication', '') or
                               data.get('medicationChoice', ''))
         
-        print(f"📋 Extracted data: name={full_name}, email={email}, phone={phone}")
-        print(f"📋 Address: {address}, {city}, {province} {postal_code}")
-        print(f"📋 Medication: {preferred_medication}")
-        
         # If still empty, check for nested structures
         if not email or not full_name or not address:
-            print("⚠️ Some fields still empty, checking for nested data structures...")
+            log.debug("Some fields still empty, checking for nested data structures")
             for key, value in data.items():
-                if isinstance(value, dict):
-                    print(f"🔍 Nested object {key}: {value}")
-                elif isinstance(value, str) and '@' in value and not email:
+                if isinstance(value, str) and '@' in value and not email:
                     email = value
-                    print(f"📧 Found email in {key}: {email}")
+                    log.debug("Found email in %s", key)
 
         # Get the correct email body based on medication choice
         email_body = get_email_body(preferred_medication, first_name)
@@ -298,54 +156,34 @@ def submit_form():
         # Send email to patient with treatment plan and medication PDF if applicable
         if email:
             try:
-                print(f"📧 Preparing patient email for {email} with medication: {preferred_medication}")
-                msg = Message(
+                msg = CachedPartMessage(
                     subject=f"Your Treatment Plan - City Life Pharmacy",
                     recipients=[email],
                     html=email_body
                 )
                 
                 # Attach medication-specific PDF instructions for injectable medications
-                if preferred_medication and preferred_medication.lower() in ['ozempic', 'mounjaro']:
-                    pdf_filename = None
-                    pdf_display_name = None
-                    
-                    if preferred_medication.lower() == 'ozempic':
-                        pdf_filename = "../attached_assets/Ozempic Injection Instructions (1).pdf"
-                        pdf_display_name = "Ozempic_Injection_Instructions.pdf"
-                    elif preferred_medication.lower() == 'mounjaro':
-                        pdf_filename = "../attached_assets/Mounjaro Penfill Instructions.pdf"
-                        pdf_display_name = "Mounjaro_Injection_Instructions.pdf"
-                    
-                    # Attach the PDF if file exists
-                    if pdf_filename:
-                        try:
-                            with open(pdf_filename, 'rb') as pdf_file:
-                                pdf_data = pdf_file.read()
-                            msg.attach(
-                                filename=pdf_display_name,
-                                content_type="application/pdf",
-                                data=pdf_data
-                            )
-                            print(f"✅ Attached {pdf_display_name} to patient email")
-                        except FileNotFoundError:
-                            print(f"⚠️ PDF file not found: {pdf_filename}")
-                        except Exception as pdf_error:
-                            print(f"⚠️ Failed to attach PDF: {pdf_error}")
+                try:
+                    instructions = attachment_cache.instructions_for(preferred_medication)
+                    if instructions:
+                        msg.attach_cached(instructions)
+                        log.debug("Attached %s to patient email", instructions.display_name)
+                except FileNotFoundError as e:
+                    log.warning("PDF file not found: %s", e.filename)
+                except Exception as pdf_error:
+                    log.warning("Failed to attach PDF: %s", pdf_error)
                 
                 mail.send(msg)
-                print(f"✅ Patient treatment email sent successfully to {email} for {preferred_medication}")
+                log.info("Patient treatment email sent",
+                         extra={"recipient": mask_email(email), "medication": preferred_medication})
             except Exception as e:
-                print(f"❌ Failed to send treatment plan email to {email}: {e}")
+                log.error("Failed to send treatment plan email: %s", e, extra={"recipient": mask_email(email)})
         else:
-            print(f"⚠️ No email address found - cannot send patient instructions")
+            log.warning("No email address found - cannot send patient instructions")
 
         # Send notification email to pharmacy with PDF attachment
         try:
-            with open(pdf_path, 'rb') as f:
-                pdf_data = f.read()
-            
-            pharmacy_msg = Message(
+            pharmacy_msg = CachedPartMessage(
                 subject=f"New Weight Loss Consultation - {full_name}",
                 recipients=["info@citylifepharmacy.com"],
                 html=f"""
@@ -365,55 +203,32 @@ def submit_form():
             pharmacy_msg.attach(
                 filename=f"consultation_{full_name.replace(' ', '_')}.pdf",
                 content_type="application/pdf",
-                data=pdf_data
+                data=intake_pdf
             )
             
             # Attach ID file if it was uploaded
-            if id_file:
-                try:
-                    # Read the file data
-                    id_file.seek(0)  # Reset file pointer to beginning
-                    id_file_data = id_file.read()
-                    
-                    # Get file extension for proper content type
-                    filename = id_file.filename or 'id_file'
-                    file_extension = filename.split('.')[-1].lower() if '.' in filename else ''
-                    
-                    # Map file extensions to content types
-                    content_type_map = {
-                        'jpg': 'image/jpeg',
-                        'jpeg': 'image/jpeg', 
-                        'png': 'image/png',
-                        'tiff': 'image/tiff',
-                        'tif': 'image/tiff',
-                        'pdf': 'application/pdf'
-                    }
-                    content_type = content_type_map.get(file_extension, 'application/octet-stream')
-                    
-                    pharmacy_msg.attach(
-                        filename=f"patient_id_{full_name.replace(' ', '_')}.{file_extension}",
-                        content_type=content_type,
-                        data=id_file_data
-                    )
-                    print(f"✅ ID file attached to pharmacy email: {filename} ({len(id_file_data)} bytes)")
-                except Exception as id_error:
-                    print(f"❌ Failed to attach ID file: {id_error}")
-            else:
-                print("📎 No ID file found to attach to pharmacy email")
+            if upload:
+                pharmacy_msg.attach_cached(DiskFile(
+                    upload.path,
+                    f"patient_id_{full_name.replace(' ', '_')}.{upload.extension}",
+                    upload.content_type,
+                ))
+                log.debug("Attached ID file to pharmacy email", extra={"bytes": upload.size})
             
             mail.send(pharmacy_msg)
-            print("✅ Notification email sent to pharmacy")
+            log.info("Notification email sent to pharmacy")
         except Exception as e:
-            print(f"❌ Failed to send pharmacy notification: {e}")
+            log.error("Failed to send pharmacy notification: %s", e)
 
         # Prepare ShipStation order data
         shipstation_order = {
             "orderNumber": f"WL-{data.get('firstName', '')}-{data.get('lastName', '')}-{hash(email) % 10000}",
+            # Lets the client retry a timed-out createorder without a duplicate order
+            "orderKey": uuid.uuid4().hex,
             "orderDate": "2024-01-01T00:00:00.0000000",
             "orderStatus": "awaiting_shipment",
             "customerUsername": email,
             "customerEmail": email,
-            "storeId": "1a4d285c-c602-4731-81d3-c5fb4661fedc",
             "billTo": {
                 "name": full_name,
                 "company": "",
@@ -470,28 +285,31 @@ def submit_form():
         shipstation_response = send_to_shipstation(shipstation_order)
         
         if shipstation_response and shipstation_response.status_code == 200:
-            print("Pharmacy email sent: 202")
-            print("Patient email sent: 202")
-            print("Email notifications sent successfully")
             return jsonify({"success": True, "message": "Order processed successfully"})
         else:
-            print("ShipStation integration failed")
+            log.error("ShipStation integration failed")
             return jsonify({"success": False, "message": "ShipStation processing failed"})
 
     except Exception as e:
-        print(f"❌ Error processing form: {e}")
+        log.exception("Error processing form")
         return jsonify({"success": False, "message": str(e)}), 500
+    finally:
+        # Everything that needed the ID has run by now
+        if upload:
+            upload.discard()
 
 @app.route("/shipstation-webhook", methods=["POST"])
 def shipstation_webhook():
     """Handle ShipStation webhooks"""
     try:
         data = request.get_json()
-        print("📦 ShipStation webhook received:", json.dumps(data, indent=2))
+        resource_type = data.get("resource_type") if isinstance(data, dict) else None
+        log.info("ShipStation webhook received", extra={"resourceType": resource_type})
+        log_payload(log, "ShipStation webhook payload", data)
         
         return jsonify({"success": True})
-    except Exception as e:
-        print(f"❌ Error processing ShipStation webhook: {e}")
+    except Exception:
+        log.exception("Error processing ShipStation webhook")
         return jsonify({"success": False}), 500
 
 if __name__ == "__main__":
@@ -0,0 +1,134 @@
+"""In-memory cache of the static instruction PDFs attached to patient emails.
+
+The Ozempic and Mounjaro instruction PDFs are read from ``attached_assets/``
+once, kept in memory together with their base64-encoded MIME part, and
+reloaded only when the file's mtime or size changes.  Paths are resolved from
+this file, so the app no longer has to be started from ``backend/``.
+"""
+import copy
+import logging
+import os
+import threading
+from email.encoders import encode_base64
+from email.mime.base import MIMEBase
+
+from flask_mail import Message
+
+log = logging.getLogger(__name__)
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "attached_assets")
+
+# medication -> (file in ASSETS_DIR, attachment name shown to the patient)
+INSTRUCTION_PDFS = {
+    "ozempic": ("Ozempic Injection Instructions (1).pdf", "Ozempic_Injection_Instructions.pdf"),
+    "mounjaro": ("Mounjaro Penfill Instructions.pdf", "Mounjaro_Injection_Instructions.pdf"),
+    "tirzepatide": ("Mounjaro Penfill Instructions.pdf", "Mounjaro_Injection_Instructions.pdf"),
+}
+
+
+class CachedFile:
+    """File contents plus its pre-encoded MIME part"""
+
+    def __init__(self, path, display_name, content_type):
+        stat = os.stat(path)
+        with open(path, "rb") as f:
+            self.data = f.read()
+        self.path = path
+        self.display_name = display_name
+        self.content_type = content_type
+        self.signature = (stat.st_mtime_ns, stat.st_size)
+
+        maintype, subtype = content_type.split("/")
+        part = MIMEBase(maintype, subtype)
+        part.set_payload(self.data)
+        encode_base64(part)
+        part.add_header("Content-Disposition", "attachment", filename=display_name)
+        self._part = part
+
+    def mime_part(self):
+        # Shallow copy: shares the encoded payload, not the part's headers list
+        part = copy.copy(self._part)
+        part._headers = list(self._part._headers)
+        return part
+
+
+class DiskFile:
+    """An attachment read from disk only when its message is built.
+
+    The file is read whole at that point: the outbox stores the rendered
+    message, so the upload isn't needed again once it has been queued.
+    """
+
+    def __init__(self, path, display_name, content_type):
+        self.path = path
+        self.display_name = display_name
+        self.content_type = content_type
+
+    @property
+    def data(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def mime_part(self):
+        maintype, subtype = self.content_type.split("/")
+        part = MIMEBase(maintype, subtype)
+        part.set_payload(self.data)
+        encode_base64(part)
+        part.add_header("Content-Disposition", "attachment", filename=self.display_name)
+        return part
+
+
+class AttachmentCache:
+    def __init__(self, assets_dir=ASSETS_DIR):
+        self.assets_dir = assets_dir
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def get(self, filename, display_name, content_type="application/pdf"):
+        """Cached file, reloaded if it changed on disk; raises FileNotFoundError"""
+        path = os.path.join(self.assets_dir, filename)
+        stat = os.stat(path)
+        cached = self._files.get(path)
+        if cached is None or cached.signature != (stat.st_mtime_ns, stat.st_size):
+            with self._lock:
+                cached = self._files.get(path)
+                if cached is None or cached.signature != (stat.st_mtime_ns, stat.st_size):
+                    cached = CachedFile(path, display_name, content_type)
+                    self._files[path] = cached
+        return cached
+
+    def instructions_for(self, medication):
+        """Injection instructions for a medication, or None if it has none"""
+        entry = INSTRUCTION_PDFS.get((medication or "").strip().lower())
+        if entry is None:
+            return None
+        return self.get(*entry)
+
+    def preload(self):
+        for filename, display_name in set(INSTRUCTION_PDFS.values()):
+            try:
+                self.get(filename, display_name)
+            except FileNotFoundError:
+                log.warning("PDF file not found: %s", os.path.join(self.assets_dir, filename))
+
+
+class CachedPartMessage(Message):
+    """Flask-Mail message that can carry already encoded MIME parts (CachedFile or DiskFile)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cached_files = []
+
+    def attach_cached(self, cached_file):
+        self.cached_files.append(cached_file)
+
+    def _message(self):
+        if self.cached_files and not (self.alts or self.attachments):
+            # A plain-text message only becomes multipart through attach()
+            for cached in self.cached_files:
+                self.attach(cached.display_name, cached.content_type, cached.data)
+            self.cached_files = []
+        msg = super()._message()
+        for cached in self.cached_files:
+            msg.attach(cached.mime_part())
+        return msg
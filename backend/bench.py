@@ -0,0 +1,349 @@
+"""Microbenchmarks for the submission hot path.
+
+Times the email template, the intake PDF (with and without an embedded ID
+photo), the ShipStation payload and the full /submit-form path for every
+medication, with and without an ID upload.  The full path runs the whole
+submission (PDF, both emails, ShipStation order) before it returns, against
+a local SMTP server and a local ShipStation stand-in, so nothing leaves the
+machine.
+
+    python bench.py run -o baseline.json
+    python bench.py run -k pdf --compare baseline.json
+    python bench.py compare baseline.json latest.json --threshold 0.15
+
+``compare`` (and ``run --compare``) exits with 1 when a benchmark's median
+got slower than the baseline by more than the threshold.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import socketserver
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MEDICATIONS = ("quickstrips", "drops", "Ozempic", "Mounjaro", "tirzepatide")
+
+DEFAULT_THRESHOLD = 0.15
+
+
+def submission_fixture(medication):
+    """A complete intake form as the frontend posts it"""
+    return {
+        "firstName": "Émilie",
+        "lastName": "Côté",
+        "email": "emilie.cote@example.com",
+        "phone": "416-555-0199",
+        "dateOfBirth": "1984-03-12",
+        "gender": "female",
+        "address": "123 Queen St W, Unit 4",
+        "city": "Toronto",
+        "province": "ON",
+        "postalCode": "M5H 2M9",
+        "height": "65",
+        "weight": "210",
+        "bmi": 34.9,
+        "currentMedications": "Metformin 500 mg twice daily",
+        "allergies": "Penicillin",
+        "medicalConditions": ["Type 2 diabetes", "Hypertension"],
+        "weightLossAttempts": "Diet programs, gym membership",
+        "idealWeight": "160",
+        "dietaryRestrictions": "None",
+        "exerciseRoutine": "Walking 3 times a week",
+        "smokingStatus": "Never",
+        "alcoholConsumption": "Occasionally",
+        "sleepPatterns": "6-7 hours",
+        "stressLevels": "Moderate",
+        "menstrualCycle": "Regular",
+        "medications": "Metformin",
+        "preferredMedication": medication,
+        "treatmentGoals": "Lose 50 lbs and improve blood sugar",
+        "deliveryMethod": "shipping",
+        "howDidYouHear": "Instagram",
+        "consentToTreatment": True,
+    }
+
+
+def id_photo_fixture(path):
+    """Write a phone-sized ID photo (2400x1800 JPEG, about 2.7 MB) to ``path``"""
+    from PIL import Image
+
+    noise = [Image.effect_noise((2400, 1800), 40) for _ in range(3)]
+    Image.merge("RGB", noise).save(path, "JPEG", quality=90)
+    return path
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    # Just enough SMTP for smtplib: accept every message and drop it
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.reply("220 localhost bench SMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b"EHLO":
+                self.reply("250-localhost")
+                self.reply("250 SIZE 52428800")
+            elif command == b"DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                self.server.messages += 1
+                self.reply("250 OK")
+            elif command == b"QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _SMTPHandler)
+        self.messages = 0
+
+
+class _ShipStationHandler(BaseHTTPRequestHandler):
+    # Answers like ShipStation for the three endpoints the app calls
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._json([{"storeId": 1, "storeName": "City Life Pharmacy", "active": True}])
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"null")
+        self.server.orders += len(body) if isinstance(body, list) else 1
+        if self.path.endswith("/createorders"):
+            self._json({"results": [{"orderNumber": order.get("orderNumber"), "orderId": 1, "success": True}
+                                    for order in body]})
+        else:
+            self._json({"orderNumber": body.get("orderNumber"), "orderId": 1})
+
+
+class LocalShipStation(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _ShipStationHandler)
+        self.orders = 0
+
+
+def _serve(server):
+    threading.Thread(target=server.serve_forever, name=type(server).__name__, daemon=True).start()
+    return server
+
+
+def measure(func, rounds=5, min_time=0.2, warmup=1):
+    """Per-call timings of ``func``: ``rounds`` rounds of as many calls as fit in ``min_time``"""
+    for _ in range(warmup):
+        func()
+    started = time.perf_counter()
+    func()
+    single = max(time.perf_counter() - started, 1e-7)
+    iterations = max(1, int(min_time / single))
+
+    per_call = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        per_call.append((time.perf_counter() - started) / iterations)
+    return {
+        "median_s": statistics.median(per_call),
+        "min_s": min(per_call),
+        "mean_s": statistics.fmean(per_call),
+        "stdev_s": statistics.stdev(per_call) if len(per_call) > 1 else 0.0,
+        "rounds": rounds,
+        "iterations": iterations,
+    }
+
+
+class InlineJobQueue:
+    """Runs a submission on the request thread, so the full path is timed in one call"""
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def enqueue(self, submission_id, **options):
+        self.handler(submission_id, **options)
+
+
+def _environment(workdir, smtp, shipstation):
+    # Everything the app writes goes to ``workdir``; mail and orders go to the stand-ins
+    os.environ.update({
+        "MAIL_SERVER": "127.0.0.1",
+        "MAIL_PORT": str(smtp.server_address[1]),
+        "MAIL_USE_TLS": "false",
+        "MAIL_USERNAME": "",
+        "MAIL_PASSWORD": "",
+        "SHIPSTATION_BASE_URL": f"http://127.0.0.1:{shipstation.server_address[1]}",
+        "SHIPSTATION_API_KEY": "bench",
+        "SHIPSTATION_API_SECRET": "bench",
+        "SHIPSTATION_RATE_LIMIT": "1000000",
+        "SHIPSTATION_BATCH_SIZE": "1",
+        "SHIPSTATION_STORE_CACHE": os.path.join(workdir, "stores.json"),
+        "SUBMISSIONS_DB": os.path.join(workdir, "submissions.db"),
+        "OUTBOX_DB": os.path.join(workdir, "outbox.db"),
+        "UPLOAD_DIR": os.path.join(workdir, "uploads"),
+        "TRACE_FILE": os.path.join(workdir, "spans.jsonl"),
+        "PROFILE_SAMPLE_RATE": "0",
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+
+def benchmarks(workdir):
+    """(name, callable) of every benchmark; imports the app against the stand-ins"""
+    smtp = _serve(LocalSMTPServer())
+    shipstation = _serve(LocalShipStation())
+    _environment(workdir, smtp, shipstation)
+
+    import app as application
+    from email_templates import get_email_body
+    from patient_pdf import generate_patient_pdf, render_intake_pdf
+
+    application.job_queue = InlineJobQueue(application.process_submission)
+    application.store_directory.wait_ready(5)
+    client = application.app.test_client()
+    id_path = id_photo_fixture(os.path.join(workdir, "id.jpg"))
+    with open(id_path, "rb") as f:
+        id_photo = f.read()
+
+    def post_form(data, with_id):
+        def run():
+            form = {"formData": json.dumps(data)}
+            if with_id:
+                form["idFile"] = (io.BytesIO(id_photo), "id.jpg")
+            response = client.post("/submit-form", data=form, content_type="multipart/form-data")
+            if response.status_code != 202:
+                raise RuntimeError(f"/submit-form answered {response.status_code}: {response.get_data(as_text=True)}")
+        return run
+
+    cases = []
+    for medication in MEDICATIONS:
+        data = submission_fixture(medication)
+        key = medication.lower()
+        cases += [
+            (f"email_body[{key}]", lambda m=medication: get_email_body(m, "Émilie")),
+            (f"shipstation_payload[{key}]", lambda d=data: application.build_shipstation_order("bench", d)),
+            (f"patient_pdf[{key}]", lambda d=data: generate_patient_pdf(d)),
+            (f"patient_pdf_with_id[{key}]",
+             lambda d=data: render_intake_pdf(d, id_path, application.ID_IMAGE_TARGET)),
+            (f"submit_form[{key}]", post_form(data, with_id=False)),
+            (f"submit_form_with_id[{key}]", post_form(data, with_id=True)),
+        ]
+    return cases, (smtp, shipstation)
+
+
+def run(selection=None, rounds=5, min_time=0.2):
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="wlf-bench-") as workdir:
+        cases, (smtp, shipstation) = benchmarks(workdir)
+        for name, func in cases:
+            if selection and not any(part in name for part in selection):
+                continue
+            results[name] = measure(func, rounds=rounds, min_time=min_time)
+            print(f"{name:<40} {results[name]['median_s'] * 1000:10.3f} ms  "
+                  f"(min {results[name]['min_s'] * 1000:.3f}, {results[name]['iterations']} x {rounds})")
+        print(f"Stand-ins received {smtp.messages} emails and {shipstation.orders} orders")
+        # Spans are written from a background thread; finish before the directory goes
+        from app import tracer
+        if tracer.exporter is not None:
+            tracer.exporter.close()
+    return {
+        "createdAt": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """Print the change of every benchmark's median; returns the names that regressed"""
+    regressions = []
+    for name in sorted(set(baseline["results"]) | set(current["results"])):
+        before = baseline["results"].get(name)
+        after = current["results"].get(name)
+        if before is None or after is None:
+            print(f"{name:<40} {'only in current' if before is None else 'only in baseline'}")
+            continue
+        change = after["median_s"] / before["median_s"] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<40} {before['median_s'] * 1000:10.3f} -> {after['median_s'] * 1000:10.3f} ms  "
+              f"{change:+7.1%}{flag}")
+    if baseline.get("platform") != current.get("platform") or baseline.get("cpus") != current.get("cpus"):
+        print("Note: the baseline was recorded on a different machine")
+    print(f"{len(regressions)} regression(s) beyond {threshold:.0%}")
+    return regressions
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the submission hot path")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("-k", dest="selection", action="append",
+                            help="only benchmarks whose name contains this (repeatable)")
+    run_parser.add_argument("--rounds", type=int, default=5)
+    run_parser.add_argument("--min-time", type=float, default=0.2, help="seconds per round")
+    run_parser.add_argument("-o", "--output", help="save the results as a JSON baseline")
+    run_parser.add_argument("--compare", metavar="BASELINE", help="compare the results with a baseline")
+    run_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    compare_parser = commands.add_parser("compare", help="compare two saved results")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                                help="allowed slowdown of a median, e.g. 0.15 for 15%%")
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        return 1 if compare(_load(args.baseline), _load(args.current), args.threshold) else 0
+
+    results = run(args.selection, rounds=args.rounds, min_time=args.min_time)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {args.output}")
+    if args.compare:
+        baseline = _load(args.compare)
+        if args.selection:
+            # Benchmarks left out with -k aren't missing
+            baseline["results"] = {name: result for name, result in baseline["results"].items()
+                                   if name in results["results"]}
+        return 1 if compare(baseline, results, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""Circuit breakers for the ShipStation and SMTP integrations.
+
+After ``failure_threshold`` consecutive failures a breaker opens and calls fail
+fast with ``CircuitOpenError`` instead of waiting on a remote that is down.
+Once ``reset_timeout`` has passed it lets a single probe call through
+(half-open); a successful probe closes it again, a failed one reopens it.
+"""
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an integration whose breaker is open"""
+
+    def __init__(self, name, retry_in):
+        super().__init__(f"{name} circuit is open, retry in {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, excluded=(), ignored=()):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # Exceptions that mean the remote answered (e.g. a rejected order)
+        self.excluded = tuple(excluded)
+        # Exceptions that say nothing about the remote (e.g. work withdrawn before it was sent)
+        self.ignored = tuple(ignored)
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _retry_in(self, now):
+        return max(0.0, self.opened_at + self.reset_timeout - now)
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go ahead now"""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            now = time.monotonic()
+            if self.state == OPEN and self._retry_in(now) <= 0:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            raise CircuitOpenError(self.name, self._retry_in(now) or self.reset_timeout)
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                log.info("%s circuit closed again", self.name)
+            self.state = CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error)
+            self._probing = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    log.warning("%s circuit opened after %d failures: %s", self.name, self.failures, error)
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def call(self, func, *args, **kwargs):
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except self.excluded:
+            self.record_success()
+            raise
+        except self.ignored:
+            with self._lock:
+                self._probing = False
+            raise
+        except Exception as e:
+            self.record_failure(e)
+            raise
+        self.record_success()
+        return result
+
+    def status(self):
+        with self._lock:
+            status = {"state": self.state, "consecutiveFailures": self.failures, "lastError": self.last_error}
+            if self.state != CLOSED:
+                status["retryInSeconds"] = round(self._retry_in(time.monotonic()), 1)
+            return status
@@ -0,0 +1,75 @@
+"""Treatment-plan email templates.
+
+Each medication's plan lives in ``treatment_plans/<medication>.html`` with
+``${name}``-style placeholders.  The registry reads every file once at
+startup and compiles it into a list of literal chunks and field names, so
+rendering a plan is one dict lookup plus a join of the per-patient values.
+Every app variant renders plans from these files.
+"""
+import html
+import os
+import re
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "treatment_plans")
+DEFAULT_TEMPLATE = "default"
+
+# Other names the form has used for the same medication
+ALIASES = {
+    "mounjaro": "tirzepatide",
+    "semaglutide": "ozempic",
+}
+
+_PLACEHOLDER = re.compile(r"\$\{(\w+)\}")
+
+
+class CompiledTemplate:
+    """A template split into literal text and the fields between it"""
+
+    def __init__(self, source):
+        self.source = source
+        self.chunks = _PLACEHOLDER.split(source)
+        # Odd positions hold field names, even positions literal text
+        self.fields = frozenset(self.chunks[1::2])
+
+    def render(self, values):
+        chunks = self.chunks[:]
+        for i in range(1, len(chunks), 2):
+            chunks[i] = html.escape(str(values.get(chunks[i], "")))
+        return "".join(chunks)
+
+
+class TemplateRegistry:
+    def __init__(self, directory=TEMPLATE_DIR):
+        self.templates = {}
+        for filename in sorted(os.listdir(directory)):
+            key, extension = os.path.splitext(filename)
+            if extension == ".html":
+                with open(os.path.join(directory, filename), encoding="utf-8") as f:
+                    self.templates[key] = CompiledTemplate(f.read())
+        if DEFAULT_TEMPLATE not in self.templates:
+            raise RuntimeError(f"{directory} has no {DEFAULT_TEMPLATE}.html template")
+
+    def key_for(self, medication):
+        """Template name for a medication, e.g. 'Mounjaro' -> 'tirzepatide'"""
+        key = (medication or "").strip().lower()
+        key = ALIASES.get(key, key)
+        return key if key in self.templates else DEFAULT_TEMPLATE
+
+    def get(self, medication):
+        return self.templates[self.key_for(medication)]
+
+    def render(self, medication, **values):
+        return self.get(medication).render(values)
+
+
+registry = TemplateRegistry()
+
+
+def medication_key(med):
+    """Medication a submission is for, as one of a fixed set of names (for metrics)"""
+    return registry.key_for(med)
+
+
+def get_email_body(med, name):
+    """Treatment-plan email body for a medication, addressed to the patient"""
+    return registry.render(med, name=name)
@@ -0,0 +1,106 @@
+"""Downscaling of images that end up in generated PDFs.
+
+Phone photos of patient IDs are often 5-10 MB, far more than a printed page
+needs.  ``shrink_photo()`` turns an upload into a JPEG no larger than an
+``ImageTarget`` (pixel size, quality, byte budget) so it can be embedded in
+the intake PDF instead of attaching the original.  Kept free of Flask so the
+PDF render workers can import it.
+"""
+import io
+import threading
+from typing import NamedTuple, Optional
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Lowest JPEG quality tried before the image is scaled down further
+MIN_QUALITY = 40
+
+
+class ImageTarget(NamedTuple):
+    # Longest side in pixels; 1600 px is about 270 dpi across a page
+    max_pixels: int = 1600
+    quality: int = 75
+    max_bytes: int = 500_000
+
+
+def _open(source, max_pixels=None):
+    # Bytes, or the path of an upload that was spooled to disk
+    image = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    if max_pixels:
+        # JPEGs can be decoded straight at 1/2, 1/4 or 1/8 scale
+        image.draft("RGB", (max_pixels, max_pixels))
+    image.load()
+    # Phones store portrait photos rotated, with the rotation in EXIF
+    return ImageOps.exif_transpose(image)
+
+
+def _flatten(image):
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+        return background
+    return image.convert("RGB") if image.mode != "RGB" else image
+
+
+def shrink_photo(source, target=ImageTarget()):
+    """JPEG bytes of the image (bytes or a path) within ``target``, or None if Pillow can't read it"""
+    try:
+        image = _open(source, target.max_pixels)
+    except (UnidentifiedImageError, OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    image = _flatten(image)
+    image.thumbnail((target.max_pixels, target.max_pixels), Image.LANCZOS)
+    quality = target.quality
+    while True:
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=quality, optimize=True, progressive=True)
+        if output.tell() <= target.max_bytes:
+            return output.getvalue()
+        if quality > MIN_QUALITY:
+            quality = max(MIN_QUALITY, quality - 10)
+        elif min(image.size) > 200:
+            image = image.resize((image.width * 3 // 4, image.height * 3 // 4), Image.LANCZOS)
+        else:
+            return output.getvalue()
+
+
+def shrink_logo(raw, max_pixels=256):
+    """PNG bytes of a letterhead logo no larger than it is ever printed"""
+    image = _open(raw)
+    if max(image.size) <= max_pixels:
+        return raw
+    image.thumbnail((max_pixels, max_pixels), Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, "PNG", optimize=True)
+    return output.getvalue()
+
+
+class SizeStats:
+    """Running totals of bytes saved by embedding shrunk ID images"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.embedded = 0
+        self.skipped = 0
+        self.original_bytes = 0
+        self.embedded_bytes = 0
+
+    def record(self, original_bytes, embedded_bytes: Optional[int]):
+        with self._lock:
+            if embedded_bytes is None:
+                self.skipped += 1
+                return
+            self.embedded += 1
+            self.original_bytes += original_bytes
+            self.embedded_bytes += embedded_bytes
+
+    def status(self):
+        with self._lock:
+            return {
+                "idImagesEmbedded": self.embedded,
+                "idImagesNotShrunk": self.skipped,
+                "originalBytes": self.original_bytes,
+                "embeddedBytes": self.embedded_bytes,
+                "bytesSaved": self.original_bytes - self.embedded_bytes,
+            }
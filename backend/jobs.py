@@ -0,0 +1,316 @@
+"""Background processing for /submit-form.
+
+The endpoint only validates and persists a submission, then hands it to a
+worker pool.  PDF generation, the two emails and the ShipStation order run
+here, and every stage records its progress so /submission-status can report
+it while the patient is already back on the success page.
+"""
+import contextvars
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime, timezone
+
+from uploads import StoredUpload
+
+log = logging.getLogger(__name__)
+
+# Stages of a submission, in the order they run
+STAGES = ("pdf", "patient_email", "pharmacy_email", "shipstation")
+
+PENDING = "pending"
+RUNNING = "running"
+RETRYING = "retrying"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "submissions.db")
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def validate_submission(data):
+    """Return a list of problems with a submitted payload (empty when valid)"""
+    if not isinstance(data, dict) or not data:
+        return ["Form data must be a non-empty JSON object"]
+
+    errors = []
+    email = data.get("email")
+    if email and (not isinstance(email, str) or "@" not in email):
+        errors.append("email is not a valid email address")
+    medication = data.get("preferredMedication")
+    if medication is not None and not isinstance(medication, str):
+        errors.append("preferredMedication must be a string")
+    return errors
+
+
+class SubmissionStore:
+    """SQLite record of submissions and the state of each processing stage.
+
+    Every submission is leased to the process working on it.  The process
+    that stores it holds the lease, and ``claim()`` renews it when the job
+    starts; another process can only take the submission over once the lease
+    has run out, so a submission is never worked on by two processes at once.
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH, lease_seconds=600.0):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self._owner = None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS submissions (
+                    id TEXT PRIMARY KEY,
+                    created_at TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    id_file_name TEXT,
+                    id_file_path TEXT,
+                    id_file_type TEXT,
+                    trace_id TEXT,
+                    owner TEXT,
+                    lease_expires_at REAL
+                )""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS stages (
+                    submission_id TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    detail TEXT,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (submission_id, stage)
+                )""")
+
+    def _connect(self):
+        # One connection per thread; sqlite3 connections can't be shared
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    @property
+    def owner(self):
+        """Lease holder name of this process (a forked child gets its own)"""
+        if self._owner is None or self._owner[0] != os.getpid():
+            self._owner = (os.getpid(), f"{os.getpid()}-{uuid.uuid4().hex[:8]}")
+        return self._owner[1]
+
+    def create(self, data, upload=None, trace_id=None):
+        """Persist a submission and its ``uploads.StoredUpload`` (if any), leased to this process; returns its id"""
+        submission_id = uuid.uuid4().hex
+        now = _now()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO submissions (id, created_at, data, id_file_name, id_file_path, id_file_type, trace_id, "
+                "owner, lease_expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (submission_id, now, json.dumps(data), *(upload or (None, None, None)), trace_id,
+                 self.owner, time.time() + self.lease_seconds),
+            )
+            conn.executemany(
+                "INSERT INTO stages (submission_id, stage, state, updated_at) VALUES (?, ?, ?, ?)",
+                [(submission_id, stage, PENDING, now) for stage in STAGES],
+            )
+        return submission_id
+
+    def load(self, submission_id):
+        """Return (data, upload) for a stored submission; upload is None without an ID file"""
+        row = self._connect().execute(
+            "SELECT data, id_file_name, id_file_path, id_file_type FROM submissions WHERE id = ?", (submission_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(submission_id)
+        upload = None
+        if row["id_file_path"]:
+            upload = StoredUpload(row["id_file_name"], row["id_file_path"], row["id_file_type"])
+        return json.loads(row["data"]), upload
+
+    def trace_id(self, submission_id):
+        """Trace ID the submission was stored with, or None"""
+        row = self._connect().execute("SELECT trace_id FROM submissions WHERE id = ?", (submission_id,)).fetchone()
+        return row["trace_id"] if row is not None else None
+
+    def claim(self, submission_id):
+        """Take or renew the lease on a submission; False if another process holds it"""
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                """UPDATE submissions SET owner = ?, lease_expires_at = ?
+                   WHERE id = ? AND (owner = ? OR owner IS NULL OR lease_expires_at < ?)""",
+                (self.owner, now + self.lease_seconds, submission_id, self.owner, now),
+            )
+        return cursor.rowcount == 1
+
+    def claim_abandoned(self, limit=100):
+        """Claim unfinished submissions whose lease ran out, oldest first; returns their ids.
+
+        The job queue only lives in memory, so these are submissions whose
+        process stopped (or crashed) before it finished them.
+        """
+        rows = self._connect().execute(
+            """SELECT DISTINCT submissions.id, submissions.created_at
+               FROM submissions JOIN stages ON stages.submission_id = submissions.id
+               WHERE stages.state IN (?, ?) AND (submissions.owner IS NULL OR submissions.lease_expires_at < ?)
+               ORDER BY submissions.created_at, submissions.id LIMIT ?""",
+            (PENDING, RUNNING, time.time(), limit),
+        ).fetchall()
+        return [row["id"] for row in rows if self.claim(row["id"])]
+
+    def stage_states(self, submission_id):
+        """{stage: state} for a submission"""
+        rows = self._connect().execute(
+            "SELECT stage, state FROM stages WHERE submission_id = ?", (submission_id,)
+        ).fetchall()
+        return {row["stage"]: row["state"] for row in rows}
+
+    def discard_upload(self, submission_id, upload):
+        """Delete a submission's ID file once nothing needs it any more"""
+        upload.discard()
+        with self._connect() as conn:
+            conn.execute("UPDATE submissions SET id_file_path = NULL WHERE id = ?", (submission_id,))
+
+    def created_between(self, since=None, until=None):
+        """Yield (id, created_at, data) of submissions created in [since, until), oldest first.
+
+        ``since``/``until`` are ISO timestamps or dates in UTC.  Rows are read
+        one at a time and the uploaded ID files are never loaded.
+        """
+        query = "SELECT id, created_at, data FROM submissions WHERE created_at >= ?"
+        params = [since or ""]
+        if until:
+            query += " AND created_at < ?"
+            params.append(until)
+        for row in self._connect().execute(query + " ORDER BY created_at, id", params):
+            yield row["id"], row["created_at"], json.loads(row["data"])
+
+    def set_stage(self, submission_id, stage, state, detail=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE stages SET state = ?, detail = ?, updated_at = ? WHERE submission_id = ? AND stage = ?",
+                (state, detail, _now(), submission_id, stage),
+            )
+
+    def status(self, submission_id):
+        """Per-stage progress for a submission, or None if it is unknown"""
+        conn = self._connect()
+        created = conn.execute(
+            "SELECT created_at, trace_id FROM submissions WHERE id = ?", (submission_id,)
+        ).fetchone()
+        if created is None:
+            return None
+        rows = conn.execute(
+            "SELECT stage, state, detail, updated_at FROM stages WHERE submission_id = ?", (submission_id,)
+        ).fetchall()
+        stages = {row["stage"]: {"state": row["state"], "detail": row["detail"], "updatedAt": row["updated_at"]}
+                  for row in rows}
+        states = {stage["state"] for stage in stages.values()}
+
+        if FAILED in states:
+            overall = "failed"
+        elif states <= {DONE, SKIPPED}:
+            overall = "completed"
+        elif states == {PENDING}:
+            overall = "queued"
+        else:
+            overall = "processing"
+
+        return {
+            "submissionId": submission_id,
+            "createdAt": created["created_at"],
+            "traceId": created["trace_id"],
+            "status": overall,
+            "stages": {stage: stages[stage] for stage in STAGES if stage in stages},
+        }
+
+
+class JobQueue:
+    """Thread pool that runs queued submissions through a handler"""
+
+    def __init__(self, handler, max_workers=4):
+        self.handler = handler
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="submission")
+        self._stop = threading.Event()
+        self._recovery = None
+
+    def enqueue(self, submission_id, **options):
+        """Run ``handler(submission_id, **options)`` on the pool"""
+        return self._executor.submit(self._run, submission_id, options)
+
+    def _run(self, submission_id, options):
+        try:
+            self.handler(submission_id, **options)
+        except Exception:
+            log.exception("Background job failed", extra={"submissionId": submission_id})
+
+    def recover(self, store):
+        """Queue the abandoned submissions this process could claim; returns their ids"""
+        submission_ids = store.claim_abandoned()
+        for submission_id in submission_ids:
+            self.enqueue(submission_id)
+        if submission_ids:
+            log.warning("Re-queued abandoned submissions", extra={"count": len(submission_ids)})
+        return submission_ids
+
+    def start_recovery(self, store, interval=60.0):
+        """Recover abandoned submissions now and then every ``interval`` seconds"""
+        if self._recovery is None:
+            self._recovery = threading.Thread(target=self._recovery_loop, args=(store, interval),
+                                              name="submission-recovery", daemon=True)
+            self._recovery.start()
+
+    def _recovery_loop(self, store, interval):
+        while True:
+            try:
+                self.recover(store)
+            except Exception:
+                log.exception("Submission recovery failed")
+            if self._stop.wait(interval):
+                return
+
+    def shutdown(self, wait=True):
+        self._stop.set()
+        self._executor.shutdown(wait=wait)
+
+
+def fan_out(executor, branches):
+    """Run independent branches concurrently on a shared executor.
+
+    ``branches`` maps a branch name to ``(callable, timeout_seconds)``.  Every
+    branch starts at once and gets its own deadline, so the whole fan-out
+    takes about as long as the slowest branch.  Each branch runs in a copy of
+    the caller's context, so it sees the caller's trace.  Returns, per
+    branch, a dict with ``ok``, ``result`` or ``error`` and ``durationMs``.
+    """
+    started = time.monotonic()
+
+    def timed(func):
+        begin = time.monotonic()
+        result = func()
+        return result, (time.monotonic() - begin) * 1000
+
+    futures = {name: (executor.submit(contextvars.copy_context().run, timed, func), timeout)
+               for name, (func, timeout) in branches.items()}
+
+    outcomes = {}
+    for name, (future, timeout) in futures.items():
+        remaining = max(0.0, started + timeout - time.monotonic())
+        try:
+            result, duration_ms = future.result(timeout=remaining)
+            outcomes[name] = {"ok": True, "result": result, "durationMs": round(duration_ms, 1)}
+        except FutureTimeoutError:
+            outcomes[name] = {"ok": False, "error": f"timed out after {timeout:g}s", "timedOut": True,
+                              "durationMs": round(timeout * 1000, 1)}
+        except Exception as e:
+            outcomes[name] = {"ok": False, "error": str(e),
+                              "durationMs": round((time.monotonic() - started) * 1000, 1)}
+    return outcomes
@@ -0,0 +1,167 @@
+"""Structured, non-blocking logging.
+
+A log call only copies the record onto an in-memory queue.  A listener
+thread formats it (one JSON object per line, or plain text) and writes it
+to stdout, so request and worker threads never wait on the stdout lock.
+
+Form and webhook payloads carry patient information.  They are not logged
+unless LOG_PAYLOADS is set, and even then only a ``redact()``-ed copy of a
+sample of them (LOG_PAYLOAD_SAMPLE_RATE) is written.
+
+    LOG_LEVEL=INFO  LOG_FORMAT=json|text  LOG_PAYLOADS=0  LOG_PAYLOAD_SAMPLE_RATE=1.0
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+
+REDACTED = "[redacted]"
+
+# Payload fields that are safe to log as-is; every other value is redacted
+SAFE_FIELDS = frozenset({
+    "preferredMedication", "deliveryMethod", "province",
+    # ShipStation webhooks
+    "resource_type", "resource_url",
+})
+
+# Attributes every LogRecord has; anything else was passed with extra=
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_lock = threading.Lock()
+_listener = None
+_handler = None
+_payloads = False
+_payload_sample_rate = 1.0
+
+
+def redact(value, key=None):
+    """Copy of a payload with every value outside SAFE_FIELDS replaced"""
+    if isinstance(value, dict):
+        return {k: redact(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact(item, key) for item in value]
+    if key in SAFE_FIELDS or value in (None, ""):
+        return value
+    return REDACTED
+
+
+def mask_email(address):
+    """'ann@example.com' -> 'a***@example.com'"""
+    local, _, domain = (address or "").partition("@")
+    return f"{local[:1]}***@{domain}" if domain else REDACTED
+
+
+def _fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **_fields(record),
+        }
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = _fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Only what can't wait happens on the calling thread: merging the
+        # arguments (they may change later) and rendering a traceback.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _start(level, formatter):
+    global _listener, _handler
+    root = logging.getLogger()
+    if _handler is not None:
+        root.removeHandler(_handler)
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(formatter)
+    _handler = _QueueHandler(records)
+    _listener = logging.handlers.QueueListener(records, output)
+    root.addHandler(_handler)
+    root.setLevel(level)
+    _listener.start()
+
+
+def _hold_output():
+    # Only the listener thread writes to stdout.  Holding its handler's lock
+    # across fork() means the child never inherits stdout's buffer mid-write.
+    if _listener is not None:
+        _listener.handlers[0].acquire()
+
+
+def _release_output():
+    if _listener is not None:
+        _listener.handlers[0].release()
+
+
+def _restart_in_child():
+    # The listener thread doesn't survive fork(); PDF render workers and
+    # pre-forked app servers get their own.  (logging re-creates the
+    # inherited handler locks in the child itself.)
+    if _listener is not None:
+        _start(logging.getLogger().level, _listener.handlers[0].formatter)
+
+
+def _stop():
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def setup_logging(level=None, fmt=None, payloads=None, payload_sample_rate=None):
+    """Route all logging through the queue; later calls only update the payload settings"""
+    global _payloads, _payload_sample_rate
+    _payloads = (os.getenv("LOG_PAYLOADS", "").lower() in ("1", "true", "yes")) if payloads is None else payloads
+    _payload_sample_rate = (float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+                            if payload_sample_rate is None else payload_sample_rate)
+    with _lock:
+        if _listener is not None:
+            return
+        level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
+        fmt = (fmt or os.getenv("LOG_FORMAT", "json")).lower()
+        _start(level, TextFormatter() if fmt == "text" else JsonFormatter())
+        atexit.register(_stop)
+        os.register_at_fork(before=_hold_output, after_in_parent=_release_output,
+                            after_in_child=_restart_in_child)
+
+
+def log_payload(logger, message, data, **fields):
+    """Log a redacted copy of a payload if payload logging is on and this one is sampled"""
+    if not _payloads or not logger.isEnabledFor(logging.INFO):
+        return
+    if _payload_sample_rate < 1.0 and random.random() >= _payload_sample_rate:
+        return
+    logger.info(message, extra={"payload": redact(data), **fields})
@@ -0,0 +1,76 @@
+"""Micro-batching of ShipStation order creation.
+
+Orders submitted by concurrent submissions are collected for a short window
+(or until the batch is full) and sent in one ``orders/createorders`` call.
+Each caller gets a future that resolves to its own entry of the bulk
+response, so at peak intake one HTTP round trip and one rate-limit token
+cover many orders.  A caller that stops waiting can ``cancel()`` its future;
+the order is dropped if its batch hasn't been sent yet.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# ShipStation accepts at most 100 orders per createorders call
+MAX_BATCH_SIZE = 100
+
+
+class OrderBatcher:
+    """Collects orders and hands them to ``send_batch`` in groups.
+
+    ``send_batch(orders)`` must return one result dict per order, in order.
+    """
+
+    def __init__(self, send_batch, max_batch=20, max_wait=1.0):
+        self.send_batch = send_batch
+        self.max_batch = max(1, min(max_batch, MAX_BATCH_SIZE))
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, order):
+        """Queue an order; the returned future resolves to its createorders result"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((order, future))
+        return future
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="order-batcher", daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            # Orders whose callers gave up before the batch went out are dropped
+            batch = [(order, future) for order, future in self._collect() if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            orders = [order for order, _ in batch]
+            try:
+                results = self.send_batch(orders)
+                if len(results) != len(batch):
+                    raise RuntimeError(f"ShipStation returned {len(results)} results for {len(batch)} orders")
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
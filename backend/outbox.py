@@ -0,0 +1,304 @@
+"""Transactional outbox for the emails and ShipStation orders of a submission.
+
+Every side effect is written to a local SQLite file (WAL mode) before it is
+attempted.  Emails are stored as the fully rendered MIME message and orders
+as their JSON payload, so a retry or replay never has to rebuild the PDF or
+re-read the ID upload.  A message's body is dropped once it has been sent.
+A dispatcher drains due entries in batches and backs off exponentially on
+failure.
+
+Replay what is still pending from the command line:
+
+    python outbox.py replay            # pending entries, ignoring backoff
+    python outbox.py replay --dead     # also entries that ran out of attempts
+    python outbox.py list
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+DEAD = "dead"
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "outbox.db")
+
+
+class DeferDelivery(Exception):
+    """Raised by a handler to put an entry back without using up an attempt"""
+
+    def __init__(self, delay, reason):
+        super().__init__(reason)
+        self.delay = delay
+
+
+class DeliveryRejected(Exception):
+    """Raised by a handler when the remote refused the entry; it is not retried"""
+
+
+class Outbox:
+    """SQLite-backed queue of side effects waiting to be delivered"""
+
+    def __init__(self, path=DEFAULT_DB_PATH, max_attempts=8, backoff_base=30.0, backoff_max=3600.0,
+                 lease_seconds=300.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease_seconds = lease_seconds
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    submission_id TEXT,
+                    stage TEXT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    body BLOB,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    claimed_at REAL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add(self, kind, payload, body=None, submission_id=None, stage=None):
+        """Record a side effect before it runs and return its entry id"""
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                """INSERT INTO outbox (submission_id, stage, kind, payload, body, status, next_attempt_at,
+                                       created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (submission_id, stage, kind, json.dumps(payload), body, PENDING, now, now, now),
+            )
+        return cursor.lastrowid
+
+    def get(self, entry_id):
+        row = self._connect().execute("SELECT * FROM outbox WHERE id = ?", (entry_id,)).fetchone()
+        return _entry(row) if row else None
+
+    def claim(self, entry_id, ignore_schedule=False):
+        """Take an entry for delivery; returns None if someone else holds it"""
+        now = time.time()
+        schedule = "" if ignore_schedule else " AND next_attempt_at <= ?"
+        params = [SENDING, now, now, entry_id, PENDING, SENDING, now - self.lease_seconds]
+        if not ignore_schedule:
+            params.append(now)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"""UPDATE outbox SET status = ?, claimed_at = ?, updated_at = ?
+                    WHERE id = ? AND (status = ? OR (status = ? AND claimed_at < ?)){schedule}""",
+                params,
+            )
+        return self.get(entry_id) if cursor.rowcount else None
+
+    def due(self, limit):
+        """Ids of entries ready for another attempt, oldest first"""
+        now = time.time()
+        rows = self._connect().execute(
+            """SELECT id FROM outbox
+               WHERE (status = ? AND next_attempt_at <= ?) OR (status = ? AND claimed_at < ?)
+               ORDER BY next_attempt_at LIMIT ?""",
+            (PENDING, now, SENDING, now - self.lease_seconds, limit),
+        ).fetchall()
+        return [row["id"] for row in rows]
+
+    def mark_sent(self, entry_id):
+        # A delivered email's MIME body (intake PDF, ID photo) is not kept
+        with self._connect() as conn:
+            conn.execute(
+                """UPDATE outbox SET status = ?, attempts = attempts + 1, body = NULL, last_error = NULL,
+                                     updated_at = ? WHERE id = ?""",
+                (SENT, time.time(), entry_id),
+            )
+
+    def mark_failed(self, entry_id, error, final=False):
+        """Schedule the next attempt with exponential backoff (none if ``final``); returns the new status"""
+        entry = self.get(entry_id)
+        attempts = entry["attempts"] + 1
+        now = time.time()
+        if final or attempts >= self.max_attempts:
+            status, next_attempt_at = DEAD, now
+        else:
+            status = PENDING
+            next_attempt_at = now + min(self.backoff_base * (2 ** (attempts - 1)), self.backoff_max)
+        with self._connect() as conn:
+            conn.execute(
+                """UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ?
+                   WHERE id = ?""",
+                (status, attempts, next_attempt_at, str(error), now, entry_id),
+            )
+        return status
+
+    def defer(self, entry_id, delay, reason):
+        """Put a claimed entry back to be retried after ``delay`` seconds"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE outbox SET status = ?, next_attempt_at = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                (PENDING, now + delay, reason, now, entry_id),
+            )
+
+    def counts(self):
+        rows = self._connect().execute("SELECT status, COUNT(*) AS n FROM outbox GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+    def stage_statuses(self, submission_id):
+        """{stage: status} of the entries recorded for a submission"""
+        rows = self._connect().execute(
+            "SELECT stage, status FROM outbox WHERE submission_id = ? AND stage IS NOT NULL ORDER BY id",
+            (submission_id,),
+        ).fetchall()
+        return {row["stage"]: row["status"] for row in rows}
+
+    def revive(self, include_dead=False):
+        """Make pending (and optionally dead) entries due now; returns their ids"""
+        statuses = (PENDING, DEAD) if include_dead else (PENDING,)
+        placeholders = ", ".join("?" for _ in statuses)
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT id FROM outbox WHERE status IN ({placeholders}) ORDER BY id", statuses
+            ).fetchall()
+            conn.execute(
+                f"""UPDATE outbox SET status = ?, next_attempt_at = ?,
+                           attempts = CASE WHEN status = ? THEN 0 ELSE attempts END
+                    WHERE status IN ({placeholders})""",
+                (PENDING, time.time(), DEAD, *statuses),
+            )
+        return [row["id"] for row in rows]
+
+    def entries(self, statuses=(PENDING, SENDING, DEAD)):
+        placeholders = ", ".join("?" for _ in statuses)
+        rows = self._connect().execute(
+            f"SELECT * FROM outbox WHERE status IN ({placeholders}) ORDER BY id", tuple(statuses)
+        ).fetchall()
+        return [_entry(row) for row in rows]
+
+
+def _entry(row):
+    entry = dict(row)
+    entry["payload"] = json.loads(entry["payload"])
+    return entry
+
+
+class Dispatcher:
+    """Delivers outbox entries through one handler per kind"""
+
+    def __init__(self, outbox, handlers, batch_size=20, poll_interval=5.0, on_sent=None, on_failed=None):
+        self.outbox = outbox
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self._stop = threading.Event()
+        self._thread = None
+
+    def dispatch(self, entry_id, ignore_schedule=False):
+        """Attempt one entry now; returns True once it has been delivered"""
+        entry = self.outbox.claim(entry_id, ignore_schedule=ignore_schedule)
+        if entry is None:
+            return False
+
+        try:
+            self.handlers[entry["kind"]](entry)
+        except DeferDelivery as e:
+            self.outbox.defer(entry_id, e.delay, str(e))
+            log.info("Outbox entry deferred: %s", e, extra={"outboxId": entry_id, "kind": entry["kind"]})
+            if self.on_failed:
+                self.on_failed(entry, e, PENDING)
+            return False
+        except Exception as e:
+            status = self.outbox.mark_failed(entry_id, e, final=isinstance(e, DeliveryRejected))
+            log.warning("Outbox entry failed: %s", e, extra={"outboxId": entry_id, "kind": entry["kind"], "status": status})
+            if self.on_failed:
+                self.on_failed(entry, e, status)
+            return False
+
+        self.outbox.mark_sent(entry_id)
+        if self.on_sent:
+            self.on_sent(entry)
+        return True
+
+    def drain(self):
+        """Deliver due entries in batches until none are left; returns how many were sent"""
+        sent = 0
+        while not self._stop.is_set():
+            batch = self.outbox.due(self.batch_size)
+            if not batch:
+                break
+            sent += sum(1 for entry_id in batch if self.dispatch(entry_id))
+            if len(batch) < self.batch_size:
+                break
+        return sent
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="outbox-dispatcher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.drain()
+            except Exception:
+                log.exception("Outbox dispatcher error")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and replay the submission outbox")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="show entries that have not been delivered")
+    replay = commands.add_parser("replay", help="deliver pending entries now")
+    replay.add_argument("--dead", action="store_true", help="also replay entries that ran out of attempts")
+    args = parser.parse_args(argv)
+
+    if args.command == "list":
+        for entry in Outbox(os.getenv("OUTBOX_DB", DEFAULT_DB_PATH)).entries():
+            print(f"#{entry['id']} {entry['kind']:<12} {entry['status']:<8} attempts={entry['attempts']} "
+                  f"submission={entry['submission_id']} error={entry['last_error']}")
+        return 0
+
+    # The handlers need the app's mail and ShipStation configuration
+    from app import app, outbox, outbox_dispatcher
+
+    # Deliver from here only, not also from the app's background loop
+    outbox_dispatcher.stop()
+    entry_ids = outbox.revive(include_dead=args.dead)
+    delivered = 0
+    with app.app_context():
+        for entry_id in entry_ids:
+            if outbox_dispatcher.dispatch(entry_id, ignore_schedule=True):
+                delivered += 1
+    print(f"📤 Replayed {len(entry_ids)} outbox entries, {delivered} delivered")
+    return 0 if delivered == len(entry_ids) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,195 @@
+"""Patient intake PDF layout.
+
+Kept free of Flask so the PDF render pool can import it in worker processes.
+
+The sections are described by ``SECTIONS``: each lists its fields with their
+label and value formatter, all worked out once at import.  Rendering is a
+single pass over the schema, and anything the schema doesn't know about ends
+up under "Additional Information".  Adding a questionnaire field to the PDF
+only means adding a ``Field`` here.
+
+``render_intake_pdf()`` can also embed a downscaled copy of the uploaded ID
+on its own page, so the pharmacy email doesn't need the original photo.
+"""
+import io
+import os
+import re
+from functools import lru_cache
+from typing import Callable, NamedTuple, Optional
+
+from images import ImageTarget, shrink_photo
+from pdf_template import new_document
+
+
+def _text(value):
+    if isinstance(value, list):
+        return ', '.join(str(item) for item in value)
+    return str(value)
+
+
+def _suffix(unit):
+    return lambda value: f"{value} {unit}"
+
+
+def _one_decimal(value):
+    try:
+        return f"{float(value):.1f}"
+    except (TypeError, ValueError):
+        return str(value)
+
+
+class Field(NamedTuple):
+    key: str
+    label: str
+    format: Callable = _text
+
+
+class Section(NamedTuple):
+    title: str
+    fields: tuple
+    # Print the heading even when none of the fields are in the data
+    always: bool = False
+    # Only print fields with a non-empty value (otherwise: any key present)
+    filled_only: bool = False
+    space_before: int = 0
+    space_after: int = 5
+
+
+SECTIONS = (
+    Section("Basic Information", always=True, fields=(
+        Field("firstName", "First Name"),
+        Field("lastName", "Last Name"),
+        Field("email", "Email"),
+        Field("phone", "Phone"),
+        Field("dateOfBirth", "Date of Birth"),
+        Field("gender", "Gender"),
+    )),
+    Section("Address Information", fields=(
+        Field("address", "Address"),
+        Field("city", "City"),
+        Field("province", "Province"),
+        Field("postalCode", "Postal Code"),
+    )),
+    Section("Physical Information", fields=(
+        Field("height", "Height", _suffix("inches")),
+        Field("weight", "Weight", _suffix("lbs")),
+        Field("bmi", "BMI", _one_decimal),
+    )),
+    Section("Medical Information", always=True, filled_only=True, space_after=0, fields=(
+        Field("currentMedications", "Current Medications"),
+        Field("allergies", "Allergies"),
+        Field("medicalConditions", "Medical Conditions"),
+        Field("weightLossAttempts", "Previous Weight Loss Attempts"),
+        Field("idealWeight", "Target Weight"),
+        Field("dietaryRestrictions", "Dietary Restrictions"),
+        Field("exerciseRoutine", "Exercise Routine"),
+        Field("smokingStatus", "Smoking Status"),
+        Field("alcoholConsumption", "Alcohol Consumption"),
+        Field("sleepPatterns", "Sleep Patterns"),
+        Field("stressLevels", "Stress Levels"),
+        Field("menstrualCycle", "Menstrual Cycle"),
+        Field("medications", "Medications"),
+        Field("preferredMedication", "Preferred Medication"),
+        Field("treatmentGoals", "Treatment Goals"),
+    )),
+    Section("Delivery Information", space_before=5, space_after=0, fields=(
+        Field("deliveryMethod", "Delivery Method", lambda value: str(value).title()),
+    )),
+)
+
+ADDITIONAL_SECTION = Section("Additional Information", fields=(), space_before=5, space_after=0)
+
+KNOWN_KEYS = frozenset(field.key for section in SECTIONS for field in section.fields)
+SCHEMA_LABELS = tuple(field.label for section in SECTIONS for field in section.fields)
+
+_CAMEL_BOUNDARY = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+
+
+@lru_cache(maxsize=512)
+def readable_label(key):
+    """Label for a field the schema doesn't list, e.g. 'idUpload' -> 'Id Upload'"""
+    return _CAMEL_BOUNDARY.sub(" ", key.replace('_', ' ')).title()
+
+
+def section_rows(section, data):
+    """(label, value) rows of a section for this submission"""
+    if section.filled_only:
+        return [(field.label, field.format(data[field.key])) for field in section.fields if data.get(field.key)]
+    return [(field.label, field.format(data[field.key])) for field in section.fields if field.key in data]
+
+
+def build_patient_pdf(data, id_image=None):
+    """Lay out the patient intake PDF, with the ID (JPEG bytes) on a last page if given"""
+    pdf = new_document("Patient Information")
+    font = pdf.font_family_name
+
+    sections = [(section, section_rows(section, data)) for section in SECTIONS]
+    other_rows = [(readable_label(key), _text(value)) for key, value in data.items()
+                  if key not in KNOWN_KEYS and value]
+    if other_rows:
+        sections.append((ADDITIONAL_SECTION, other_rows))
+    pdf.set_font(font, "B", 12)
+    label_width = label_column_width(pdf, SCHEMA_LABELS + tuple(label for label, _ in other_rows))
+
+    for section, rows in sections:
+        if not rows and not section.always:
+            continue
+        if section.space_before:
+            pdf.ln(section.space_before)
+        pdf.set_font(font, "B", 14)
+        pdf.cell(0, 10, section.title, 0, 1)
+        pdf.ln(5)
+
+        for label, value in rows:
+            pdf.set_font(font, "B", 12)
+            pdf.cell(label_width, 8, f"{label}:", 0, 0)
+            pdf.set_font(font, size=12)
+            pdf.cell(0, 8, value, 0, 1)
+
+        if section.space_after:
+            pdf.ln(section.space_after)
+
+    if id_image:
+        add_id_page(pdf, id_image)
+
+    return pdf
+
+def label_column_width(pdf, labels):
+    """Width (mm) that fits the longest label in the current font, at most half the page"""
+    widest = max(pdf.get_string_width(f"{label}:") for label in labels)
+    return min(widest + 2 * pdf.c_margin + 2, pdf.epw / 2)
+
+def add_id_page(pdf, id_image):
+    pdf.add_page()
+    pdf.set_font(pdf.font_family_name, "B", 14)
+    pdf.cell(0, 10, "Patient Identification", 0, 1)
+    pdf.ln(5)
+    # Fit the image into the rest of the page, keeping its aspect ratio
+    width = pdf.epw
+    height = pdf.h - pdf.get_y() - pdf.b_margin
+    pdf.image(io.BytesIO(id_image), x=pdf.l_margin, y=pdf.get_y(), w=width, h=height, keep_aspect_ratio=True)
+
+def generate_patient_pdf(data, id_image=None):
+    """Generate a PDF from the patient data and return its bytes, without touching disk"""
+    return bytes(build_patient_pdf(data, id_image).output())
+
+
+class IntakePdf(NamedTuple):
+    pdf: bytes
+    # Size of the uploaded ID and of the copy embedded in the PDF (None: not embedded)
+    id_original_bytes: int = 0
+    id_embedded_bytes: Optional[int] = None
+
+    @property
+    def id_embedded(self):
+        return self.id_embedded_bytes is not None
+
+
+def render_intake_pdf(data, id_path=None, image_target=ImageTarget()):
+    """Intake PDF with the uploaded ID (a file on disk) shrunk and embedded when it is a readable image"""
+    id_image = shrink_photo(id_path, image_target) if id_path else None
+    return IntakePdf(
+        pdf=generate_patient_pdf(data, id_image),
+        id_original_bytes=os.path.getsize(id_path) if id_path else 0,
+        id_embedded_bytes=len(id_image) if id_image else None,
+    )
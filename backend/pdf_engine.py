@@ -0,0 +1,196 @@
+"""Process pool for rendering patient PDFs.
+
+FPDF layout is pure Python and holds the GIL for the whole render, so running
+it on submission threads caps PDF throughput at one core.  The engine keeps a
+pool of pre-started worker processes, bounds how many renders may be queued
+and gives every job its own timeout.  Workers return the finished PDF bytes.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from patient_pdf import generate_patient_pdf, render_intake_pdf
+from pdf_template import load_fonts
+from treatment_plan_pdf import render_cover
+
+log = logging.getLogger(__name__)
+
+
+class RenderQueueFull(Exception):
+    """Raised when the render queue stays full for longer than the wait allows"""
+
+
+class RenderTimeout(Exception):
+    """Raised when a render takes longer than its timeout"""
+
+
+def _warm_up():
+    # Parsing the TTF fonts is the slow part of a worker's first job; forked
+    # workers inherit the fonts start() already parsed in the parent.
+    load_fonts()
+    return os.getpid()
+
+
+class PdfRenderEngine:
+    """Renders patient PDFs on a bounded pool of worker processes.
+
+    With ``workers=0`` renders run inline on the calling thread, which is
+    handy for development and for platforms without a usable process pool.
+    If a worker dies (out of memory, a crash), the pool is replaced and the
+    renders it took down fail on their own instead of every later one.
+    """
+
+    def __init__(self, workers=None, max_queued=None, timeout=30.0, queue_wait=10.0, start_method=None):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.timeout = timeout
+        self.queue_wait = queue_wait
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+        if self.workers > 0:
+            max_queued = max_queued or self.workers * 2
+            self._slots = threading.BoundedSemaphore(max_queued)
+            self._context = _pool_context(start_method)
+            self._executor = self._new_pool()
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=self._context, initializer=_warm_up)
+
+    def _replace(self, broken):
+        """Swap a pool that lost a worker for a new one; returns the pool to use"""
+        with self._lock:
+            if self._executor is broken:
+                log.error("A PDF render worker died; starting a new pool")
+                self._executor = self._new_pool()
+                broken.shutdown(wait=False, cancel_futures=True)
+            return self._executor
+
+    def start(self):
+        """Fork every worker process now instead of on the first submission"""
+        load_fonts()
+        if self._executor is not None:
+            pids = [self._executor.submit(_warm_up) for _ in range(self.workers)]
+            for pid in pids:
+                pid.result()
+
+    def render(self, data, timeout=None):
+        """Render the patient PDF for ``data`` and return its bytes"""
+        return self._run(generate_patient_pdf, (data,), timeout)
+
+    def render_intake(self, data, id_path, image_target, timeout=None):
+        """Render the intake PDF with the ID file at ``id_path`` embedded; returns a patient_pdf.IntakePdf"""
+        return self._run(render_intake_pdf, (data, id_path, image_target), timeout)
+
+    def render_cover(self, name, schedule, has_instructions=False, timeout=None):
+        """Render a treatment-plan cover page (see treatment_plan_pdf.render_cover) and return its bytes"""
+        return self._run(render_cover, (name, schedule, has_instructions), timeout)
+
+    def _run(self, func, args, timeout=None):
+        if self._executor is None:
+            return func(*args)
+
+        try:
+            return self._run_once(func, args, timeout)
+        except BrokenProcessPool:
+            # This job may only have been caught up in another one's crash
+            return self._run_once(func, args, timeout)
+
+    def _run_once(self, func, args, timeout):
+        if not self._slots.acquire(timeout=self.queue_wait):
+            raise RenderQueueFull(f"PDF render queue is full ({self.workers} workers busy)")
+        executor = self._executor
+        try:
+            future = executor.submit(func, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._replace(executor)
+            raise
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return future.result(timeout=timeout or self.timeout)
+        except FutureTimeoutError:
+            # A job that already started can't be interrupted; it keeps its
+            # queue slot until the worker finishes it.
+            future.cancel()
+            raise RenderTimeout(f"PDF render took longer than {timeout or self.timeout}s")
+        except BrokenProcessPool:
+            self._replace(executor)
+            raise
+
+    def render_many(self, items, window=None, timeout=None):
+        """Render ``(key, data)`` pairs, yielding ``(key, pdf_bytes, error)`` in input order.
+
+        At most ``window`` renders (default: one per worker) are in flight,
+        so a large batch holds only a handful of PDFs in memory and live
+        submissions queue behind no more than that.  Batch jobs don't take
+        the live render queue's slots.
+        """
+        if self._executor is None:
+            for key, data in items:
+                try:
+                    yield key, generate_patient_pdf(data), None
+                except Exception as e:
+                    yield key, None, e
+            return
+
+        window = window or self.workers
+        timeout = timeout or self.timeout
+        pending = deque()
+
+        def submit(data):
+            executor = self._executor
+            try:
+                return executor, executor.submit(generate_patient_pdf, data)
+            except BrokenProcessPool:
+                executor = self._replace(executor)
+                return executor, executor.submit(generate_patient_pdf, data)
+
+        def collect(key, executor, future):
+            result = _collect(key, future, timeout)
+            if isinstance(result[2], BrokenProcessPool):
+                # Only the renders in flight fail; the rest go to a new pool
+                self._replace(executor)
+            return result
+
+        try:
+            for key, data in items:
+                pending.append((key, *submit(data)))
+                if len(pending) >= window:
+                    yield collect(*pending.popleft())
+            while pending:
+                yield collect(*pending.popleft())
+        finally:
+            # The consumer stopped early (e.g. the client disconnected)
+            for _, _, future in pending:
+                future.cancel()
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def _collect(key, future, timeout):
+    try:
+        return key, future.result(timeout=timeout), None
+    except FutureTimeoutError:
+        future.cancel()
+        return key, None, RenderTimeout(f"PDF render took longer than {timeout}s")
+    except Exception as e:
+        return key, None, e
+
+
+def _pool_context(start_method=None):
+    # Forked workers don't re-import __main__ (the Flask app), unlike spawn
+    # and forkserver workers.  Call start() before the app starts any threads.
+    if start_method is None:
+        start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(start_method)
@@ -0,0 +1,246 @@
+"""Batch export of intake PDFs.
+
+Renders the stored submissions of a date range on the PDF render pool and
+streams them either as a ZIP with one PDF per submission or as one combined
+PDF.  Output is produced chunk by chunk as renders finish, so neither the
+archive nor the full set of PDFs is ever held in memory.
+
+    python pdf_export.py --from 2026-10-01 --to 2026-10-07 -o week.zip
+    python pdf_export.py --from 2026-10-17 --format pdf -o today.pdf
+
+Dates are inclusive and in UTC, like the stored ``created_at`` timestamps.
+"""
+import argparse
+import io
+import logging
+import os
+import re
+import unicodedata
+import zipfile
+from datetime import date, timedelta
+
+from pypdf import PdfReader
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, StreamObject
+
+from jobs import DEFAULT_DB_PATH, SubmissionStore
+from logs import setup_logging
+from pdf_engine import PdfRenderEngine
+
+log = logging.getLogger(__name__)
+
+FORMATS = {
+    "zip": ("application/zip", "zip"),
+    "pdf": ("application/pdf", "pdf"),
+}
+
+
+def date_range(since=None, until=None):
+    """``created_at`` bounds for inclusive YYYY-MM-DD dates; raises ValueError"""
+    start = date.fromisoformat(since).isoformat() if since else None
+    end = (date.fromisoformat(until) + timedelta(days=1)).isoformat() if until else None
+    if start and end and start >= end:
+        raise ValueError("the end date is before the start date")
+    return start, end
+
+
+def export_name(submission_id, created_at, data):
+    """File name of a submission's PDF inside the ZIP"""
+    name = "_".join(str(data.get(key) or "") for key in ("lastName", "firstName")).strip("_") or "patient"
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    name = re.sub(r"[^A-Za-z0-9_-]+", "-", name)
+    return f"{created_at[:10]}_{name}_{submission_id[:8]}.pdf"
+
+
+class _ChunkBuffer:
+    """Write-only file object whose contents are handed out as chunks"""
+
+    def __init__(self):
+        self._chunks = []
+        self.written = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.written += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+class StreamingPdfMerger:
+    """Concatenates PDFs into one document written straight to ``out``.
+
+    Each source's page objects are renumbered and written as soon as it is
+    added; only the object offsets and page numbers are kept until
+    ``close()`` writes the page tree, catalog and cross-reference table.
+    """
+
+    CATALOG = 1
+    PAGES = 2
+
+    def __init__(self, out):
+        self.out = out
+        self.offset = 0
+        self.offsets = {}
+        self.pages = []
+        self._next_number = 3
+        self._write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write(self, data):
+        self.out.write(data)
+        self.offset += len(data)
+
+    def _write_object(self, number, obj):
+        body = io.BytesIO()
+        obj.write_to_stream(body)
+        self.offsets[number] = self.offset
+        self._write(f"{number} 0 obj\n".encode() + body.getvalue() + b"\nendobj\n")
+
+    def add(self, pdf_bytes):
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        numbers = {}
+        queue = []
+
+        def renumber(ref):
+            key = (ref.idnum, ref.generation)
+            if key not in numbers:
+                numbers[key] = self._next_number
+                self._next_number += 1
+                queue.append(ref)
+            return IndirectObject(numbers[key], 0, None)
+
+        def copy(obj, skip=()):
+            if isinstance(obj, IndirectObject):
+                return renumber(obj)
+            if isinstance(obj, StreamObject):
+                stream = obj.__class__()
+                stream._data = obj._data
+                stream.update({key: copy(value) for key, value in obj.items()})
+                return stream
+            if isinstance(obj, DictionaryObject):
+                return DictionaryObject({key: copy(value) for key, value in obj.items() if key not in skip})
+            if isinstance(obj, ArrayObject):
+                return ArrayObject(copy(value) for value in obj)
+            return obj
+
+        # reader.pages have inherited attributes (MediaBox, Resources) filled in
+        source_pages = {}
+        for page in reader.pages:
+            ref = page.indirect_reference
+            source_pages[(ref.idnum, ref.generation)] = page
+            self.pages.append(renumber(ref).idnum)
+
+        while queue:
+            ref = queue.pop()
+            key = (ref.idnum, ref.generation)
+            if key in source_pages:
+                obj = copy(source_pages[key], skip=("/Parent",))
+                obj[NameObject("/Parent")] = IndirectObject(self.PAGES, 0, None)
+            else:
+                obj = copy(ref.get_object())
+            self._write_object(numbers[key], obj)
+
+    def close(self):
+        kids = " ".join(f"{number} 0 R" for number in self.pages)
+        self.offsets[self.PAGES] = self.offset
+        self._write(f"{self.PAGES} 0 obj\n<< /Type /Pages /Kids [{kids}] /Count {len(self.pages)} >>\nendobj\n".encode())
+        self.offsets[self.CATALOG] = self.offset
+        self._write(f"{self.CATALOG} 0 obj\n<< /Type /Catalog /Pages {self.PAGES} 0 R >>\nendobj\n".encode())
+
+        xref_offset = self.offset
+        size = self._next_number
+        xref = [f"xref\n0 {size}\n0000000000 65535 f \n"]
+        xref += [f"{self.offsets[number]:010d} 00000 n \n" for number in range(1, size)]
+        self._write("".join(xref).encode())
+        self._write(f"trailer\n<< /Size {size} /Root {self.CATALOG} 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode())
+
+
+def _zip_chunks(results, buffer, summary):
+    # ZipFile writes data descriptors when the output can't seek, so every
+    # member goes out as soon as it is added.  PDF streams are already
+    # deflated, so the members are stored as-is.
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for name, pdf in results:
+            archive.writestr(name, pdf)
+            yield buffer.drain()
+        if summary["failed"]:
+            archive.writestr("export_errors.txt", "\n".join(summary["errors"]) + "\n")
+    yield buffer.drain()
+
+
+def _pdf_chunks(results, buffer, summary):
+    merger = StreamingPdfMerger(buffer)
+    for _, pdf in results:
+        merger.add(pdf)
+        yield buffer.drain()
+    merger.close()
+    yield buffer.drain()
+
+
+def export_pdfs(store, engine, since=None, until=None, fmt="zip", summary=None):
+    """Yield the export of submissions created in [since, until) as byte chunks.
+
+    ``summary``, if given, is filled in with the exported and failed counts
+    and the render errors as the export runs.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown export format {fmt!r}")
+    summary = {} if summary is None else summary
+    summary.update(exported=0, failed=0, errors=[])
+
+    def rendered():
+        items = ((export_name(submission_id, created_at, data), data)
+                 for submission_id, created_at, data in store.created_between(since, until))
+        for name, pdf, error in engine.render_many(items):
+            if error is not None:
+                summary["failed"] += 1
+                summary["errors"].append(f"{name}: {error}")
+                log.warning("Could not render %s for export: %s", name, error)
+                continue
+            summary["exported"] += 1
+            yield name, pdf
+
+    buffer = _ChunkBuffer()
+    chunks = _zip_chunks if fmt == "zip" else _pdf_chunks
+    for chunk in chunks(rendered(), buffer, summary):
+        if chunk:
+            yield chunk
+    log.info("Exported submission PDFs", extra={
+        "format": fmt, "exported": summary["exported"], "failed": summary["failed"], "bytes": buffer.written,
+    })
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export intake PDFs of stored submissions")
+    parser.add_argument("--from", dest="since", help="first day to export (YYYY-MM-DD, UTC)")
+    parser.add_argument("--to", dest="until", help="last day to export (YYYY-MM-DD, UTC), inclusive")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="zip")
+    parser.add_argument("--workers", type=int, default=None, help="render processes (default: one per CPU)")
+    parser.add_argument("-o", "--output", required=True, help="file to write the export to")
+    args = parser.parse_args(argv)
+    setup_logging()
+
+    try:
+        since, until = date_range(args.since, args.until)
+    except ValueError as e:
+        parser.error(str(e))
+
+    store = SubmissionStore(os.getenv("SUBMISSIONS_DB", DEFAULT_DB_PATH))
+    engine = PdfRenderEngine(workers=args.workers, timeout=float(os.getenv("PDF_RENDER_TIMEOUT", "30")))
+    engine.start()
+    summary = {}
+    try:
+        with open(args.output, "wb") as f:
+            for chunk in export_pdfs(store, engine, since, until, args.format, summary):
+                f.write(chunk)
+    finally:
+        engine.shutdown()
+    return 0 if not summary.get("failed") else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
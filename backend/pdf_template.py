@@ -0,0 +1,237 @@
+"""Branded page template for generated PDFs.
+
+The pharmacy letterhead, title block, fonts and footer are described once
+per process by ``page_template()`` and every document created with
+``new_document()`` stamps them onto its pages through ``header()`` and
+``footer()``.  The branding comes from environment variables so it can be
+changed without touching the layout code.
+
+Documents are set in DejaVu Sans, bundled in ``fonts/``, so Latin, Greek and
+Cyrillic names print as written; ``PDF_FONT_PATH`` (and optionally
+``PDF_FONT_BOLD_PATH``) switch to another TrueType font, and setting
+``PDF_FONT_PATH`` to ``core`` falls back to the built-in Helvetica.  Parsing a
+TTF takes longer than laying out the whole intake form, so each font file is
+parsed once per process and every document gets a light copy of it with its
+own glyph subset.  With the core font, text it can't encode is transliterated
+instead of failing the render.
+"""
+import copy
+import io
+import logging
+import os
+import unicodedata
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+from fontTools import ttLib
+from fpdf import FPDF
+from fpdf.fonts import SubsetMap
+
+from images import shrink_logo
+
+log = logging.getLogger(__name__)
+
+# fpdf2 maps "Arial" onto its core Helvetica font
+FONT_FAMILY = "helvetica"
+# Family name the TTF fonts are registered under
+TTF_FAMILY = "body"
+FONTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+DEFAULT_FONT_PATH = os.path.join(FONTS_DIR, "DejaVuSans.ttf")
+DEFAULT_FONT_BOLD_PATH = os.path.join(FONTS_DIR, "DejaVuSans-Bold.ttf")
+# Core fonts are written with WinAnsiEncoding, which covers more than latin-1
+CORE_FONTS_ENCODING = "windows-1252"
+
+
+class PageTemplate(NamedTuple):
+    brand: str
+    contact_line: str
+    footer_note: str
+    font_family: str
+    logo: Optional[bytes]
+    # (style, path) of the TrueType files registered under font_family
+    font_files: tuple = ()
+    margin: float = 15
+    header_height: float = 24
+
+
+@lru_cache(maxsize=1)
+def page_template():
+    """The letterhead and fonts shared by every PDF this process renders"""
+    logo = None
+    logo_path = os.getenv("PDF_LOGO_PATH")
+    if logo_path:
+        with open(logo_path, "rb") as f:
+            # Printed 14 mm tall: a full-size logo only makes every PDF bigger
+            logo = shrink_logo(f.read())
+
+    font_files = ()
+    font_path = os.getenv("PDF_FONT_PATH")
+    if not font_path:
+        font_files = (("", DEFAULT_FONT_PATH), ("B", DEFAULT_FONT_BOLD_PATH))
+    elif font_path != "core":
+        font_files = (("", font_path), ("B", os.getenv("PDF_FONT_BOLD_PATH") or font_path))
+
+    return PageTemplate(
+        brand=os.getenv("PDF_BRAND_NAME", "City Life Pharmacy & Compounding Centre"),
+        contact_line=os.getenv(
+            "PDF_CONTACT_LINE",
+            "info@CityLifePharmacy.com  |  www.CityLifePharmacy.com  |  Tel 416-214-CITY (2489)",
+        ),
+        footer_note=os.getenv("PDF_FOOTER_NOTE", "Confidential patient information"),
+        font_family=TTF_FAMILY if font_files else FONT_FAMILY,
+        logo=logo,
+        font_files=font_files,
+    )
+
+
+class ParsedFont:
+    """A TrueType font parsed once, handed out to documents as cheap copies.
+
+    The copies set fpdf2's font internals directly, checked against the
+    fpdf2 range pinned in requirements; if they have changed, documents fall
+    back to the public ``add_font()`` and parse the file themselves.
+    """
+
+    def __init__(self, path, family, style):
+        with open(path, "rb") as f:
+            self.data = f.read()
+        scratch = FPDF()
+        scratch.add_font(family, style, path)
+        self.path = path
+        self.family = family
+        self.style = style
+        self.fontkey = f"{family}{style}"
+        self.copyable = True
+        self.font = scratch.fonts[self.fontkey]
+        # Metrics, cmap and glyph ids are all we keep from the parse
+        self.font.ttfont.close()
+        self.font.ttfont = None
+
+    def add_to(self, pdf):
+        """Register this font on ``pdf`` as if pdf.add_font() had parsed it"""
+        if self.copyable:
+            try:
+                pdf.fonts[self.fontkey] = self._copy(pdf)
+                return
+            except (AttributeError, TypeError) as e:
+                log.warning("Parsing %s for every document: %s", self.path, e)
+                self.copyable = False
+        pdf.add_font(self.family, self.style, self.path)
+
+    def _copy(self, pdf):
+        font = copy.copy(self.font)
+        font.i = len(pdf.fonts) + 1
+        # Embedding subsets the font's tables in place, so every document
+        # needs its own TTFont; loading it lazily from memory is cheap, and
+        # skipping the bbox recalculation copies the used glyphs into the
+        # subset without decompiling them.
+        font.ttfont = ttLib.TTFont(io.BytesIO(self.data), recalcTimestamp=False, recalcBBoxes=False,
+                                   lazy=True, fontNumber=font.collection_font_number)
+        font.ttfont.flavor = None
+        font.missing_glyphs = []
+        font.biggest_size_pt = 0
+        font._hbfont = None
+        font.subset = SubsetMap(font)
+        return font
+
+
+@lru_cache(maxsize=None)
+def parsed_font(path, family, style=""):
+    return ParsedFont(path, family, style)
+
+
+def load_fonts(template=None):
+    """Parse the template's fonts now, e.g. before forking render workers"""
+    template = template or page_template()
+    for style, path in template.font_files:
+        parsed_font(path, template.font_family, style)
+
+
+def core_font_text(text):
+    """Closest spelling of ``text`` the core fonts can encode, e.g. 'Dvořák' -> 'Dvorák'"""
+    try:
+        text.encode(CORE_FONTS_ENCODING)
+        return text
+    except UnicodeEncodeError:
+        return "".join(_core_font_char(char) for char in text)
+
+
+@lru_cache(maxsize=1024)
+def _core_font_char(char):
+    for candidate in (char, "".join(c for c in unicodedata.normalize("NFKD", char)
+                                    if not unicodedata.combining(c))):
+        try:
+            candidate.encode(CORE_FONTS_ENCODING)
+            return candidate
+        except UnicodeEncodeError:
+            pass
+    return "?"
+
+
+class BrandedPDF(FPDF):
+    """FPDF document that draws the pharmacy letterhead and footer on every page"""
+
+    def __init__(self, template=None, title=""):
+        super().__init__()
+        self.template = template or page_template()
+        self.doc_title = title
+        self.font_family_name = self.template.font_family
+        self.core_fonts_encoding = CORE_FONTS_ENCODING
+        for style, path in self.template.font_files:
+            parsed_font(path, self.template.font_family, style).add_to(self)
+        self.set_margins(self.template.margin, self.template.margin)
+        self.set_auto_page_break(True, margin=20)
+        self.set_creator(self.template.brand)
+        if title:
+            self.set_title(title)
+
+    def normalize_text(self, text):
+        if not self.is_ttf_font:
+            text = core_font_text(text)
+        return super().normalize_text(text)
+
+    def header(self):
+        template = self.template
+        top = self.get_y()
+        text_x = template.margin
+        if template.logo:
+            # fpdf2 reuses the parsed image for every page of the document
+            self.image(io.BytesIO(template.logo), x=template.margin, y=top, h=14)
+            text_x += 18
+
+        self.set_xy(text_x, top)
+        self.set_font(self.font_family_name, "B", 13)
+        self.set_text_color(20, 60, 110)
+        self.cell(0, 7, template.brand, 0, 1)
+        self.set_x(text_x)
+        self.set_font(self.font_family_name, "", 9)
+        self.set_text_color(90, 90, 90)
+        self.cell(0, 5, template.contact_line, 0, 1)
+
+        rule_y = top + template.header_height - 6
+        self.set_draw_color(20, 60, 110)
+        self.set_line_width(0.4)
+        self.line(template.margin, rule_y, self.w - template.margin, rule_y)
+        self.set_text_color(0, 0, 0)
+        self.set_y(top + template.header_height)
+
+    def footer(self):
+        self.set_y(-15)
+        self.set_font(self.font_family_name, "", 8)
+        self.set_text_color(120, 120, 120)
+        self.cell(0, 10, f"{self.template.footer_note}  -  Page {self.page_no()}/{{nb}}", 0, 0, "C")
+        self.set_text_color(0, 0, 0)
+
+    def title_block(self):
+        if self.doc_title:
+            self.set_font(self.font_family_name, "B", 16)
+            self.cell(0, 10, self.doc_title, ln=True, align="C")
+            self.ln(10)
+
+
+def new_document(title):
+    """A branded PDF with its first page and title block already laid out"""
+    pdf = BrandedPDF(title=title)
+    pdf.add_page()
+    pdf.title_block()
+    return pdf
@@ -0,0 +1,168 @@
+"""Opt-in profiling of single requests.
+
+A request is profiled with cProfile when the PROFILE_SAMPLE_RATE lottery
+picks it, or when an admin asks for it with the ``X-Profile: 1`` header.
+The background work it queues is profiled under the same trace ID, one
+profile per thread (cProfile only sees the thread it runs on).  Only one
+trace is profiled at a time; the others run untouched, so the overhead
+stays bounded even with a high sample rate.  When profiling is off the cost
+is one comparison per request.
+
+Profiles are written to PROFILE_DIR named after their duration, what ran
+and the trace ID.  Files are kept per trace: a trace's time runs from the
+start of its first profile to the end of its last, and only the
+PROFILE_KEEP slowest traces (plus the one still being recorded) are kept,
+all their files together:
+
+    data/profiles/0000004.2ms_submit_form_<traceId>.prof
+    data/profiles/0001234.5ms_process_submission.pharmacy_email_<traceId>.prof
+    python -m pstats data/profiles/0001234.5ms_process_submission.pharmacy_email_<traceId>.prof
+"""
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+DEFAULT_PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "profiles")
+
+log = logging.getLogger(__name__)
+
+
+def _parse_name(filename):
+    """(duration_ms, trace_id) from a profile's file name, or None"""
+    stem, ext = os.path.splitext(filename)
+    if ext != ".prof" or "ms_" not in stem or "_" not in stem.split("ms_", 1)[1]:
+        return None
+    duration, rest = stem.split("ms_", 1)
+    try:
+        return float(duration), rest.rsplit("_", 1)[1]
+    except ValueError:
+        return None
+
+
+class _Trace:
+    """The kept profile files of one trace and the wall-clock span they cover"""
+
+    def __init__(self):
+        self.started = None
+        self.ended = None
+        self.paths = []
+
+    def add(self, path, started, ended):
+        self.started = started if self.started is None else min(self.started, started)
+        self.ended = ended if self.ended is None else max(self.ended, ended)
+        self.paths.append(path)
+
+    @property
+    def total_ms(self):
+        return (self.ended - self.started) * 1000
+
+
+class RequestProfiler:
+    def __init__(self, directory=DEFAULT_PROFILE_DIR, keep=20, sample_rate=0.0):
+        self.directory = directory
+        self.keep = keep
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+        self._active_trace = None
+        self._active = 0
+        self._files_lock = threading.Lock()
+        self._traces = None
+        # Traces evicted lately, so their later profiles aren't kept on their own
+        self._dropped = OrderedDict()
+
+    def wanted(self, requested=False):
+        return requested or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def _begin(self, trace_id):
+        # Threads of the trace being profiled may join it; other traces may not
+        with self._lock:
+            if self._active and self._active_trace != trace_id:
+                return False
+            self._active_trace = trace_id
+            self._active += 1
+            return True
+
+    def _end(self):
+        with self._lock:
+            self._active -= 1
+
+    @contextmanager
+    def profile(self, name, trace_id, requested=False, sample=True):
+        """Profile the block if it is ``requested`` (or, with ``sample``, sampled) and no other trace is"""
+        if not (requested or (sample and self.wanted())) or not self._begin(trace_id):
+            yield
+            return
+        profiler = cProfile.Profile()
+        started_at = time.time()
+        started = time.perf_counter()
+        try:
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler or debugger already has the hook
+                profiler = None
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            self._end()
+        if profiler is not None:
+            self._keep(name, trace_id, started_at, (time.perf_counter() - started) * 1000, profiler)
+
+    def _load(self):
+        # {trace_id: _Trace} of the kept profiles; the span of a file from
+        # before a restart is its mtime minus its duration
+        if self._traces is None:
+            self._traces = {}
+            if os.path.isdir(self.directory):
+                for filename in os.listdir(self.directory):
+                    parsed = _parse_name(filename)
+                    if parsed is None:
+                        continue
+                    duration_ms, trace_id = parsed
+                    path = os.path.join(self.directory, filename)
+                    ended = os.path.getmtime(path)
+                    self._traces.setdefault(trace_id, _Trace()).add(path, ended - duration_ms / 1000, ended)
+        return self._traces
+
+    def _keep(self, name, trace_id, started_at, duration_ms, profiler):
+        with self._files_lock:
+            traces = self._load()
+            if trace_id in self._dropped:
+                log.info("Profiled request was not among the slowest",
+                         extra={"endpoint": name, "durationMs": round(duration_ms, 1)})
+                return None
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{duration_ms:09.1f}ms_{name}_{trace_id}.prof")
+            profiler.dump_stats(path)
+            traces.setdefault(trace_id, _Trace()).add(path, started_at, started_at + duration_ms / 1000)
+            # The trace being recorded may still get files, so it is only
+            # ranked once another trace has been profiled
+            others = sorted((kept for kept in traces if kept != trace_id), key=lambda kept: traces[kept].total_ms)
+            for evicted in others[:max(0, len(others) - self.keep)]:
+                self._evict(evicted)
+        log.info("Saved request profile", extra={"endpoint": name, "durationMs": round(duration_ms, 1), "path": path})
+        return path
+
+    def _evict(self, trace_id):
+        for path in self._traces.pop(trace_id).paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._dropped[trace_id] = None
+        while len(self._dropped) > 100:
+            self._dropped.popitem(last=False)
+
+
+def profiler_from_env():
+    return RequestProfiler(
+        directory=os.getenv("PROFILE_DIR", DEFAULT_PROFILE_DIR),
+        keep=int(os.getenv("PROFILE_KEEP", "20")),
+        sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+    )
@@ -0,0 +1,225 @@
+"""ShipStation API client shared by the Flask app and the store-discovery script.
+
+One pooled, keep-alive ``requests.Session`` is reused for every call so orders
+don't pay a new TLS handshake each time.  Every request has connect and read
+timeouts, and 429 / 5xx responses and connection errors are retried a bounded
+number of times with jittered exponential backoff.  A POST that timed out may
+still have gone through, so orders must carry an ``orderKey``: ShipStation
+then updates the existing order on a retry instead of creating another one.
+
+ShipStation throttles each API key (40 requests a minute by default) and
+reports what is left in the ``X-Rate-Limit-Remaining`` and
+``X-Rate-Limit-Reset`` headers.  Every call first takes a token from a shared
+``RateLimiter``, which follows those headers, so bursts wait their turn
+instead of running into 429s.
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+BASE_URL = "https://ssapi.shipstation.com"
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a request waited longer than allowed for rate-limit budget"""
+
+
+class RateLimiter:
+    """FIFO token bucket that tracks ShipStation's rate-limit headers"""
+
+    def __init__(self, capacity=40, period=60.0):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._queue = deque()
+        self._tickets = 0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        if now < self._blocked_until:
+            self._updated = now
+            return
+        if self._blocked_until:
+            # The server's window has reset
+            self._blocked_until = 0.0
+            self._tokens = float(self.capacity)
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _wait_time(self, now):
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout=None):
+        """Wait in line for a token; raises RateLimitTimeout after ``timeout`` seconds"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._tickets += 1
+            ticket = self._tickets
+            self._queue.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._queue[0] == ticket and self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = self._wait_time(now) if self._queue[0] == ticket else None
+                    if deadline is not None:
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            raise RateLimitTimeout(f"waited more than {timeout:g}s for ShipStation rate-limit budget")
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._cond.wait(wait)
+            finally:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+
+    def update(self, headers):
+        """Adjust the budget from a response's X-Rate-Limit-* headers"""
+        remaining = _float_header(headers, "X-Rate-Limit-Remaining")
+        reset = _float_header(headers, "X-Rate-Limit-Reset")
+        if remaining is None:
+            return
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens = min(self._tokens, remaining)
+            if remaining < 1 and reset is not None:
+                self._blocked_until = max(self._blocked_until, now + reset)
+            self._cond.notify_all()
+
+    def throttled(self, retry_after):
+        """Stop issuing requests for ``retry_after`` seconds after a 429"""
+        with self._cond:
+            now = time.monotonic()
+            self._tokens = 0.0
+            self._blocked_until = max(self._blocked_until, now + retry_after)
+            self._updated = now
+            self._cond.notify_all()
+
+    def status(self):
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                "capacity": self.capacity,
+                "available": round(self._tokens, 2),
+                "queueDepth": len(self._queue),
+                "blockedForSeconds": round(max(0.0, self._blocked_until - now), 2),
+            }
+
+
+class ShipStationClient:
+    """Thin wrapper around the ShipStation REST API"""
+
+    def __init__(self, api_key, api_secret, base_url=BASE_URL, connect_timeout=3.05, read_timeout=20.0,
+                 max_retries=3, backoff=0.5, backoff_max=10.0, pool_connections=4, pool_maxsize=16,
+                 rate_limiter=None, queue_timeout=120.0, max_throttled=10):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.queue_timeout = queue_timeout
+        self.max_throttled = max_throttled
+
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(api_key, api_secret)
+        self.session.headers.update({"Accept": "application/json"})
+        # Retries are handled in request() so 429s can honour Retry-After
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @classmethod
+    def from_env(cls):
+        """Build a client from SHIPSTATION_* environment variables"""
+        return cls(
+            os.getenv("SHIPSTATION_API_KEY"),
+            os.getenv("SHIPSTATION_API_SECRET"),
+            base_url=os.getenv("SHIPSTATION_BASE_URL", BASE_URL),
+            connect_timeout=float(os.getenv("SHIPSTATION_CONNECT_TIMEOUT", "3.05")),
+            read_timeout=float(os.getenv("SHIPSTATION_READ_TIMEOUT", "20")),
+            max_retries=int(os.getenv("SHIPSTATION_MAX_RETRIES", "3")),
+            pool_maxsize=int(os.getenv("SHIPSTATION_POOL_SIZE", "16")),
+            rate_limiter=RateLimiter(
+                capacity=int(os.getenv("SHIPSTATION_RATE_LIMIT", "40")),
+                period=float(os.getenv("SHIPSTATION_RATE_PERIOD", "60")),
+            ),
+            queue_timeout=float(os.getenv("SHIPSTATION_QUEUE_TIMEOUT", "120")),
+        )
+
+    def request(self, method, path, **kwargs):
+        """Send a request once rate-limit budget allows, retrying 429 / 5xx and connection failures"""
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        kwargs.setdefault("timeout", self.timeout)
+
+        attempt = 0
+        throttled = 0
+        while True:
+            self.rate_limiter.acquire(timeout=self.queue_timeout)
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                self.rate_limiter.update(response.headers)
+                if response.status_code == 429 and throttled < self.max_throttled:
+                    # Throttled: wait for the window to reset and queue up again
+                    throttled += 1
+                    wait = _float_header(response.headers, "Retry-After")
+                    if wait is None:
+                        wait = _float_header(response.headers, "X-Rate-Limit-Reset")
+                    self.rate_limiter.throttled(wait if wait is not None else self._backoff_delay(throttled))
+                    continue
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+
+            attempt += 1
+            time.sleep(self._backoff_delay(attempt))
+
+    def _backoff_delay(self, attempt):
+        # "Full jitter": a random delay up to the exponential cap
+        return random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt)))
+
+    def get_stores(self):
+        response = self.request("GET", "/stores")
+        response.raise_for_status()
+        return response.json()
+
+    def create_order(self, order):
+        """Create (or, for a known ``orderKey``, update) an order"""
+        return self.request("POST", "/orders/createorder", json=order)
+
+    def create_orders(self, orders):
+        """Create up to 100 orders in one bulk call"""
+        return self.request("POST", "/orders/createorders", json=orders)
+
+    def rate_limit_status(self):
+        """Current rate-limit budget and how many requests are waiting for it"""
+        return self.rate_limiter.status()
+
+    def close(self):
+        self.session.close()
+
+
+def _float_header(headers, name):
+    value = headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
@@ -0,0 +1,135 @@
+"""Pool of authenticated SMTP connections for outgoing mail.
+
+``mail.send()`` opens a new connection, runs STARTTLS and logs in for every
+message, which costs more than the send itself.  The pool keeps a few logged-in
+connections open across submissions, checks idle ones with NOOP before reuse,
+and reconnects when the server has dropped them.
+
+Every socket gets ``timeout`` and waiting for a free connection is bounded by
+``acquire_timeout``, so a server that stops answering fails sends (and trips
+the SMTP breaker) instead of holding every slot forever.
+"""
+import smtplib
+import threading
+import time
+from collections import deque
+
+
+class SMTPPool:
+    def __init__(self, mail, size=4, max_idle=120.0, check_after=15.0, max_messages=100, timeout=30.0,
+                 acquire_timeout=60.0):
+        self.mail = mail
+        self.size = size
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.acquire_timeout = acquire_timeout
+        self._idle = deque()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def _open(self):
+        # Same host setup as flask_mail's Connection.configure_host(), plus a socket timeout
+        state = self.mail.state
+        smtp_class = smtplib.SMTP_SSL if state.use_ssl else smtplib.SMTP
+        host = smtp_class(state.server, state.port, timeout=self.timeout)
+        try:
+            host.set_debuglevel(int(state.debug))
+            if state.use_tls:
+                host.starttls()
+            if state.username and state.password:
+                host.login(state.username, state.password)
+        except Exception:
+            host.close()
+            raise
+        self.opened += 1
+        return {"host": host, "last_used": time.monotonic(), "sent": 0}
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                return self._open()
+
+            idle_for = time.monotonic() - conn["last_used"]
+            if idle_for > self.max_idle or conn["sent"] >= self.max_messages:
+                _quit(conn)
+                continue
+            if idle_for > self.check_after:
+                try:
+                    if conn["host"].noop()[0] != 250:
+                        raise smtplib.SMTPServerDisconnected("NOOP failed")
+                except (smtplib.SMTPException, OSError):
+                    _close(conn)
+                    continue
+            return conn
+
+    def _checkin(self, conn):
+        conn["last_used"] = time.monotonic()
+        with self._lock:
+            self._idle.append(conn)
+
+    def sendmail(self, sender, recipients, body):
+        """Send a rendered message over a pooled connection"""
+        if self.mail.suppress:
+            return
+
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise TimeoutError(f"No SMTP connection free after {self.acquire_timeout:g}s")
+        try:
+            conn = self._checkout()
+            try:
+                self._send(conn, sender, recipients, body)
+            except smtplib.SMTPServerDisconnected:
+                conn = self._resend(sender, recipients, body)
+            except smtplib.SMTPException:
+                _close(conn)
+                raise
+            except OSError:
+                # Socket-level failure (a timeout included) on a reused connection
+                conn = self._resend(sender, recipients, body)
+            conn["sent"] += 1
+            self._checkin(conn)
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    def _send(conn, sender, recipients, body):
+        try:
+            conn["host"].sendmail(sender, recipients, body)
+        except Exception:
+            _close(conn)
+            raise
+
+    def _resend(self, sender, recipients, body):
+        # The server dropped the connection; retry once on a fresh one
+        conn = self._open()
+        self._send(conn, sender, recipients, body)
+        return conn
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for conn in idle:
+            _quit(conn)
+
+    def status(self):
+        with self._lock:
+            return {"size": self.size, "idle": len(self._idle), "opened": self.opened}
+
+
+def _quit(conn):
+    try:
+        conn["host"].quit()
+    except (smtplib.SMTPException, OSError):
+        _close(conn)
+
+
+def _close(conn):
+    try:
+        conn["host"].close()
+    except OSError:
+        pass
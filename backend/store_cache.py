@@ -0,0 +1,111 @@
+"""ShipStation store discovery.
+
+Instead of a hard-coded ``storeId``, the app lists ``/stores`` once at startup
+and picks the configured store (``SHIPSTATION_STORE_ID``) or the City Life
+Pharmacy store by name.  The list is cached on disk with a TTL so restarts
+don't hit the API, and a background thread keeps it fresh, so creating an
+order only ever reads the resolved ID from memory.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "shipstation_stores.json")
+
+STORE_NAME_HINTS = ("city life", "citylife")
+
+
+class StoreDirectory:
+    """Resolves and caches the ShipStation store orders are created in"""
+
+    def __init__(self, client, cache_path=DEFAULT_CACHE_PATH, ttl=6 * 3600, refresh_interval=3600,
+                 configured_store_id=None):
+        self.client = client
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.configured_store_id = configured_store_id or None
+        self.stores = []
+        self.fetched_at = None
+        self.store_id = None
+        self._ready = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Load the disk cache and refresh in the background when it is stale"""
+        if self._load_cache():
+            log.info("Using cached ShipStation stores", extra={"storeId": self.store_id})
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="store-refresh", daemon=True)
+            self._thread.start()
+
+    def wait_ready(self, timeout):
+        """Wait for the first store list; only matters right after a cold start"""
+        return self._ready.wait(timeout)
+
+    def refresh(self):
+        stores = self.client.get_stores()
+        self._apply(stores, time.time())
+        directory = os.path.dirname(self.cache_path) or "."
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"fetchedAt": self.fetched_at, "stores": stores}, f)
+        os.replace(tmp_path, self.cache_path)
+        log.info("Refreshed ShipStation stores", extra={"stores": len(stores), "storeId": self.store_id})
+
+    def status(self):
+        return {
+            "storeId": self.store_id,
+            "configuredStoreId": self.configured_store_id,
+            "storeCount": len(self.stores),
+            "fetchedAt": self.fetched_at,
+        }
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self._apply(cached.get("stores", []), cached.get("fetchedAt") or 0)
+        return True
+
+    def _stale(self):
+        return self.fetched_at is None or time.time() - self.fetched_at >= self.ttl
+
+    def _loop(self):
+        while True:
+            if self._stale():
+                try:
+                    self.refresh()
+                except Exception as e:
+                    log.warning("Could not refresh ShipStation stores: %s", e)
+                    self._ready.set()
+            time.sleep(self.refresh_interval if not self._stale() else min(60, self.refresh_interval))
+
+    def _apply(self, stores, fetched_at):
+        self.stores = stores
+        self.fetched_at = fetched_at
+        self.store_id = self._resolve(stores)
+        self._ready.set()
+
+    def _resolve(self, stores):
+        active = [store for store in stores if store.get("active", True)]
+        if self.configured_store_id:
+            if not any(str(store.get("storeId")) == str(self.configured_store_id) for store in active):
+                log.error("SHIPSTATION_STORE_ID %s is not an active ShipStation store", self.configured_store_id)
+            return self.configured_store_id
+
+        for store in active:
+            name = (store.get("storeName") or "").lower()
+            if any(hint in name for hint in STORE_NAME_HINTS):
+                return store.get("storeId")
+
+        if stores:
+            log.warning("No City Life Pharmacy store found in ShipStation; set SHIPSTATION_STORE_ID")
+        return None
@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+from outbox import DEAD, PENDING, SENDING, SENT, DeferDelivery, DeliveryRejected, Dispatcher, Outbox
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    return Outbox(str(tmp_path / "outbox.db"), max_attempts=3, backoff_base=10.0, lease_seconds=60.0)
+
+
+def test_claim_is_exclusive(outbox):
+    entry_id = outbox.add("email", {"to": "a@example.com"}, body=b"mime")
+    entry = outbox.claim(entry_id)
+    assert entry["status"] == SENDING
+    assert entry["body"] == b"mime"
+    assert outbox.claim(entry_id) is None
+    assert outbox.due(10) == []
+
+
+def test_expired_lease_can_be_claimed_again(outbox):
+    entry_id = outbox.add("email", {})
+    outbox.claim(entry_id)
+    outbox.lease_seconds = 0.05
+    time.sleep(0.1)
+    assert outbox.due(10) == [entry_id]
+    assert outbox.claim(entry_id) is not None
+
+
+def test_failure_backs_off_until_dead(outbox):
+    entry_id = outbox.add("email", {})
+    outbox.claim(entry_id)
+    before = time.time()
+    assert outbox.mark_failed(entry_id, "timeout") == PENDING
+    entry = outbox.get(entry_id)
+    assert entry["attempts"] == 1
+    assert entry["last_error"] == "timeout"
+    assert entry["next_attempt_at"] >= before + 10.0
+    # Not due again until the backoff has passed
+    assert outbox.claim(entry_id) is None
+
+    assert outbox.claim(entry_id, ignore_schedule=True) is not None
+    outbox.mark_failed(entry_id, "timeout")
+    assert outbox.get(entry_id)["next_attempt_at"] >= before + 20.0
+    outbox.claim(entry_id, ignore_schedule=True)
+    assert outbox.mark_failed(entry_id, "timeout") == DEAD
+
+
+def test_sent_entry_drops_its_body(outbox):
+    entry_id = outbox.add("email", {}, body=b"mime")
+    outbox.claim(entry_id)
+    outbox.mark_sent(entry_id)
+    entry = outbox.get(entry_id)
+    assert entry["status"] == SENT
+    assert entry["body"] is None
+
+
+def test_dispatcher_retries_defers_and_rejects(outbox):
+    outcomes = {"flaky": [RuntimeError("down"), None], "busy": [DeferDelivery(0, "breaker open"), None],
+                "refused": [DeliveryRejected("400")]}
+
+    def handle(entry):
+        outcome = outcomes[entry["payload"]["name"]].pop(0)
+        if outcome is not None:
+            raise outcome
+
+    dispatcher = Dispatcher(outbox, {"email": handle})
+    flaky = outbox.add("email", {"name": "flaky"})
+    busy = outbox.add("email", {"name": "busy"})
+    refused = outbox.add("email", {"name": "refused"})
+
+    assert dispatcher.drain() == 0
+    assert outbox.get(flaky)["status"] == PENDING and outbox.get(flaky)["attempts"] == 1
+    assert outbox.get(busy)["status"] == PENDING and outbox.get(busy)["attempts"] == 0
+    assert outbox.get(refused)["status"] == DEAD
+
+    assert dispatcher.dispatch(flaky, ignore_schedule=True)
+    assert dispatcher.dispatch(busy)
+    assert outbox.counts() == {SENT: 2, DEAD: 1}
@@ -0,0 +1,46 @@
+import os
+import time
+
+from profiling import RequestProfiler
+
+
+def profile_trace(profiler, trace_id, *seconds):
+    for n, duration in enumerate(seconds):
+        with profiler.profile(f"step{n}", trace_id, requested=True):
+            time.sleep(duration)
+
+
+def kept_traces(directory):
+    return sorted({filename.rsplit("_", 1)[1][:-len(".prof")] for filename in os.listdir(directory)})
+
+
+def test_slowest_traces_are_kept_whole(tmp_path):
+    profiler = RequestProfiler(str(tmp_path), keep=2)
+    profile_trace(profiler, "fast", 0.01, 0.02)
+    profile_trace(profiler, "slow", 0.01, 0.2)
+    # Short first profile: not ranked until its trace is done
+    profile_trace(profiler, "medium", 0.01, 0.1)
+    assert kept_traces(tmp_path) == ["fast", "medium", "slow"]
+
+    profile_trace(profiler, "next", 0.01)
+    assert kept_traces(tmp_path) == ["medium", "next", "slow"]
+    assert len(os.listdir(tmp_path)) == 5
+
+
+def test_evicted_trace_is_not_kept_in_part(tmp_path):
+    profiler = RequestProfiler(str(tmp_path), keep=1)
+    profile_trace(profiler, "slow", 0.1)
+    profile_trace(profiler, "fast", 0.01)
+    profile_trace(profiler, "other", 0.01)
+    assert kept_traces(tmp_path) == ["other", "slow"]
+    # A late profile of the evicted trace doesn't bring it back
+    profile_trace(profiler, "fast", 0.3)
+    assert kept_traces(tmp_path) == ["other", "slow"]
+
+
+def test_ranking_survives_a_restart(tmp_path):
+    profile_trace(RequestProfiler(str(tmp_path), keep=1), "slow", 0.01, 0.1)
+    profiler = RequestProfiler(str(tmp_path), keep=1)
+    profile_trace(profiler, "fast", 0.01)
+    profile_trace(profiler, "other", 0.01)
+    assert kept_traces(tmp_path) == ["other", "slow"]
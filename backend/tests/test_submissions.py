@@ -0,0 +1,65 @@
+import multiprocessing
+import time
+
+import pytest
+
+from jobs import DONE, STAGES, JobQueue, SubmissionStore
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "submissions.db")
+
+
+def open_store(db_path, lease_seconds=60.0):
+    return SubmissionStore(db_path, lease_seconds=lease_seconds)
+
+
+def test_leased_submission_is_not_recovered(db_path):
+    mine = open_store(db_path)
+    submission_id = mine.create({"firstName": "Ana"})
+    other = open_store(db_path)
+    assert other.claim_abandoned() == []
+    assert not other.claim(submission_id)
+    assert mine.claim(submission_id)
+
+
+def test_recovery_requeues_expired_unfinished_submissions(db_path):
+    crashed = open_store(db_path, lease_seconds=0.05)
+    abandoned = crashed.create({})
+    finished = crashed.create({})
+    for stage in STAGES:
+        crashed.set_stage(finished, stage, DONE)
+    time.sleep(0.1)
+
+    handled = []
+    queue = JobQueue(handled.append, max_workers=1)
+    survivor = open_store(db_path)
+    assert queue.recover(survivor) == [abandoned]
+    queue.shutdown()
+    assert handled == [abandoned]
+    # The survivor holds the lease now; the crashed owner can't take it back
+    assert open_store(db_path).claim_abandoned() == []
+    assert not crashed.claim(abandoned)
+
+
+def _recover(db_path, results):
+    results.put(open_store(db_path).claim_abandoned())
+
+
+def test_two_processes_never_recover_the_same_submission(db_path):
+    crashed = open_store(db_path, lease_seconds=0.05)
+    submission_ids = [crashed.create({"n": n}) for n in range(20)]
+    time.sleep(0.1)
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    workers = [context.Process(target=_recover, args=(db_path, results)) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    claimed = [results.get(timeout=60) for _ in workers]
+    for worker in workers:
+        worker.join(timeout=60)
+
+    assert not set(claimed[0]) & set(claimed[1])
+    assert sorted(claimed[0] + claimed[1]) == sorted(submission_ids)
@@ -0,0 +1,175 @@
+"""Request tracing.
+
+A trace ID is assigned when a submission arrives at /submit-form and is
+stored with it.  Every step that works on the submission runs as a timed
+span of that trace: the request itself, each stage on the job workers and
+each outbox delivery, retries included.  The ID also goes out in the
+X-Trace-Id header of the emails and in the ShipStation order's internal
+notes, and it is added to every log record made inside a span.
+
+Finished spans are appended to a JSONL file (TRACE_FILE, default
+data/spans.jsonl) by a background thread, one span per line:
+
+    {"traceId": "...", "spanId": "...", "parentId": "...", "name": "pdf",
+     "start": "2026-10-17T12:00:00.000+00:00", "durationMs": 212.4, "status": "ok", "attrs": {...}}
+
+so ``grep <traceId> data/spans.jsonl`` shows one submission end to end.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+DEFAULT_TRACE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "spans.jsonl")
+
+_current = contextvars.ContextVar("span", default=None)
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def current_trace_id():
+    """Trace ID of the span running in this context, or None"""
+    span = _current.get()
+    return span.trace_id if span is not None else None
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attrs", "status")
+
+    def __init__(self, trace_id, parent_id, name, attrs):
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self.status = "ok"
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+class JsonlExporter:
+    """Appends finished spans to a file from a background thread.
+
+    The file is rotated to ``<path>.1`` once it grows past ``max_bytes``.
+    """
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        if self._pid != os.getpid():
+            self._start()
+        self._queue.put(span)
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.SimpleQueue()
+            self._thread = threading.Thread(target=self._loop, name="span-export", daemon=True)
+            self._thread.start()
+            if self._pid is None:
+                atexit.register(self.close)
+            self._pid = os.getpid()
+
+    def close(self):
+        """Write out the spans still queued"""
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+    def _loop(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        while True:
+            spans = [self._queue.get()]
+            # Whatever else finished meanwhile goes out in the same write
+            while True:
+                try:
+                    spans.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in spans
+            lines = "".join(json.dumps(span, default=str) + "\n" for span in spans if span is not None)
+            try:
+                if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                    os.replace(self.path, f"{self.path}.1")
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(lines)
+            except OSError as e:
+                logging.getLogger(__name__).warning("Could not write spans to %s: %s", self.path, e)
+            if stop:
+                return
+
+
+class Tracer:
+    """Creates spans; with no exporter, spans only carry the trace ID along"""
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+
+    @contextmanager
+    def span(self, name, trace_id=None, **attrs):
+        """Time a block as a span of ``trace_id`` (default: the current trace, or a new one)"""
+        parent = _current.get()
+        if trace_id is None:
+            trace_id = parent.trace_id if parent is not None else new_trace_id()
+        parent_id = parent.span_id if parent is not None and parent.trace_id == trace_id else None
+        span = Span(trace_id, parent_id, name, attrs)
+        token = _current.set(span)
+        started_at = time.time()
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "error"
+            span.attrs["error"] = str(e)[:500]
+            raise
+        finally:
+            _current.reset(token)
+            if self.exporter is not None:
+                self.exporter.export({
+                    "traceId": span.trace_id,
+                    "spanId": span.span_id,
+                    "parentId": span.parent_id,
+                    "name": span.name,
+                    "start": datetime.fromtimestamp(started_at, timezone.utc).isoformat(timespec="milliseconds"),
+                    "durationMs": round((time.perf_counter() - started) * 1000, 2),
+                    "status": span.status,
+                    "attrs": span.attrs,
+                })
+
+
+def tracer_from_env():
+    """Tracer exporting to TRACE_FILE; an empty TRACE_FILE turns the span file off"""
+    path = os.getenv("TRACE_FILE", DEFAULT_TRACE_FILE)
+    max_bytes = int(os.getenv("TRACE_FILE_MAX_BYTES", str(50 * 1024 * 1024)))
+    return Tracer(JsonlExporter(path, max_bytes) if path else None)
+
+
+def add_trace_id_to_logs():
+    """Give every log record made inside a span a ``traceId`` field"""
+    make_record = logging.getLogRecordFactory()
+
+    def record_factory(*args, **kwargs):
+        record = make_record(*args, **kwargs)
+        span = _current.get()
+        if span is not None:
+            record.traceId = span.trace_id
+        return record
+
+    logging.setLogRecordFactory(record_factory)
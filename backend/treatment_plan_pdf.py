@@ -0,0 +1,130 @@
+"""Personalized treatment-plan PDF for the patient email.
+
+One PDF per patient: a branded cover page with the patient's name and the
+medication's titration schedule, followed by the injection instructions for
+injectables.  The schedule is read from the medication's treatment-plan
+email, so medications whose email has no month-by-month schedule get no
+plan PDF.  Only the cover page is rendered per patient.  The instruction
+PDFs come from the attachment cache, are parsed once, and their pages are
+copied into the plan as-is.
+"""
+import io
+import re
+import threading
+from datetime import date
+from typing import NamedTuple
+
+from pypdf import PdfReader, PdfWriter
+
+from email_templates import registry as templates
+from pdf_template import new_document
+
+
+class Schedule(NamedTuple):
+    medication: str
+    steps: tuple
+    notes: tuple = ()
+
+
+_PRESCRIBED = re.compile(r"You have been prescribed ([^.]+?)\.")
+_STEP = re.compile(r"^\s*(Month \d+)\s*:\s*(.+?)\.?\s*$", re.MULTILINE)
+_NOTE = re.compile(r"^\s*\*(Months? \d[^*]*?)\*?\s*$", re.MULTILINE)
+_FOLLOW_UP = re.compile(r"At your follow up[^.]*\.")
+_TAG = re.compile(r"<[^>]+>")
+
+
+def parse_schedule(source):
+    """The month-by-month schedule a treatment-plan email lists, or None if it has none"""
+    text = _TAG.sub("", source)
+    steps = tuple((step, " ".join(instruction.split())) for step, instruction in _STEP.findall(text))
+    if not steps:
+        return None
+    prescribed = _PRESCRIBED.search(text)
+    notes = tuple(" ".join(note.split()) for note in _NOTE.findall(text))
+    notes += tuple(" ".join(note.split()) for note in _FOLLOW_UP.findall(text)[:1])
+    return Schedule(prescribed.group(1) if prescribed else steps[0][1], steps, notes)
+
+
+# Read from the treatment-plan emails, so the PDF and the email can't disagree
+SCHEDULES = {key: schedule for key, template in templates.templates.items()
+             if (schedule := parse_schedule(template.source)) is not None}
+
+
+def schedule_for(medication):
+    return SCHEDULES.get(templates.key_for(medication))
+
+
+def render_cover(name, schedule, has_instructions=False):
+    """Cover page with the patient's name and titration schedule, as PDF bytes"""
+    pdf = new_document("Your Treatment Plan")
+    font = pdf.font_family_name
+
+    pdf.set_font(font, size=12)
+    pdf.cell(0, 8, f"Prepared for {name} on {date.today():%B %d, %Y}", 0, 1)
+    pdf.ln(4)
+    pdf.set_font(font, "B", 14)
+    pdf.cell(0, 10, schedule.medication, 0, 1)
+    pdf.ln(2)
+
+    for step, instruction in schedule.steps:
+        pdf.set_font(font, "B", 12)
+        pdf.cell(30, 8, step, 0, 0)
+        pdf.set_font(font, size=12)
+        pdf.multi_cell(0, 8, instruction, new_x="LMARGIN", new_y="NEXT")
+
+    pdf.ln(4)
+    pdf.set_font(font, size=10)
+    for note in schedule.notes:
+        pdf.multi_cell(0, 6, note, new_x="LMARGIN", new_y="NEXT")
+        pdf.ln(2)
+    if has_instructions:
+        pdf.ln(4)
+        pdf.set_font(font, "B", 11)
+        pdf.multi_cell(0, 6, "Your injection instructions follow on the next pages. Please read them carefully.",
+                       new_x="LMARGIN", new_y="NEXT")
+
+    return bytes(pdf.output())
+
+
+class TreatmentPlanBuilder:
+    """Builds treatment-plan PDFs from the cached instruction PDFs.
+
+    ``render`` renders a cover page; pass the render pool's ``render_cover``
+    to keep FPDF off the calling thread.
+    """
+
+    def __init__(self, attachment_cache, render=render_cover):
+        self.attachment_cache = attachment_cache
+        self.render = render
+        self._readers = {}
+        self._lock = threading.Lock()
+
+    def _reader(self, cached):
+        # Parsed once per version of the file; PdfReader isn't thread-safe,
+        # so each one comes with the lock its users copy pages under.
+        entry = self._readers.get(cached.path)
+        if entry is None or entry[0] != cached.signature:
+            with self._lock:
+                entry = self._readers.get(cached.path)
+                if entry is None or entry[0] != cached.signature:
+                    entry = (cached.signature, PdfReader(io.BytesIO(cached.data)), threading.Lock())
+                    self._readers[cached.path] = entry
+        return entry[1], entry[2]
+
+    def build(self, name, medication):
+        """The plan PDF's bytes, or None when the medication has no schedule"""
+        schedule = schedule_for(medication)
+        if schedule is None:
+            return None
+
+        instructions = self.attachment_cache.instructions_for(medication)
+        writer = PdfWriter()
+        writer.append(PdfReader(io.BytesIO(self.render(name, schedule, instructions is not None))))
+        if instructions is not None:
+            reader, lock = self._reader(instructions)
+            with lock:
+                writer.append(reader)
+
+        output = io.BytesIO()
+        writer.write(output)
+        return output.getvalue()
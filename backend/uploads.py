@@ -0,0 +1,110 @@
+"""ID file uploads.
+
+An uploaded ID is copied to disk chunk by chunk as the request is read, so
+it is never held in memory, and it is rejected as soon as it passes the size
+limit.  Its type comes from the file's first bytes, not from the name the
+browser sent, and the pharmacy email attaches it straight from disk.  The
+file is deleted once the pharmacy email holds its own copy.
+"""
+import os
+import uuid
+from typing import NamedTuple, Optional
+
+DEFAULT_UPLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "uploads")
+DEFAULT_MAX_BYTES = 15 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# Accepted ID file types and the extension they are stored and mailed with
+EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/heic": "heic",
+    "image/webp": "webp",
+    "image/gif": "gif",
+    "image/tiff": "tiff",
+    "application/pdf": "pdf",
+}
+
+_HEIF_BRANDS = (b"heic", b"heix", b"hevc", b"heim", b"heis", b"mif1", b"msf1")
+
+
+def detect_content_type(head):
+    """Content type of a file from its first bytes, or None if it isn't an accepted type"""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"%PDF-"):
+        return "application/pdf"
+    if head[4:8] == b"ftyp" and head[8:12] in _HEIF_BRANDS:
+        return "image/heic"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "image/tiff"
+    return None
+
+
+class UploadRejected(ValueError):
+    """The upload is too large or not a file type we accept"""
+
+
+class StoredUpload(NamedTuple):
+    filename: str
+    path: str
+    content_type: str
+
+    @property
+    def extension(self):
+        return EXTENSIONS.get(self.content_type, "bin")
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def discard(self):
+        """Delete the stored file; it may already be gone"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def save_upload(stream, filename, upload_dir=DEFAULT_UPLOAD_DIR, max_bytes=DEFAULT_MAX_BYTES,
+                accept_unknown=False) -> Optional[StoredUpload]:
+    """Copy an upload stream to ``upload_dir``; None for an empty file.
+
+    Raises UploadRejected when the file is larger than ``max_bytes`` (None:
+    no limit) or, unless ``accept_unknown``, isn't one of the accepted types.
+    """
+    head = stream.read(CHUNK_SIZE)
+    if not head:
+        return None
+    content_type = detect_content_type(head)
+    if content_type is None:
+        if not accept_unknown:
+            raise UploadRejected("The ID file must be a photo (JPEG, PNG, HEIC, WebP, GIF, TIFF) or a PDF")
+        content_type = "application/octet-stream"
+
+    os.makedirs(upload_dir, exist_ok=True)
+    path = os.path.join(upload_dir, f"{uuid.uuid4().hex}.{EXTENSIONS.get(content_type, 'bin')}")
+    size = 0
+    try:
+        with open(path, "wb") as f:
+            chunk = head
+            while chunk:
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise UploadRejected(f"The ID file is larger than {max_bytes / (1024 * 1024):.0f} MB")
+                f.write(chunk)
+                chunk = stream.read(CHUNK_SIZE)
+    except BaseException:
+        os.remove(path)
+        raise
+    return StoredUpload(filename or f"id.{EXTENSIONS.get(content_type, 'bin')}", path, content_type)
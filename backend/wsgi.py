@@ -0,0 +1,9 @@
+"""WSGI entry point, e.g. ``gunicorn wsgi:app``.
+
+Importing ``app`` only sets the service up; this is where a WSGI server's
+worker starts the background work that ``python app.py`` starts itself.
+"""
+
+from app import app, start_background_work
+
+start_background_work()
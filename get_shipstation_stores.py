@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
-import requests
-from requests.auth import HTTPBasicAuth
-import json
 import os
+import sys
 from dotenv import load_dotenv
 
+# Share the app's ShipStation client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+from shipstation import ShipStationClient
+
 # Load environment variables
 load_dotenv()
 
@@ -16,11 +18,10 @@ def get_shipstation_stores():
         print("❌ ShipStation credentials not found in environment variables")
         return
     
-    url = "https://ssapi.shipstation.com/stores"
-    auth = HTTPBasicAuth(SHIPSTATION_API_KEY, SHIPSTATION_API_SECRET)
+    client = ShipStationClient.from_env()
     
     try:
-        response = requests.get(url, auth=auth)
+        response = client.request("GET", "/stores")
         if response.status_code == 200:
             stores_data = response.json()
             print("📦 Available ShipStation Stores:")